@@ -1,18 +1,50 @@
 from flask import Flask
+from werkzeug.middleware.proxy_fix import ProxyFix
 from ad_server.config import Config
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
+from ad_server.utils.hashing import PasswordHasher
+from ad_server.utils.ratelimit import RateLimiter
 
 
 db = SQLAlchemy()
 migrate = Migrate()
+password_hasher = PasswordHasher()
+limiter = RateLimiter()
 
 
 def create_app(config=Config):
     app = Flask(__name__)
     app.config.from_object(config)
+    proxies = app.config.get('TRUSTED_PROXIES')
+    if proxies:
+        # Client address and scheme are taken from X-Forwarded-For
+        # and X-Forwarded-Proto set by the proxies
+        app.wsgi_app = ProxyFix(
+            app.wsgi_app, x_for=proxies, x_proto=proxies)
     db.init_app(app)
     migrate.init_app(app, db)
+    password_hasher.init_app(app)
+    limiter.init_app(app)
+
+    from ad_server.models import user_cache
+    user_cache.configure(
+        maxsize=app.config.get('USER_CACHE_SIZE'),
+        ttl=app.config.get('USER_CACHE_TTL'))
+
+    from ad_server.views.auth import token_cache, revocation_cache
+    token_cache.configure(maxsize=app.config.get('TOKEN_CACHE_SIZE'))
+    revocation_cache.configure(
+        maxsize=app.config.get('TOKEN_CACHE_SIZE'),
+        ttl=app.config.get('TOKEN_REVOCATION_CHECK_INTERVAL'))
+
+    from ad_server.utils.streaming import head_cache, file_cache
+    head_cache.configure(
+        budget=app.config.get('HEAD_CACHE_SIZE'),
+        head_size=app.config.get('HEAD_CACHE_HEAD_SIZE'))
+    file_cache.configure(
+        maxsize=app.config.get('FILE_CACHE_SIZE'),
+        ttl=app.config.get('FILE_CACHE_TTL'))
 
     from ad_server.views.users import users as users_bp
     app.register_blueprint(users_bp, url_prefix='/api/public/auth')
@@ -20,7 +52,28 @@ def create_app(config=Config):
     from ad_server.views.media import media as media_bp
     app.register_blueprint(media_bp, url_prefix='/api/public/media')
 
+    from ad_server.views.admin import admin as admin_bp
+    app.register_blueprint(admin_bp, url_prefix='/api/private/admin')
+
+    # Threads are started by the first request, so they run in every
+    # worker of a pre-forking server and never in one-shot scripts
+    app.before_first_request(lambda: start_background_tasks(app))
+
     return app
 
 
+def start_background_tasks(app):
+    from ad_server.utils.sweeper import start_token_sweeper
+    start_token_sweeper(app)
+
+    from ad_server.utils.streaming import start_head_cache_warmer
+    start_head_cache_warmer(app)
+
+    from ad_server.utils.listens import start_listen_flusher
+    start_listen_flusher(app)
+
+    from ad_server.utils.tiers import start_tier_balancer
+    start_tier_balancer(app)
+
+
 from ad_server import models
@@ -14,7 +14,108 @@ class Config:
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     MEDIA_STORAGE = os.environ.get('MEDIA_STORAGE') or\
         os.path.join(PWD, 'media_storage')
+    # Root of the content addressed song files storage,
+    # defaults to MEDIA_STORAGE/library
+    LIBRARY_STORAGE = os.environ.get('LIBRARY_STORAGE')
+    # Faster storage holding copies of the most listened songs,
+    # comma separated <root>=<budget in bytes>, fastest first
+    STORAGE_TIERS = os.environ.get('STORAGE_TIERS')
+    # Seconds between placements of songs on the tiers, 0 to disable.
+    # Placement can be run by cron instead, see utils.tiers
+    STORAGE_TIER_INTERVAL = int(
+        os.environ.get('STORAGE_TIER_INTERVAL', 3600))
+    # Folder of the local cover store, defaults to MEDIA_STORAGE/covers
+    COVER_STORAGE = os.environ.get('COVER_STORAGE')
+    # Covers never change under the same hash
+    COVER_MAX_AGE = 365 * 24 * 3600
+    STREAM_CHUNK_SIZE = 64 * 1024
+    # Memory for starts of the most listened songs, 0 to disable
+    HEAD_CACHE_SIZE = int(os.environ.get('HEAD_CACHE_SIZE', 64 * 1024 ** 2))
+    HEAD_CACHE_HEAD_SIZE = 256 * 1024
+    # Seconds between refills of the head cache by popularity
+    HEAD_CACHE_REFRESH = int(os.environ.get('HEAD_CACHE_REFRESH', 600))
+    # Open song files kept by every worker, capped at a quarter
+    # of the descriptor limit, and seconds their stat results are trusted
+    FILE_CACHE_SIZE = int(os.environ.get('FILE_CACHE_SIZE', 256))
+    FILE_CACHE_TTL = 5
+    # Paced streams are sent no faster than STREAM_PACING_FACTOR times
+    # bitrate of the song after the first STREAM_PACING_BURST seconds
+    STREAM_PACING = os.environ.get('STREAM_PACING', '').lower() in \
+        ('1', 'true', 'yes')
+    STREAM_PACING_BURST = 30
+    STREAM_PACING_FACTOR = 1.5
+    # Key of signed stream urls, defaults to SECRET_KEY
+    STREAM_URL_SECRET = os.environ.get('STREAM_URL_SECRET')
+    STREAM_URL_TTL = int(os.environ.get('STREAM_URL_TTL', 3600))
+    # Internal location of LIBRARY_STORAGE in the reverse proxy, if set
+    # files of signed urls are sent by the proxy with X-Accel-Redirect
+    STREAM_ACCEL_PREFIX = os.environ.get('STREAM_ACCEL_PREFIX')
+    # Seconds between writes of listens counted in memory
+    LISTEN_FLUSH_INTERVAL = int(os.environ.get('LISTEN_FLUSH_INTERVAL', 10))
+    # Threads handling requests of the async server, see utils.asgi.
+    # Streams are sent without holding a thread.
+    ASYNC_WORKERS = int(os.environ.get('ASYNC_WORKERS', 32))
+    # Length of HLS segments of songs in seconds
+    HLS_SEGMENT_DURATION = int(os.environ.get('HLS_SEGMENT_DURATION', 10))
+    HLS_SEGMENT_MAX_AGE = 24 * 3600
+    PREVIEW_MAX_AGE = 24 * 3600
     LAST_FM_API_KEY = os.environ.get('LAST_FM_API_KEY')
+    LAST_FM_API_URL = os.environ.get('LAST_FM_API_URL') or\
+        'http://ws.audioscrobbler.com/2.0'
+    # Sqlite file with cached last.fm responses, no caching if empty
+    LAST_FM_CACHE = os.environ.get('LAST_FM_CACHE') or\
+        os.path.join(PWD, 'lastfm_cache.db')
+    LAST_FM_CACHE_TTL = 30 * 24 * 3600
+    LAST_FM_MAX_CONCURRENCY = 4
+    # Users cached during token authentication
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 1024))
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', 300))
+    # Claims of verified access tokens
+    TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 4096))
+    # Seconds a token found not revoked is trusted without asking
+    # the database. Revocations made by other workers take effect
+    # within this time.
+    TOKEN_REVOCATION_CHECK_INTERVAL = int(
+        os.environ.get('TOKEN_REVOCATION_CHECK_INTERVAL', 30))
+    # Password hashing method in werkzeug format. Existing hashes are
+    # updated on login when it changes.
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or\
+        'pbkdf2:sha256:260000'
+    # Threads checking passwords and checks allowed to wait for them
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+    PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE', 8))
+    PASSWORD_HASH_TIMEOUT = 5
+    RATELIMIT_ENABLED = True
+    # Number of reverse proxies in front of the app, e.g. 1 behind
+    # nginx. Rate limits are applied to client addresses forwarded
+    # by them. 0 if clients connect to the app directly.
+    TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES', 0))
+    # Either 'memory' for buckets of a single process or path to
+    # a sqlite file shared by all workers
+    RATELIMIT_STORAGE = os.environ.get('RATELIMIT_STORAGE') or 'memory'
+    # Seconds between deletions of expired refresh tokens, 0 to disable
+    TOKEN_SWEEP_INTERVAL = int(os.environ.get('TOKEN_SWEEP_INTERVAL', 3600))
+    TOKEN_SWEEP_BATCH_SIZE = 1000
+    # Folder watched by the ingestion daemon, defaults to MEDIA_STORAGE
+    INGEST_DROP_FOLDER = os.environ.get('INGEST_DROP_FOLDER')
+    # Json file where the drop folder watcher reports its state
+    INGEST_STATUS_FILE = os.environ.get('INGEST_STATUS_FILE') or\
+        os.path.join(MEDIA_STORAGE, 'ingest_status.json')
+    UPLOAD_CHUNK_SIZE = 64 * 1024
+    UPLOAD_MAX_SIZE = int(os.environ.get('UPLOAD_MAX_SIZE', 512 * 1024 ** 2))
+    # Json file where the integrity scanner writes its last report
+    INTEGRITY_REPORT_FILE = os.environ.get('INTEGRITY_REPORT_FILE') or\
+        os.path.join(MEDIA_STORAGE, 'integrity_report.json')
+
+
+# One-shot scripts and daemons in ad_server.utils, which serve
+# no requests and run no background threads
+class ScriptConfig(Config):
+
+    TOKEN_SWEEP_INTERVAL = 0
+    HEAD_CACHE_REFRESH = 0
+    LISTEN_FLUSH_INTERVAL = 0
+    STORAGE_TIER_INTERVAL = 0
 
 
 class TestConfig(Config):
@@ -23,4 +124,12 @@ class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URI')
     SONGS_URLS = os.environ.get('SONGS_URLS')
+    LAST_FM_CACHE = None
     PRESERVE_CONTEXT_ON_EXCEPTION = False
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
+    # Enabled by tests of rate limits only
+    RATELIMIT_ENABLED = False
+    TOKEN_SWEEP_INTERVAL = 0
+    HEAD_CACHE_REFRESH = 0
+    LISTEN_FLUSH_INTERVAL = 0
+    STORAGE_TIER_INTERVAL = 0
@@ -1,12 +1,14 @@
 import os
 import base64
 
-from ad_server import db
-from werkzeug.security import generate_password_hash, check_password_hash
+from ad_server import db, password_hasher
+from werkzeug.security import check_password_hash
 from datetime import datetime, timedelta
 from flask_sqlalchemy import BaseQuery
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import make_transient_to_detached
 from ad_server.views.error import RefreshTokenError
+from ad_server.utils.cache import TTLCache
 
 
 # from sqlalchemy import MetaData
@@ -15,6 +17,11 @@ from ad_server.views.error import RefreshTokenError
 # __table__ = meta.tables['tablename']
 
 
+# Users loaded during token authentication, keyed by user id.
+# Limits are applied from app config in create_app.
+user_cache = TTLCache()
+
+
 # Key based pagination
 def paginate(query, per_page, key, last=0):
     return query.filter(key > last).order_by(key).limit(per_page)
@@ -49,6 +56,9 @@ class User(db.Model, BaseModel):
     id = db.Column('id', db.Integer, primary_key=True, nullable=False)
     login = db.Column('login', db.String(64), nullable=False, unique=True)
     pass_hash = db.Column('pass_hash', db.String(128), nullable=False)
+    is_admin = db.Column(
+        'is_admin', db.Boolean, nullable=False, default=False,
+        server_default=db.false())
     playlists = db.relationship('Playlist', backref='user', lazy='dynamic')
 
     @property
@@ -57,27 +67,72 @@ class User(db.Model, BaseModel):
 
     @password.setter
     def password(self, password):
-        self.pass_hash = generate_password_hash(password)
+        self.pass_hash = password_hasher.hash(password)
+        if self.id is not None:
+            user_cache.pop(self.id)
 
     def check_password(self, password):
         return check_password_hash(self.pass_hash, password)
 
+    @staticmethod
+    def get_cached(id):
+        """
+        Returns user by id, using user_cache to avoid hitting the database
+        on every authenticated request.
+        Only id and login are cached, other attributes are loaded
+        on access. Admin flag is never cached, so a demoted admin
+        loses access right away.
+        Cache is per process, so changes made by other workers are seen
+        only after cached entry expires.
+        """
+        cached = user_cache.get(id)
+        if cached is None:
+            user = User.query.get(id)
+            if user:
+                user_cache.set(id, {
+                    'id': user.id,
+                    'login': user.login
+                })
+            return user
+
+        user = User(**cached)
+        make_transient_to_detached(user)
+        # Attach to the current session without emitting any sql
+        return db.session.merge(user, load=False)
+
     def get_playlists(self):
         playlists = [p.to_dict() for p in self.playlists]
         return playlists
 
 
+@db.event.listens_for(User, 'after_delete')
+def invalidate_cached_user(mapper, connection, user):
+    user_cache.pop(user.id)
+
+
 class Song(db.Model, BaseModel):
     __tablename__ = 'song'
     id = db.Column('id', db.Integer, primary_key=True, nullable=False)
     title = db.Column('title', db.String(64), nullable=False)
     filepath = db.Column('filepath', db.String(128), nullable=False)
     duration = db.Column('duration', db.Integer)
+    # Average bitrate in bits per second
+    bitrate = db.Column('bitrate', db.Integer)
     album_position = db.Column('album_position', db.SmallInteger)
     listens_count = db.Column('listens_count', db.Integer, default=0)
     artist_id = db.Column(
         'artist_id', db.Integer, db.ForeignKey('artist.id'), nullable=False)
     album_id = db.Column('album_id', db.Integer, db.ForeignKey('album.id'))
+    # Set when the file is missing or corrupt, see utils.integrity
+    broken = db.Column(
+        'broken', db.Boolean, nullable=False, default=False,
+        server_default=db.false())
+    # Packed (milliseconds, byte offset) pairs, see utils.mp3index.
+    # Loaded only when accessed
+    seek_table = db.deferred(db.Column('seek_table', db.LargeBinary))
+    # Byte range of the preview clip
+    preview_start = db.Column('preview_start', db.BigInteger)
+    preview_end = db.Column('preview_end', db.BigInteger)
 
     @staticmethod
     def play_song(id):
@@ -99,11 +154,13 @@ class Song(db.Model, BaseModel):
 
         cover_small = None
         cover_medium = None
+        cover_hash = None
         artists = []
         if self.album:
             artists.extend([a.title for a in self.album.artists])
             cover_small = self.album.cover_small
             cover_medium = self.album.cover_medium
+            cover_hash = self.album.cover_hash
         else:
             artists.append(self.artist.title)
         album_title = self.album.title if self.album else 'unknown'
@@ -112,6 +169,7 @@ class Song(db.Model, BaseModel):
         d['album'] = album_title
         d['cover_small'] = cover_small
         d['cover_medium'] = cover_medium
+        d['cover_hash'] = cover_hash
 
         return d
 
@@ -165,6 +223,8 @@ class Album(db.Model, BaseModel):
     year = db.Column('year', db.SmallInteger)
     cover_small = db.Column('cover_small', db.String(256))
     cover_medium = db.Column('cover_medium', db.String(256))
+    # Cover image in the local cover store, see utils.covers
+    cover_hash = db.Column('cover_hash', db.String(64))
     songs = db.relationship(
         'Song',
         backref='album',
@@ -354,11 +414,74 @@ class PlaylistSong(db.Model, BaseModel):
     song_position = db.Column('song_position', db.Integer)
 
 
+class MediaFile(db.Model):
+    """
+    Manifest of audio files in the library.
+    Lets rescans skip files which haven't changed since the last scan.
+    """
+    __tablename__ = 'media_file'
+    path = db.Column('path', db.String(512), primary_key=True)
+    size = db.Column('size', db.BigInteger, nullable=False)
+    # Modification time in nanoseconds
+    mtime = db.Column('mtime', db.BigInteger, nullable=False)
+    checksum = db.Column('checksum', db.String(64), index=True)
+    # Needed up front by streamed zip archives, see utils.zipstream
+    crc32 = db.Column('crc32', db.BigInteger)
+    song_id = db.Column(
+        'song_id', db.Integer, db.ForeignKey('song.id'), index=True)
+
+
+class IngestJob(db.Model):
+    """
+    Import of files from a folder. Unfinished job is resumed
+    by the next import of the same folder.
+    """
+    __tablename__ = 'ingest_job'
+    id = db.Column('id', db.Integer, primary_key=True, nullable=False)
+    folder = db.Column('folder', db.String(512), nullable=False, index=True)
+    added_folder = db.Column('added_folder', db.String(512))
+    finished = db.Column(
+        'finished', db.Boolean, nullable=False, default=False)
+    created_date = db.Column(
+        'created_date', db.DateTime, default=datetime.utcnow)
+    finished_date = db.Column('finished_date', db.DateTime)
+    items = db.relationship('IngestItem', backref='job', lazy='dynamic')
+
+
+class IngestItem(db.Model):
+    """
+    File of an import job with the last stage it has passed.
+    Track parsed from the file is kept in data as json,
+    so resumed job doesn't have to parse or look it up again.
+    """
+    __tablename__ = 'ingest_item'
+    # Stages in order
+    PENDING = 'pending'
+    PARSED = 'parsed'
+    ENRICHED = 'enriched'
+    COMMITTED = 'committed'
+    MOVED = 'moved'
+    FAILED = 'failed'
+
+    id = db.Column('id', db.Integer, primary_key=True, nullable=False)
+    job_id = db.Column(
+        'job_id', db.Integer, db.ForeignKey('ingest_job.id'), nullable=False)
+    filepath = db.Column('filepath', db.String(512), nullable=False)
+    state = db.Column(
+        'state', db.String(16), nullable=False, default=PENDING)
+    data = db.Column('data', db.Text)
+    # Kept by items of finished jobs after their song is deleted
+    song_id = db.Column(
+        'song_id', db.Integer,
+        db.ForeignKey('song.id', ondelete='SET NULL'))
+    __table_args__ = (db.UniqueConstraint('job_id', 'filepath'),)
+
+
 class RefreshToken(db.Model):
     __tablename__ = 'refresh_token'
     token = db.Column('token', db.String(32), primary_key=True)
     expiration_date = db.Column(
-        'expiration_date', db.DateTime, default=datetime.utcnow)
+        'expiration_date', db.DateTime, default=datetime.utcnow, index=True)
     user_id = db.Column(
         'user_id', db.Integer, db.ForeignKey('app_user.id'),
         nullable=False, unique=True)
@@ -366,12 +489,14 @@ class RefreshToken(db.Model):
     @staticmethod
     def create_or_get(user_id, expires_in=timedelta(weeks=24)):
         # If already exists for this user
-        refresh_token = RefreshToken.query.join(User).filter_by(id=user_id).first()
+        refresh_token = RefreshToken.query.filter_by(user_id=user_id).first()
         if refresh_token:
-            return refresh_token.token
-            # raise RefreshTokenError('Refresh token is already given to this user')
-        return RefreshToken.create(user_id, expires_in) 
-
+            if datetime.utcnow() < refresh_token.expiration_date:
+                return refresh_token.token
+            # Expired token is replaced with a new one
+            db.session.delete(refresh_token)
+            db.session.flush()
+        return RefreshToken.create(user_id, expires_in)
 
     @staticmethod
     def create(user_id, expires_in=timedelta(weeks=24)):
@@ -395,10 +520,10 @@ class RefreshToken(db.Model):
 
     @staticmethod
     def valid_token(token):
-        refresh_token = RefreshToken.query.get(token)
-        if refresh_token and datetime.utcnow() < refresh_token.expiration_date:
-            return refresh_token
-        return None
+        return RefreshToken.query.filter(
+            RefreshToken.token == token,
+            RefreshToken.expiration_date > datetime.utcnow()
+        ).first()
 
     @staticmethod
     def revoke(token):
@@ -406,4 +531,69 @@ class RefreshToken(db.Model):
 
     @staticmethod
     def get_user(token):
-        User.query.join(RefreshToken).filter_by(token=token).first()
+        return User.query.join(RefreshToken).filter_by(token=token).first()
+
+    @staticmethod
+    def delete_expired(batch_size=1000):
+        """
+        Deletes expired tokens in chunks of batch_size,
+        committing after every chunk to keep transactions short.
+        Returns number of deleted tokens.
+        """
+        deleted = 0
+        now = datetime.utcnow()
+        while True:
+            expired = db.session.query(RefreshToken.token)\
+                .filter(RefreshToken.expiration_date <= now)\
+                .limit(batch_size).all()
+            if not expired:
+                break
+            RefreshToken.query\
+                .filter(RefreshToken.token.in_([t for t, in expired]))\
+                .delete(synchronize_session=False)
+            db.session.commit()
+            deleted += len(expired)
+        return deleted
+
+
+class RevokedToken(db.Model):
+    """
+    Access token revoked before it has expired, by its jti claim.
+    Shared by all workers, rows are deleted by the token sweeper
+    once their tokens have expired.
+    """
+    __tablename__ = 'revoked_token'
+    jti = db.Column('jti', db.String(64), primary_key=True)
+    expiration_date = db.Column(
+        'expiration_date', db.DateTime, nullable=False, index=True)
+
+    @staticmethod
+    def revoke(jti, expiration_date):
+        db.session.merge(
+            RevokedToken(jti=jti, expiration_date=expiration_date))
+
+    @staticmethod
+    def is_revoked(jti):
+        return db.session.query(RevokedToken.jti)\
+            .filter_by(jti=jti).first() is not None
+
+    @staticmethod
+    def delete_expired(batch_size=1000):
+        """
+        Deletes entries of expired tokens in chunks of batch_size.
+        Returns number of deleted entries.
+        """
+        deleted = 0
+        now = datetime.utcnow()
+        while True:
+            expired = db.session.query(RevokedToken.jti)\
+                .filter(RevokedToken.expiration_date <= now)\
+                .limit(batch_size).all()
+            if not expired:
+                break
+            RevokedToken.query\
+                .filter(RevokedToken.jti.in_([j for j, in expired]))\
+                .delete(synchronize_session=False)
+            db.session.commit()
+            deleted += len(expired)
+        return deleted
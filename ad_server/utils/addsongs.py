@@ -1,134 +1,482 @@
 import os
-import shutil
 import re
+import zlib
+import hashlib
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from queue import Queue, Empty
+from requests import RequestException
 from mutagen.mp3 import EasyMP3
-from ad_server.config import Config
-from ad_server.models import (
-    Song,
-    Artist,
-    Album,
-    Genre
-)
-from ad_server.utils.lastfm_api import search_on_lastfm
+from ad_server.config import ScriptConfig
+from ad_server.utils import mp3index
+from ad_server.utils.lastfm_api import get_client
+from ad_server.utils.ingest import IngestionSession
+from ad_server.utils.jobs import JobProgress
+from ad_server.utils.covers import CoverStore, embedded_cover, get_cover_store
+from ad_server.utils.storage import get_media_storage
+from ad_server.models import IngestItem
 from ad_server import db, create_app
 from flask import current_app
 
 
 reg = re.compile(r'\s*([\s\w\d\-&\.\']*[\w\d])\s*[/,;\\]?')
 
+# Marks the end of items in a queue between pipeline stages
+STOP = None
 
-def add_songs_to_db(target_folder, db):
 
-    mediastorage = current_app.config.get('MEDIA_STORAGE')
-    if not mediastorage:
-        raise ValueError('DATA_LOCATION must be set in app config')
+def file_checksum(filepath, chunk_size=1024 * 1024):
+    """
+    Returns sha256 hex digest of file content.
+    """
+    return file_digests(filepath, chunk_size)[0]
+
 
-    added_folder = os.path.join(mediastorage, 'added')
+def file_digests(filepath, chunk_size=1024 * 1024):
+    """
+    Returns tuple (sha256 hex digest, crc32) of file content,
+    reading the file once.
+    """
+    digest = hashlib.sha256()
+    crc = 0
+    with open(filepath, 'rb') as f:
+        chunk = f.read(chunk_size)
+        while chunk:
+            digest.update(chunk)
+            crc = zlib.crc32(chunk, crc)
+            chunk = f.read(chunk_size)
+    return digest.hexdigest(), crc
 
-    for f in os.listdir(target_folder):
 
-        if not os.path.isfile(os.path.join(target_folder, f)):
+def list_mp3_files(folder):
+    files = []
+    for f in os.listdir(folder):
+
+        if not os.path.isfile(os.path.join(folder, f)):
             continue
         elif os.path.splitext(f)[1] != '.mp3':
             continue
 
-        filepath = os.path.abspath(os.path.join(target_folder, f))
+        files.append(os.path.abspath(os.path.join(folder, f)))
+    return files
 
-        songfile = EasyMP3(filepath)
 
-        title = songfile.tags.get('title') and \
-            songfile.tags.get('title')[0]
-        track_number = songfile.tags.get('tracknumber') and \
-            int(songfile.tags.get('tracknumber')[0].split('/')[0])
-        duration = songfile.info.length
-        genres_titles = songfile.tags.get('genre') and \
-            reg.findall(songfile.tags.get('genre')[0])
-        artists_titles = songfile.tags.get('artist') and \
-            reg.findall(songfile.tags.get('artist')[0])
+def parse_song_file(filepath, cover_folder=None):
+    """
+    Reads tags of a single mp3 file.
+    Runs in a worker process, so it returns plain dict.
+    Returns None if file lacks title or artist.
+    If cover_folder is given, embedded cover is put into
+    the cover store there.
+    """
+    stat = os.stat(filepath)
+    songfile = EasyMP3(filepath)
 
-        if not title or not artists_titles or len(artists_titles) == 0:
-            continue
+    title = songfile.tags.get('title') and \
+        songfile.tags.get('title')[0]
+    track_number = songfile.tags.get('tracknumber') and \
+        int(songfile.tags.get('tracknumber')[0].split('/')[0])
+    duration = songfile.info.length
+    genres_titles = songfile.tags.get('genre') and \
+        reg.findall(songfile.tags.get('genre')[0])
+    artists_titles = songfile.tags.get('artist') and \
+        reg.findall(songfile.tags.get('artist')[0])
+    album_title = songfile.tags.get('album') and \
+        songfile.tags.get('album')[0]
 
-        artists = []
+    if not title or not artists_titles or len(artists_titles) == 0:
+        return None
+
+    cover_hash = None
+    if cover_folder:
+        try:
+            cover_hash = CoverStore(cover_folder).put(embedded_cover(filepath))
+        except OSError as e:
+            print(f'Failed to store cover of {filepath}: {e!r}')
 
-        for artist_title in artists_titles:
-            artist = Artist.query.filter_by(title=artist_title).first()
-            if not artist:
-                artist = Artist(title=artist_title)
-                db.session.add(artist)
-            artists.append(artist)
+    index = mp3index.file_index(filepath)
+    checksum, crc32 = file_digests(filepath)
+    return {
+        'filepath': filepath,
+        'title': title,
+        'track_number': track_number,
+        'duration': duration,
+        'bitrate': songfile.info.bitrate,
+        'genres': genres_titles or [],
+        'artists': artists_titles,
+        'album': album_title,
+        'cover_small': None,
+        'cover_medium': None,
+        'cover_hash': cover_hash,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+        'checksum': checksum,
+        'crc32': crc32,
+        'seek_table': mp3index.encode(index['seek_table']),
+        'preview_start': index['preview_start'],
+        'preview_end': index['preview_end'],
+    }
 
-        album_title = songfile.tags.get('album') and \
-            songfile.tags.get('album')[0]
 
+def parse_stage(files, workers, parsed, on_parsed=None, cover_folder=None):
+    """
+    Parses files in a pool of worker processes and puts results
+    into parsed queue in the same order.
+    No more than 2 * workers files are being parsed at once,
+    the rest waits for the queue to free up.
+    on_parsed is called with every track before it is put in the queue.
+    """
+    def put(filepath, result):
         try:
-            # Try get album title from song data
-            if not album_title:
-                track_info = search_on_lastfm(
-                    searchfor='track', track=title, artist=artists_titles[0]
-                    )
-                album_title = track_info['album']['title']
-
-            album = Album.query.filter_by(title=album_title)\
-                .join(Album.artists).filter_by(title=artist_title).first()
-
-            # If album is not in database
-            if not album:
-                album_info = search_on_lastfm(
-                    searchfor='album',
-                    album=album_title,
-                    artist=artists_titles[0]
-                    )
+            track = result()
+        except Exception as e:
+            print(f'Failed to read {filepath}: {e!r}')
+            return
+        if track:
+            if on_parsed:
+                on_parsed(track)
+            parsed.put(track)
+
+    if not workers:
+        for filepath in files:
+            put(filepath, lambda: parse_song_file(filepath, cover_folder))
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for filepath in files:
+            pending.append(
+                (filepath,
+                 pool.submit(parse_song_file, filepath, cover_folder)))
+            if len(pending) >= workers * 2:
+                filepath, future = pending.popleft()
+                put(filepath, future.result)
+        while pending:
+            filepath, future = pending.popleft()
+            put(filepath, future.result)
+
+
+class AlbumLookup:
+    """
+    Looks up album titles and covers on last.fm for batches of tracks.
+    Every album is looked up only once per import,
+    albums already present in database are not looked up at all.
+    Covers of albums whose tracks have no embedded cover are downloaded
+    into the cover store, if it is given.
+    """
+
+    def __init__(self, client, known_albums, cover_store=None):
+        self.client = client
+        self.known_albums = known_albums
+        self.cover_store = cover_store
+        self.albums = {}
+        # (album title, artist title): cover hash
+        self.covers = {}
+
+    def __call__(self, tracks):
+        # Try get album title from song data
+        untitled = [t for t in tracks if not t['album']]
+        results = self.client.search_many([
+            ('track', {'track': t['title'], 'artist': t['artists'][0]})
+            for t in untitled
+        ])
+        for track, track_info in zip(untitled, results):
+            try:
+                if isinstance(track_info, Exception):
+                    raise track_info
+                track['album'] = track_info['album']['title']
+            except (ConnectionError, RequestException,
+                    KeyError, TypeError, AttributeError) as e:
+                # Song is added to an unknown album
+                print(repr(e))
+
+        keys = []
+        for track in tracks:
+            key = (track['album'], track['artists'][0])
+            if track['album'] and key not in self.known_albums and \
+               key not in self.albums and key not in keys:
+                keys.append(key)
+
+        results = self.client.search_many([
+            ('album', {'album': album, 'artist': artist})
+            for album, artist in keys
+        ])
+        for key, album_info in zip(keys, results):
+            try:
+                if isinstance(album_info, Exception):
+                    raise album_info
                 # Changed this line to get bigger cover sizes
-                cover_small = album_info.get('image')[2].get('#text')
-                cover_medium = album_info.get('image')[3].get('#text')
-                album = Album(
-                    title=album_title,
-                    cover_small=cover_small,
-                    cover_medium=cover_medium)
-        except ConnectionError as e:
-            print(repr(e))
-            album = Album(title='unknown')
-
-        album.artists.extend(
-            [a for a in artists if a not in album.artists]
-        )
-
-        db.session.add(album)
-
-        if album and genres_titles:
-            genres = []
-            for genre_title in genres_titles:
-                genre = Genre.query.filter_by(title=genre_title).first()
-                if not genre:
-                    genre = Genre(title=genre_title)
-                    db.session.add(genre)
-                genres.append(genre)
-            album.genres.extend([g for g in genres if g not in album.genres])
-
-        if len(artists) == 1:
-            single_artist = artists[0]
-
-        new_filepath = os.path.join(added_folder, f)
-
-        song = Song(
-            title=title,
-            filepath=new_filepath,
-            duration=duration,
-            album_position=track_number,
-            artist=single_artist,
-            album=album)
-
-        db.session.add(song)
-        db.session.commit()
-
-        if not os.path.exists(added_folder):
-            os.mkdir(added_folder)
-        shutil.move(filepath, new_filepath)
+                self.albums[key] = (
+                    album_info.get('image')[2].get('#text'),
+                    album_info.get('image')[3].get('#text')
+                )
+            except (ConnectionError, RequestException,
+                    KeyError, IndexError, TypeError, AttributeError) as e:
+                # Album is added without covers, search results
+                # are None when last.fm has found nothing
+                print(repr(e))
+                self.albums[key] = (None, None)
+
+        if self.cover_store:
+            self.download_covers(keys, tracks)
+
+        for track in tracks:
+            key = (track['album'], track['artists'][0])
+            track['cover_small'], track['cover_medium'] = \
+                self.albums.get(key, (None, None))
+            if not track.get('cover_hash'):
+                track['cover_hash'] = self.covers.get(key)
+        return tracks
+
+    def download_covers(self, keys, tracks):
+        embedded = {
+            (t['album'], t['artists'][0])
+            for t in tracks if t.get('cover_hash')
+        }
+        urls = [
+            (key, self.albums[key][1]) for key in keys
+            if key not in embedded and self.albums[key][1]
+        ]
+
+        def download(url):
+            try:
+                return self.cover_store.put(self.client.download(url))
+            except (ConnectionError, OSError) as e:
+                print(f'Failed to download cover {url}: {e!r}')
+                return None
+
+        if not urls:
+            return
+        with ThreadPoolExecutor(self.client.max_concurrency) as pool:
+            hashes = pool.map(download, [url for _, url in urls])
+            for (key, _), cover_hash in zip(urls, hashes):
+                self.covers[key] = cover_hash
+
+
+def lookup_stage(lookup, parsed, enriched, batch_size, failed):
+    """
+    Takes parsed tracks in batches of up to batch_size,
+    so last.fm requests for a batch are made concurrently.
+    Tracks of a batch whose lookup has raised are put into failed
+    with the exception, the end mark is put even if the stage dies,
+    so the write stage never waits for it forever.
+    """
+    try:
+        done = False
+        while not done:
+            batch = [parsed.get()]
+            while len(batch) < batch_size:
+                try:
+                    batch.append(parsed.get_nowait())
+                except Empty:
+                    break
+            # End mark is always the last item put in the queue
+            if batch[-1] is STOP:
+                batch.pop()
+                done = True
+            try:
+                tracks = lookup(batch)
+            except Exception as e:
+                failed.extend((track, e) for track in batch)
+                continue
+            for track in tracks:
+                enriched.put(track)
+    finally:
+        enriched.put(STOP)
+
+
+def move_files(tracks, storage):
+    for track in tracks:
+        try:
+            # Files moved before an interrupted import could record it
+            # and duplicates are handled by the storage
+            storage.store(track['filepath'], track['target'])
+        except OSError as e:
+            print(f'Failed to move {track["filepath"]}: {e!r}')
+
+
+def import_files(files, db, storage=None, song_ids=None, workers=None,
+                 batch_size=100, queue_size=64, progress=None):
+    """
+    Adds mp3 files to the database.
+
+    Import is a pipeline of three stages connected with bounded queues:
+    tags are parsed by a pool of worker processes, metadata is looked up
+    on last.fm in batches by a lookup thread and everything is written
+    to the database by the calling thread, committing every batch_size
+    songs.
+
+    :param storage: storage.MediaStorage where files are moved after they
+    are committed. Songs refer to them by storage keys. If None, files
+    stay where they are and songs refer to them by absolute paths.
+    :param song_ids: dict filepath: song id for files which already belong
+    to songs. Those songs are updated instead of adding new ones.
+    :param workers: number of tag parsing processes, defaults to cpu count.
+    0 parses files in a thread of the current process.
+    :param progress: jobs.JobProgress of the import job files belong to.
+    Every file is checkpointed as it passes a stage and files which have
+    passed some stages in an interrupted run continue from the next one.
+    :return: tuple (list of committed tracks, list of failed tracks with
+    exceptions)
+    """
+    song_ids = song_ids or {}
+
+    parsed_before = []
+    enriched_before = []
+    committed_before = []
+    if progress:
+        parsed_before = progress.tracks(IngestItem.PARSED)
+        enriched_before = progress.tracks(IngestItem.ENRICHED)
+        committed_before = progress.tracks(IngestItem.COMMITTED)
+        files = [f for f in files if progress.state(f) == IngestItem.PENDING]
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(files))
+
+    ingest = IngestionSession(db, batch_size, progress)
+    ingest.preload()
+
+    client = get_client()
+    cover_store = get_cover_store()
+    lookup = AlbumLookup(client, ingest.albums, cover_store)
+
+    parsed = Queue(maxsize=queue_size)
+    enriched = Queue(maxsize=queue_size)
+
+    def parse():
+        try:
+            for track in parsed_before:
+                parsed.put(track)
+            parse_stage(
+                files, workers, parsed, progress and progress.parsed,
+                cover_store.folder)
+        finally:
+            parsed.put(STOP)
+
+    threads = [
+        threading.Thread(target=parse, daemon=True),
+        threading.Thread(
+            target=lookup_stage,
+            args=(lookup, parsed, enriched, client.max_concurrency * 4,
+                  ingest.failed),
+            daemon=True)
+    ]
+    for t in threads:
+        t.start()
+
+    done = []
+
+    def committed(tracks):
+        if storage:
+            move_files(tracks, storage)
+        if progress:
+            for track in tracks:
+                progress.record(IngestItem.MOVED, track)
+        done.extend(tracks)
+
+    def write(track):
+        if storage:
+            track['target'] = storage.key(track['checksum'])
+        else:
+            track['target'] = track['filepath']
+        track['song_id'] = song_ids.get(track['filepath'])
+        committed(ingest.add(track))
+
+    # Songs committed by an interrupted run only need their files moved
+    committed(committed_before)
+    for track in enriched_before:
+        write(track)
+
+    # Write stage. With a job, checkpoints are saved while waiting
+    # for slow lookups too.
+    while True:
+        try:
+            track = enriched.get(timeout=1 if progress else None)
+        except Empty:
+            progress.save()
+            continue
+        if track is STOP:
+            break
+        if progress:
+            progress.record(IngestItem.ENRICHED, track)
+        write(track)
+    committed(ingest.flush())
+
+    for track, e in ingest.failed:
+        print(f'Failed to add {track["filepath"]}: {e!r}')
+        if progress:
+            progress.record(IngestItem.FAILED, track)
+    if progress:
+        progress.finish()
+
+    for t in threads:
+        t.join()
+
+    return done, ingest.failed
+
+
+def add_songs_to_db(target_folder, db, workers=None, batch_size=100,
+                    resume=True, files=None, storage=None):
+    """
+    Adds all mp3 files from target_folder to the database
+    and moves them into the media storage.
+    Import is run as a job which continues the last unfinished import
+    of target_folder, unless resume is False.
+
+    :param files: files of target_folder to add instead of all of them.
+    Files left over by an interrupted job are added as well.
+    :param storage: storage.MediaStorage to move files to, defaults
+    to the app media storage.
+    """
+
+    mediastorage = current_app.config.get('MEDIA_STORAGE')
+    if not mediastorage:
+        raise ValueError('DATA_LOCATION must be set in app config')
+
+    if storage is None:
+        storage = get_media_storage()
+    if files is None:
+        files = list_mp3_files(target_folder)
+
+    progress = JobProgress.start(
+        db, target_folder, files,
+        added_folder=storage.root, resume=resume)
+
+    return import_files(
+        progress.filepaths(),
+        db,
+        storage=storage,
+        workers=workers,
+        batch_size=batch_size,
+        progress=progress)
 
 
 if __name__ == '__main__':
-    app = create_app(Config)
+    parser = argparse.ArgumentParser(
+        description='Adds mp3 files from a folder to the database')
+    parser.add_argument(
+        'folder', nargs='?',
+        help='folder with mp3 files, defaults to MEDIA_STORAGE')
+    parser.add_argument(
+        '--workers', type=int, default=None,
+        help='number of processes parsing tags, defaults to cpu count')
+    parser.add_argument(
+        '--batch-size', type=int, default=100,
+        help='number of songs written in one transaction')
+    parser.add_argument(
+        '--new-job', action='store_true',
+        help='start a new import instead of resuming an unfinished one')
+    args = parser.parse_args()
+
+    app = create_app(ScriptConfig)
     with app.app_context():
-        target_folder = app.config.get('MEDIA_STORAGE')
-        add_songs_to_db(target_folder, db=db)
+        target_folder = args.folder or app.config.get('MEDIA_STORAGE')
+        add_songs_to_db(
+            target_folder,
+            db=db,
+            workers=args.workers,
+            batch_size=args.batch_size,
+            resume=not args.new_job)
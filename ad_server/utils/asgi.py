@@ -0,0 +1,179 @@
+import sys
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+from ad_server.utils.streaming import FileStream
+
+
+# Request bodies over this size are spooled to a temporary file
+BODY_MEMORY_SIZE = 1024 * 1024
+
+
+def wsgi_environ(scope, body):
+    """
+    Returns WSGI environ of an ASGI http request scope,
+    body is a file with the request body.
+    """
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    root_path = scope.get('root_path', '')
+    path = scope['path']
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path.encode().decode('latin-1'),
+        'PATH_INFO': path.encode().decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': f'HTTP/{scope.get("http_version", "1.1")}',
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = f'HTTP_{name}'
+        if name in environ:
+            value = f'{environ[name]},{value}'
+        environ[name] = value
+    return environ
+
+
+class AsyncApp:
+    """
+    ASGI application serving the Flask app, so streams don't hold
+    a thread while they are being sent.
+
+    Requests are handled by the Flask app in a thread pool as usual,
+    with the same views, models and auth. Response body is then pulled
+    from the WSGI iterable a chunk at a time in the pool and sent
+    from the event loop. Slow clients and paced FileStreams are waited
+    for in the loop, so the number of concurrent streams is limited
+    by memory and sockets rather than by the number of threads.
+
+    Run it with any ASGI server, e.g. `uvicorn asgi:app`.
+    """
+
+    def __init__(self, app, workers=None):
+        self.app = app
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers or app.config.get('ASYNC_WORKERS'),
+            thread_name_prefix='asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            await self.http(scope, receive, send)
+        elif scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+
+    async def run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, receive, send):
+        body = await self.read_body(receive)
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [
+                (name.lower().encode('latin-1'), value.encode('latin-1'))
+                for name, value in headers]
+            return written.append
+
+        written = []
+        try:
+            iterable = await self.run(
+                self.app, wsgi_environ(scope, body), start_response)
+        finally:
+            body.close()
+
+        disconnect = asyncio.ensure_future(self.wait_disconnect(receive))
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': response['status'],
+                'headers': response['headers'],
+            })
+            for chunk in written:
+                await self.send_body(send, chunk)
+            await self.send_iterable(send, iterable, disconnect)
+            if not disconnect.done():
+                await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            disconnect.cancel()
+            close = getattr(iterable, 'close', None)
+            if close:
+                await self.run(close)
+
+    async def send_iterable(self, send, iterable, disconnect):
+        """
+        Sends body from WSGI iterable until it ends
+        or the client disconnects.
+        """
+        pacer = None
+        if isinstance(iterable, (list, tuple)):
+            for chunk in iterable:
+                await self.send_body(send, chunk)
+            return
+        elif isinstance(iterable, FileStream):
+            chunks, pacer = iterable.chunks, iterable.pacer
+        else:
+            chunks = iter(iterable)
+
+        while not disconnect.done():
+            # Files are read in the pool, one chunk at a time
+            chunk = await self.run(next, chunks, None)
+            if chunk is None:
+                return
+            if pacer:
+                delay = pacer.delay(len(chunk))
+                if delay:
+                    await asyncio.sleep(delay)
+            await self.send_body(send, chunk)
+
+    @staticmethod
+    async def send_body(send, chunk):
+        if chunk:
+            await send({
+                'type': 'http.response.body',
+                'body': chunk,
+                'more_body': True,
+            })
+
+    @staticmethod
+    async def read_body(receive):
+        body = SpooledTemporaryFile(max_size=BODY_MEMORY_SIZE)
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] != 'http.request':
+                break
+            body.write(message.get('body', b''))
+            more_body = message.get('more_body', False)
+        body.seek(0)
+        return body
+
+    @staticmethod
+    async def wait_disconnect(receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
@@ -0,0 +1,173 @@
+import os
+import io
+import hashlib
+import tempfile
+import argparse
+from mutagen.id3 import ID3, ID3NoHeaderError
+from flask import current_app
+from PIL import Image
+from ad_server.config import ScriptConfig
+
+
+# Longer side of size variants in pixels
+SIZES = {
+    'small': 174,
+    'medium': 300,
+}
+
+# Front cover picture type in APIC frames
+FRONT_COVER = 3
+
+
+def image_type(data):
+    """
+    Returns mimetype of image data or None if it's not an image.
+    """
+    if data[:3] == b'\xff\xd8\xff':
+        return 'image/jpeg'
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'image/png'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+
+class CoverStore:
+    """
+    Cover images kept in a folder under their sha256 hash.
+    Files are sharded by the first two characters of the hash:
+    <folder>/ab/abcdef... for originals and
+    <folder>/ab/abcdef..._<size> for size variants.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def path(self, cover_hash, size=None):
+        """
+        Returns path of the cover or of its size variant
+        if there is one. Returns None if there is no such cover.
+        """
+        if len(cover_hash) != 64 or \
+           not all(c in '0123456789abcdef' for c in cover_hash):
+            return None
+        original = os.path.join(self.folder, cover_hash[:2], cover_hash)
+        if size in SIZES:
+            variant = f'{original}_{size}'
+            if os.path.exists(variant):
+                return variant
+        return original if os.path.exists(original) else None
+
+    def put(self, data):
+        """
+        Stores image data once and returns its hash.
+        Returns None if data is not an image.
+        """
+        if not data or not image_type(data):
+            return None
+        cover_hash = hashlib.sha256(data).hexdigest()
+        folder = os.path.join(self.folder, cover_hash[:2])
+        original = os.path.join(folder, cover_hash)
+        if os.path.exists(original):
+            return cover_hash
+
+        os.makedirs(folder, exist_ok=True)
+        self._write(original, data)
+        self._make_variants(original, data)
+        return cover_hash
+
+    @staticmethod
+    def _write(path, data):
+        # Readers never see partially written file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _make_variants(self, original, data):
+        try:
+            image = Image.open(io.BytesIO(data))
+            image.load()
+        except (OSError, ValueError):
+            return
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        for size, pixels in SIZES.items():
+            if max(image.size) <= pixels:
+                continue
+            variant = image.copy()
+            variant.thumbnail((pixels, pixels))
+            buffer = io.BytesIO()
+            variant.save(buffer, 'JPEG', quality=85)
+            self._write(f'{original}_{size}', buffer.getvalue())
+
+
+def get_cover_store():
+    config = current_app.config
+    return CoverStore(
+        config.get('COVER_STORAGE') or
+        os.path.join(config.get('MEDIA_STORAGE'), 'covers'))
+
+
+def embedded_cover(filepath):
+    """
+    Returns image data of the front cover embedded in mp3 tags,
+    or of any other embedded picture if there is no front cover.
+    """
+    try:
+        pictures = ID3(filepath).getall('APIC')
+    except ID3NoHeaderError:
+        return None
+    if not pictures:
+        return None
+    pictures.sort(key=lambda p: p.type != FRONT_COVER)
+    return pictures[0].data
+
+
+def backfill_covers(db, client, store, storage):
+    """
+    Stores covers of albums which have none yet, taking embedded
+    pictures from album songs or downloading last.fm images.
+    Returns number of albums which got a cover.
+    """
+    from ad_server.models import Album
+
+    found = 0
+    for album in Album.query.filter(Album.cover_hash.is_(None)):
+        cover_hash = None
+        for song in album.songs:
+            try:
+                cover_hash = store.put(
+                    embedded_cover(storage.path(song.filepath)))
+            except OSError:
+                continue
+            if cover_hash:
+                break
+        if not cover_hash and album.cover_medium:
+            try:
+                cover_hash = store.put(client.download(album.cover_medium))
+            except (ConnectionError, OSError) as e:
+                print(f'Failed to download cover of {album.title}: {e!r}')
+        if cover_hash:
+            album.cover_hash = cover_hash
+            found += 1
+            db.session.commit()
+    return found
+
+
+if __name__ == '__main__':
+    from ad_server import db, create_app
+    from ad_server.utils.lastfm_api import get_client
+    from ad_server.utils.storage import get_media_storage
+
+    parser = argparse.ArgumentParser(
+        description='Stores covers of albums which have no local cover')
+    parser.parse_args()
+
+    app = create_app(ScriptConfig)
+    with app.app_context():
+        found = backfill_covers(
+            db, get_client(), get_cover_store(), get_media_storage())
+        print(f'Covers stored: {found}')
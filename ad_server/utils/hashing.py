@@ -0,0 +1,84 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from werkzeug.security import (
+    generate_password_hash,
+    check_password_hash,
+    DEFAULT_PBKDF2_ITERATIONS
+)
+from ad_server.views.error import HasherBusyError
+
+
+class PasswordHasher:
+    """
+    Verifies passwords in a dedicated thread pool of limited size,
+    so a burst of logins can't occupy all request workers.
+    Checks which don't fit into the pool and its queue are rejected
+    right away with HasherBusyError.
+    Hashes made with an outdated method are recomputed on successful check.
+    """
+
+    def __init__(self, app=None):
+        self.method = 'pbkdf2:sha256'
+        self.timeout = None
+        self.executor = None
+        self.slots = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PASSWORD_HASH_METHOD', 'pbkdf2:sha256')
+        app.config.setdefault('PASSWORD_HASH_WORKERS', 2)
+        app.config.setdefault('PASSWORD_HASH_QUEUE', 8)
+        app.config.setdefault('PASSWORD_HASH_TIMEOUT', 5)
+
+        self.method = app.config['PASSWORD_HASH_METHOD']
+        self.timeout = app.config['PASSWORD_HASH_TIMEOUT']
+
+        workers = app.config['PASSWORD_HASH_WORKERS']
+        if self.executor:
+            self.executor.shutdown(wait=False)
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='password-hasher')
+        # Checks running in the pool plus checks waiting in its queue
+        self.slots = threading.BoundedSemaphore(
+            workers + app.config['PASSWORD_HASH_QUEUE'])
+
+    def hash(self, password):
+        return generate_password_hash(password, method=self.method)
+
+    def needs_rehash(self, pass_hash):
+        method = self.method
+        # Werkzeug stores iterations count even if method doesn't specify it
+        if method.startswith('pbkdf2:') and method.count(':') == 1:
+            method = f'{method}:{DEFAULT_PBKDF2_ITERATIONS}'
+        return pass_hash.split('$', 1)[0] != method
+
+    def verify(self, pass_hash, password):
+        """
+        Checks password against the hash in the pool.
+        Returns tuple (is_valid, new_hash). new_hash is not None only
+        if password is valid and hash has to be updated.
+        """
+        if self.executor is None:
+            return self._verify(pass_hash, password)
+
+        if not self.slots.acquire(blocking=False):
+            raise HasherBusyError('Too many password checks in progress')
+        try:
+            future = self.executor.submit(self._verify, pass_hash, password)
+        except RuntimeError:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda f: self.slots.release())
+
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise HasherBusyError('Password check has timed out')
+
+    def _verify(self, pass_hash, password):
+        if not check_password_hash(pass_hash, password):
+            return False, None
+        if self.needs_rehash(pass_hash):
+            return True, self.hash(password)
+        return True, None
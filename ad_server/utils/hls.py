@@ -0,0 +1,82 @@
+import math
+import struct
+from ad_server.utils import mp3index
+
+
+PLAYLIST_MIMETYPE = 'application/vnd.apple.mpegurl'
+
+# Owner of the ID3 PRIV frame with timestamp of a packed audio segment
+TIMESTAMP_OWNER = b'com.apple.streaming.transportStreamTimestamp\x00'
+
+
+def segments(packed_table, duration_ms, file_size, segment_ms, read=None):
+    """
+    Splits a song into segments of about segment_ms each.
+    Segments start at frames from the seek table, so tags at the start
+    of the file are left out. Without a seek table the whole file
+    is a single segment.
+
+    End of the song is the last seek table entry plus duration of
+    the frames after it, which are read with read(offset, size).
+    Song duration in whole seconds is used only without a table.
+
+    :return: list of (start ms, duration ms, start offset, end offset)
+    """
+    starts = []
+    last = None
+    for ms, offset in mp3index.unpack(packed_table or b''):
+        if offset >= file_size:
+            break
+        last = (ms, offset)
+        if not starts or ms >= starts[-1][0] + segment_ms:
+            starts.append((ms, offset))
+    if not starts:
+        starts = [(0, 0)]
+
+    end_ms = duration_ms
+    if last and read:
+        last_ms, last_offset = last
+        end_ms = last_ms + mp3index.frames_duration(
+            read(last_offset, file_size - last_offset))
+
+    result = []
+    for (ms, offset), (next_ms, next_offset) in zip(starts, starts[1:]):
+        result.append((ms, next_ms - ms, offset, next_offset))
+    ms, offset = starts[-1]
+    result.append((ms, max(end_ms - ms, 0), offset, file_size))
+    return result
+
+
+def playlist(segment_list, segment_url):
+    """
+    Returns m3u8 media playlist of a whole song.
+    segment_url is called with segment number.
+    """
+    target = max(math.ceil(d / 1000) for _, d, _, _ in segment_list)
+    lines = [
+        '#EXTM3U',
+        '#EXT-X-VERSION:3',
+        f'#EXT-X-TARGETDURATION:{max(target, 1)}',
+        '#EXT-X-MEDIA-SEQUENCE:0',
+        '#EXT-X-PLAYLIST-TYPE:VOD',
+    ]
+    for n, (_, duration, _, _) in enumerate(segment_list):
+        lines.append(f'#EXTINF:{duration / 1000:.3f},')
+        lines.append(segment_url(n))
+    lines.append('#EXT-X-ENDLIST')
+    return '\n'.join(lines) + '\n'
+
+
+def syncsafe(n):
+    return bytes((n >> shift) & 0x7f for shift in (21, 14, 7, 0))
+
+
+def timestamp_tag(ms):
+    """
+    Returns ID3 tag with start time of a packed audio segment,
+    HLS clients place the segment on the timeline by it.
+    """
+    # 33 bit timestamp of the 90 kHz mpeg clock
+    data = TIMESTAMP_OWNER + struct.pack('>Q', ms * 90 % (1 << 33))
+    frame = b'PRIV' + syncsafe(len(data)) + b'\x00\x00' + data
+    return b'ID3\x04\x00\x00' + syncsafe(len(frame)) + frame
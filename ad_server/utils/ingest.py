@@ -0,0 +1,260 @@
+from sqlalchemy.exc import SQLAlchemyError
+from ad_server.utils import mp3index
+from ad_server.models import (
+    Song,
+    Artist,
+    Album,
+    AlbumArtist,
+    AlbumGenre,
+    Genre,
+    MediaFile
+)
+
+
+def insert_ignore(session, model, rows, index_elements):
+    """
+    Inserts rows skipping those which conflict on index_elements
+    with INSERT ... ON CONFLICT DO NOTHING.
+    """
+    if not rows:
+        return
+    dialect = session.bind.dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        # No upsert support, rows are known to be new from the maps
+        session.execute(model.__table__.insert(), rows)
+        return
+    statement = insert(model.__table__).on_conflict_do_nothing(
+        index_elements=index_elements)
+    session.execute(statement, rows)
+
+
+class IngestionSession:
+    """
+    Writes imported songs to the database in batches.
+
+    Artists, genres and albums are loaded into memory once, so tracks
+    don't have to query them. New artists and genres of a batch
+    are inserted with a single upsert each, every song is written
+    in its own savepoint, so a bad track doesn't abort the whole batch,
+    and everything is committed once per batch.
+
+    Tracks are dicts made by the importer, see addsongs.parse_song_file.
+    Path of the song file in the storage is taken from track['target'].
+    If track['song_id'] is set, that song is updated instead of adding
+    a new one. Track whose target already belongs to a song is not
+    written, it gets song_id of that song and duplicate flag.
+
+    If progress of an import job (jobs.JobProgress) is given, its
+    checkpoints are saved before every batch and files are marked
+    committed together with their songs.
+    """
+
+    def __init__(self, db, batch_size=100, progress=None):
+        self.db = db
+        self.batch_size = batch_size
+        self.progress = progress
+        # title: id
+        self.artists = {}
+        self.genres = {}
+        # (album title, artist title): album id
+        self.albums = {}
+        # (album id, artist id) and (album id, genre id) pairs
+        self.album_artists = set()
+        self.album_genres = set()
+        # ids of albums which have local cover
+        self.album_covers = set()
+        self.pending = []
+        self.failed = []
+
+    def preload(self):
+        session = self.db.session
+        self.artists = dict(session.query(Artist.title, Artist.id))
+        self.genres = dict(session.query(Genre.title, Genre.id))
+        artist_titles = {id: title for title, id in self.artists.items()}
+        self.albums = {}
+        self.album_artists = set()
+        for album_id, title, artist_id in session.query(
+                Album.id, Album.title, AlbumArtist.artist_id)\
+                .join(AlbumArtist, AlbumArtist.album_id == Album.id):
+            self.albums[(title, artist_titles[artist_id])] = album_id
+            self.album_artists.add((album_id, artist_id))
+        self.album_genres = set(
+            session.query(AlbumGenre.album_id, AlbumGenre.genre_id))
+        self.album_covers = {
+            id for id, in session.query(Album.id)
+            .filter(Album.cover_hash.isnot(None))
+        }
+
+    def add(self, track):
+        """
+        Queues track for writing.
+        Returns list of committed tracks if the batch has been flushed.
+        """
+        self.pending.append(track)
+        if len(self.pending) >= self.batch_size:
+            return self.flush()
+        return []
+
+    def flush(self):
+        """
+        Writes queued tracks and commits them.
+        Returns list of committed tracks, each with song_id set.
+        Tracks which failed are put into self.failed.
+        """
+        tracks, self.pending = self.pending, []
+        if not tracks:
+            return []
+        session = self.db.session
+        if self.progress:
+            self.progress.save()
+
+        self._upsert_titles(
+            Artist, self.artists,
+            {a for t in tracks for a in t['artists']})
+        self._upsert_titles(
+            Genre, self.genres,
+            {g for t in tracks for g in t['genres']})
+
+        known = dict(
+            session.query(MediaFile.path, MediaFile.song_id)
+            .filter(MediaFile.path.in_({t['target'] for t in tracks})))
+
+        written = []
+        links = []
+        for track in tracks:
+            if not track.get('song_id') and known.get(track['target']):
+                # Same file is already in the library
+                track['song_id'] = known[track['target']]
+                track['duplicate'] = True
+                written.append(track)
+                continue
+            try:
+                with session.begin_nested():
+                    links.extend(self._write_track(track))
+                written.append(track)
+                known[track['target']] = track['song_id']
+            except (SQLAlchemyError, KeyError) as e:
+                self.failed.append((track, e))
+
+        try:
+            insert_ignore(
+                session, AlbumArtist,
+                [{'album_id': al, 'artist_id': ar}
+                 for al, ar in links if (al, ar) not in self.album_artists],
+                ['artist_id', 'album_id'])
+            # album_genre has no unique constraint, pairs are checked
+            # against the map instead
+            genre_links = {
+                (al, g) for track in written
+                for al, g in track.pop('genre_links', [])
+                if (al, g) not in self.album_genres
+            }
+            if genre_links:
+                session.execute(AlbumGenre.__table__.insert(), [
+                    {'album_id': al, 'genre_id': g} for al, g in genre_links
+                ])
+            session.commit()
+        except SQLAlchemyError as e:
+            session.rollback()
+            self.failed.extend((t, e) for t in written)
+            # Ids made in this transaction are gone
+            self.preload()
+            return []
+
+        self.album_artists.update(links)
+        self.album_genres.update(genre_links)
+        return written
+
+    def _upsert_titles(self, model, known, titles):
+        """
+        Inserts titles missing from known map and adds their ids to it.
+        If batch insert fails, titles are inserted one by one
+        and those which fail are left out of the map.
+        """
+        session = self.db.session
+        new = [t for t in titles if t not in known]
+        if not new:
+            return
+        try:
+            with session.begin_nested():
+                insert_ignore(
+                    session, model, [{'title': t} for t in new], ['title'])
+        except SQLAlchemyError:
+            for title in new:
+                try:
+                    with session.begin_nested():
+                        insert_ignore(
+                            session, model, [{'title': title}], ['title'])
+                except SQLAlchemyError:
+                    continue
+        known.update(
+            session.query(model.title, model.id)
+            .filter(model.title.in_(new)))
+
+    def _write_track(self, track):
+        """
+        Writes album and song of the track and its file to the manifest.
+        Returns album-artist pairs to link.
+        """
+        session = self.db.session
+        artist_ids = [self.artists[a] for a in track['artists']]
+
+        album_title = track['album'] or 'unknown'
+        key = (album_title, track['artists'][0])
+        album_id = self.albums.get(key)
+        if album_id is None:
+            album = Album(
+                title=album_title,
+                cover_small=track['cover_small'],
+                cover_medium=track['cover_medium'],
+                cover_hash=track.get('cover_hash'))
+            session.add(album)
+            session.flush()
+            album_id = album.id
+        elif track.get('cover_hash') and album_id not in self.album_covers:
+            Album.query.filter_by(id=album_id).update(
+                {'cover_hash': track['cover_hash']},
+                synchronize_session=False)
+        if track.get('cover_hash'):
+            self.album_covers.add(album_id)
+
+        song = None
+        if track.get('song_id'):
+            song = Song.query.get(track['song_id'])
+        if song is None:
+            song = Song()
+            session.add(song)
+        song.title = track['title']
+        song.filepath = track['target']
+        song.duration = track['duration']
+        song.bitrate = track.get('bitrate')
+        song.album_position = track['track_number']
+        song.artist_id = artist_ids[0]
+        song.album_id = album_id
+        song.broken = False
+        song.seek_table = mp3index.decode(track.get('seek_table'))
+        song.preview_start = track.get('preview_start')
+        song.preview_end = track.get('preview_end')
+        session.flush()
+
+        session.merge(MediaFile(
+            path=track['target'],
+            size=track['size'],
+            mtime=track['mtime'],
+            checksum=track['checksum'],
+            crc32=track.get('crc32'),
+            song_id=song.id))
+
+        self.albums[key] = album_id
+        track['song_id'] = song.id
+        track['genre_links'] = [
+            (album_id, self.genres[g]) for g in track['genres']
+            if g in self.genres
+        ]
+        if self.progress:
+            self.progress.mark_committed(track)
+        return [(album_id, a) for a in artist_ids]
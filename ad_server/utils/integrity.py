@@ -0,0 +1,163 @@
+import os
+import json
+import argparse
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from mutagen import MutagenError
+from mutagen.mp3 import MP3
+from ad_server.config import ScriptConfig
+
+
+# Problems found in files
+MISSING = 'missing'
+UNREADABLE = 'unreadable'
+TRUNCATED = 'truncated'
+CHANGED = 'changed'
+CORRUPT = 'corrupt'
+
+
+def check_file(job):
+    """
+    Checks one audio file. Job is a tuple (path, expected size,
+    expected checksum, duration in seconds), any of the expected
+    values may be None to skip the check.
+    Returns name of the problem or None if the file is fine.
+    """
+    from ad_server.utils.addsongs import file_checksum
+
+    path, size, checksum, duration = job
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return MISSING
+    except OSError:
+        return UNREADABLE
+    if size is not None and stat.st_size != size:
+        return TRUNCATED if stat.st_size < size else CHANGED
+
+    try:
+        info = MP3(path).info
+    except MutagenError:
+        return CORRUPT
+    # Sketchy means no valid frame sequence was found
+    if info.sketchy or info.length <= 0:
+        return CORRUPT
+    # Length of files without a vbr header is estimated from their size
+    if duration and info.length < duration - 1:
+        return TRUNCATED
+
+    if checksum is not None:
+        try:
+            if file_checksum(path) != checksum:
+                return CHANGED
+        except OSError:
+            return UNREADABLE
+    return None
+
+
+def check_library(db, storage, workers=None, verify_checksums=False,
+                  batch_size=500):
+    """
+    Checks files of all songs in parallel and flags songs whose files
+    are missing or bad as broken, clearing the flag of those
+    which are fine again. Every file is checked once however many
+    songs refer to it.
+
+    Size and checksum are compared with the manifest, checksums only
+    if verify_checksums is set, as it reads every file in full.
+
+    :return: report dict with check date, numbers of checked songs,
+    files, newly broken and repaired songs, and list of broken songs
+    """
+    from ad_server.models import Song, MediaFile
+
+    rows = db.session.query(
+        Song.id, Song.filepath, Song.duration, Song.broken,
+        MediaFile.size, MediaFile.checksum)\
+        .outerjoin(MediaFile, MediaFile.path == Song.filepath)\
+        .order_by(Song.id).all()
+
+    jobs = {}
+    for _, filepath, duration, _, size, checksum in rows:
+        if filepath not in jobs:
+            jobs[filepath] = (
+                storage.path(filepath),
+                size,
+                checksum if verify_checksums else None,
+                duration)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if jobs and workers:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            problems = list(pool.map(check_file, jobs.values(), chunksize=16))
+    else:
+        problems = [check_file(job) for job in jobs.values()]
+    problems = dict(zip(jobs, problems))
+
+    broken = []
+    newly_broken = []
+    repaired = []
+    for id, filepath, _, was_broken, _, _ in rows:
+        problem = problems[filepath]
+        if problem:
+            broken.append(
+                {'song_id': id, 'filepath': filepath, 'problem': problem})
+            if not was_broken:
+                newly_broken.append(id)
+        elif was_broken:
+            repaired.append(id)
+
+    for ids, flag in ((newly_broken, True), (repaired, False)):
+        for i in range(0, len(ids), batch_size):
+            Song.query.filter(Song.id.in_(ids[i:i + batch_size]))\
+                .update({'broken': flag}, synchronize_session=False)
+            db.session.commit()
+
+    return {
+        'date': datetime.utcnow().isoformat(),
+        'songs': len(rows),
+        'files': len(jobs),
+        'newly_broken': len(newly_broken),
+        'repaired': len(repaired),
+        'broken': broken,
+    }
+
+
+def write_report(report, report_file):
+    tmp_file = f'{report_file}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(report, f, indent=2)
+    os.replace(tmp_file, report_file)
+
+
+if __name__ == '__main__':
+    from ad_server import db, create_app
+    from ad_server.utils.storage import get_media_storage
+
+    parser = argparse.ArgumentParser(
+        description='Checks song files and flags songs with bad files')
+    parser.add_argument(
+        '--workers', type=int, default=None,
+        help='number of processes checking files, defaults to cpu count')
+    parser.add_argument(
+        '--checksums', action='store_true',
+        help='also compare checksums with the manifest, reads whole files')
+    parser.add_argument(
+        '--report',
+        help='report file, defaults to INTEGRITY_REPORT_FILE')
+    args = parser.parse_args()
+
+    app = create_app(ScriptConfig)
+    with app.app_context():
+        report = check_library(
+            db, get_media_storage(), workers=args.workers,
+            verify_checksums=args.checksums)
+        write_report(
+            report, args.report or app.config.get('INTEGRITY_REPORT_FILE'))
+        print(
+            f'Checked {report["files"]} files of {report["songs"]} songs, '
+            f'broken: {len(report["broken"])}, '
+            f'newly broken: {report["newly_broken"]}, '
+            f'repaired: {report["repaired"]}')
+        for item in report['broken']:
+            print(f'{item["problem"]}: {item["filepath"]}')
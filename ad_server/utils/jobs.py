@@ -0,0 +1,150 @@
+import os
+import json
+from datetime import datetime
+from queue import Queue, Empty
+from sqlalchemy import bindparam
+from ad_server.models import IngestJob, IngestItem
+
+
+class JobProgress:
+    """
+    Checkpoints files of an import job as they pass pipeline stages.
+
+    Stage changes are buffered and written with a single statement
+    on save, committed state is written in the transaction which adds
+    the song, so a song is never added twice for the same file.
+    Parse stage runs in another thread and reports parsed tracks
+    through a queue, everything else is called from the writing thread.
+    """
+
+    def __init__(self, db, job):
+        self.db = db
+        self.job = job
+        # filepath: (item id, state, track dict or None)
+        self.items = {}
+        self.changes = []
+        self.parsed_tracks = Queue()
+
+    @classmethod
+    def start(cls, db, folder, files, added_folder=None, resume=True):
+        """
+        Returns progress of the last unfinished job for folder
+        or of a new job if there is none, or resume is False.
+        Files which are not part of the job yet are added to it.
+        """
+        folder = os.path.abspath(folder)
+        job = None
+        if resume:
+            job = IngestJob.query\
+                .filter_by(folder=folder, finished=False)\
+                .order_by(IngestJob.id.desc()).first()
+        if job is None:
+            job = IngestJob(folder=folder, added_folder=added_folder)
+            db.session.add(job)
+            db.session.flush()
+
+        progress = cls(db, job)
+        progress.load()
+        new_files = [f for f in files if f not in progress.items]
+        if new_files:
+            db.session.execute(IngestItem.__table__.insert(), [
+                {'job_id': job.id, 'filepath': f, 'state': IngestItem.PENDING}
+                for f in new_files
+            ])
+        db.session.commit()
+        progress.load()
+        return progress
+
+    def load(self):
+        self.items = {}
+        for id, filepath, state, data in self.db.session.query(
+                IngestItem.id, IngestItem.filepath,
+                IngestItem.state, IngestItem.data)\
+                .filter(IngestItem.job_id == self.job.id):
+            self.items[filepath] = (
+                id, state, json.loads(data) if data else None)
+
+    def state(self, filepath):
+        return self.items[filepath][1]
+
+    def filepaths(self):
+        return list(self.items)
+
+    def tracks(self, state):
+        """
+        Returns tracks saved for files which have stopped at state.
+        """
+        return [
+            track for _, item_state, track in self.items.values()
+            if item_state == state
+        ]
+
+    def parsed(self, track):
+        """
+        Called from the parse stage for every parsed track.
+        """
+        self.parsed_tracks.put(dict(track))
+
+    def record(self, state, track):
+        id = self.items[track['filepath']][0]
+        self.changes.append({
+            'item_id': id, 'state': state, 'data': json.dumps(track)
+        })
+
+    def save(self):
+        """
+        Writes buffered stage changes and commits them.
+        """
+        # Parsed tracks are always reported before they are passed on,
+        # so later stages are written after them
+        parsed = []
+        while True:
+            try:
+                track = self.parsed_tracks.get_nowait()
+            except Empty:
+                break
+            id = self.items[track['filepath']][0]
+            parsed.append({
+                'item_id': id,
+                'state': IngestItem.PARSED,
+                'data': json.dumps(track)
+            })
+        changes, self.changes = parsed + self.changes, []
+        if not changes:
+            return
+        table = IngestItem.__table__
+        self.db.session.execute(
+            table.update()
+            .where(table.c.id == bindparam('item_id'))
+            .values(state=bindparam('state'), data=bindparam('data')),
+            changes)
+        self.db.session.commit()
+
+    def mark_committed(self, track):
+        """
+        Marks file committed within the current transaction.
+        """
+        id = self.items[track['filepath']][0]
+        IngestItem.query.filter_by(id=id).update({
+            'state': IngestItem.COMMITTED,
+            'data': json.dumps(track),
+            'song_id': track['song_id']
+        }, synchronize_session=False)
+
+    def finish(self):
+        """
+        Marks files which haven't made it through as failed
+        and closes the job.
+        """
+        self.save()
+        IngestItem.query\
+            .filter(IngestItem.job_id == self.job.id)\
+            .filter(IngestItem.state.in_((
+                IngestItem.PENDING,
+                IngestItem.PARSED,
+                IngestItem.ENRICHED)))\
+            .update(
+                {'state': IngestItem.FAILED}, synchronize_session=False)
+        self.job.finished = True
+        self.job.finished_date = datetime.utcnow()
+        self.db.session.commit()
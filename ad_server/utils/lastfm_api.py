@@ -1,4 +1,11 @@
+import json
+import sqlite3
+import threading
+import time
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from flask import current_app
 
 
@@ -10,43 +17,194 @@ searchable = {
     'track':
     {'method': 'track.getInfo', 'required': ('track', 'artist')},
     'artist':
-    {'method': 'artist.getInfo', 'required': ('artist')}
+    {'method': 'artist.getInfo', 'required': ('artist',)}
 }
 
+# Last.fm error codes which won't change on retry and can be cached.
+# 6 - requested item is not found
+CACHEABLE_ERRORS = (6,)
 
-def search_on_lastfm(searchfor='track', **kwargs):
 
-    api_key = current_app.config.get('LAST_FM_API_KEY')
+class ResponseCache:
+    """
+    Last.fm responses stored in a sqlite file.
+    Keys are made of api method and request parameters.
+    """
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.local = threading.local()
+        self._connection().execute(
+            'CREATE TABLE IF NOT EXISTS response ('
+            'key TEXT PRIMARY KEY, body TEXT, expires REAL)'
+        )
+
+    def _connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self.local.conn = conn
+        return conn
 
-    if searchfor not in searchable:
-        raise ValueError('searchfor must be either track or album')
-    else:
-        api_request = searchable[searchfor]
+    @staticmethod
+    def make_key(params):
+        key_params = {
+            k: v for k, v in params.items() if k not in ('api_key', 'format')
+        }
+        return json.dumps(key_params, sort_keys=True)
 
-    params = {
-        'method': api_request.get('method'),
-        'api_key': api_key,
-        'format': 'json'}
+    def get(self, params):
+        row = self._connection().execute(
+            'SELECT body FROM response WHERE key = ? AND expires > ?',
+            (self.make_key(params), time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
 
-    for par in api_request['required']:
-        if par not in kwargs:
-            raise ValueError(
-                f'Parameter {par} must be provided!'
-                f'Required parameters: {api_request["required"]}'
+    def set(self, params, body):
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO response VALUES (?, ?, ?)',
+                (self.make_key(params), json.dumps(body),
+                 time.time() + self.ttl)
             )
-    params.update(kwargs)
 
-    response = requests.get(BASE_URL, params=params)
-    if not response.ok:
-        raise ConnectionError(
-            f'Request (url {response.url}) with parameters: {params} '
-            'has returned anything but 200 OK'
-        )
+    def purge(self):
+        """
+        Deletes expired responses.
+        """
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                'DELETE FROM response WHERE expires <= ?', (time.time(),))
 
-    jresponse = response.json()
-    if 'error' in jresponse:
-        raise ConnectionError(
-            f'Request (url {response.url}) with parameters: {params} '
-            f'ended up with an error:\n{jresponse["error"]}'
-        )
-    return jresponse.get(searchfor)
+
+class LastFMClient:
+    """
+    Last.fm api client.
+    Keeps a pool of connections, retries failed requests with backoff,
+    caches responses on disk and limits number of concurrent requests.
+    """
+
+    def __init__(self, api_key, base_url=BASE_URL, cache_path=None,
+                 cache_ttl=30 * 24 * 3600, max_concurrency=4, retries=3,
+                 backoff=0.5, timeout=10):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.cache = ResponseCache(cache_path, cache_ttl) \
+            if cache_path else None
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=('GET',))
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=max_concurrency,
+            max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def search(self, searchfor='track', **kwargs):
+
+        if searchfor not in searchable:
+            raise ValueError('searchfor must be either track or album')
+        else:
+            api_request = searchable[searchfor]
+
+        params = {
+            'method': api_request.get('method'),
+            'api_key': self.api_key,
+            'format': 'json'}
+
+        for par in api_request['required']:
+            if par not in kwargs:
+                raise ValueError(
+                    f'Parameter {par} must be provided!'
+                    f'Required parameters: {api_request["required"]}'
+                )
+        params.update(kwargs)
+
+        jresponse = self.cache.get(params) if self.cache else None
+
+        if jresponse is None:
+            with self.slots:
+                response = self.session.get(
+                    self.base_url, params=params, timeout=self.timeout)
+            if not response.ok:
+                raise ConnectionError(
+                    f'Request (url {response.url}) with parameters: {params} '
+                    'has returned anything but 200 OK'
+                )
+            jresponse = response.json()
+            error = jresponse.get('error')
+            if self.cache and (error is None or error in CACHEABLE_ERRORS):
+                self.cache.set(params, jresponse)
+
+        if 'error' in jresponse:
+            raise ConnectionError(
+                f'Request with parameters: {params} '
+                f'ended up with an error:\n{jresponse["error"]}'
+            )
+        return jresponse.get(searchfor)
+
+    def download(self, url):
+        """
+        Returns content of a file linked from api responses,
+        such as album image.
+        """
+        with self.slots:
+            response = self.session.get(url, timeout=self.timeout)
+        if not response.ok:
+            raise ConnectionError(
+                f'Download of {url} has returned {response.status_code}')
+        return response.content
+
+    def search_many(self, queries):
+        """
+        Runs several searches concurrently,
+        no more than max_concurrency at once.
+
+        :param queries: list of tuples (searchfor, dict of parameters)
+        :return: list of results in the same order. Failed search
+        is represented by the exception it has raised.
+        """
+        def search(query):
+            searchfor, params = query
+            try:
+                return self.search(searchfor, **params)
+            except (ConnectionError, requests.RequestException) as e:
+                return e
+
+        if not queries:
+            return []
+        with ThreadPoolExecutor(self.max_concurrency) as pool:
+            return list(pool.map(search, queries))
+
+
+def get_client():
+    """
+    Returns client configured for current app. Client is created once
+    per app, so connections and cache are reused between calls.
+    """
+    client = current_app.extensions.get('lastfm')
+    if client is None:
+        config = current_app.config
+        client = LastFMClient(
+            api_key=config.get('LAST_FM_API_KEY'),
+            base_url=config.get('LAST_FM_API_URL') or BASE_URL,
+            cache_path=config.get('LAST_FM_CACHE'),
+            cache_ttl=config.get('LAST_FM_CACHE_TTL', 30 * 24 * 3600),
+            max_concurrency=config.get('LAST_FM_MAX_CONCURRENCY', 4))
+        current_app.extensions['lastfm'] = client
+    return client
+
+
+def search_on_lastfm(searchfor='track', **kwargs):
+    return get_client().search(searchfor, **kwargs)
@@ -0,0 +1,97 @@
+import atexit
+import threading
+from collections import Counter
+from sqlalchemy import bindparam
+from sqlalchemy.exc import SQLAlchemyError
+
+
+class ListenCounter:
+    """
+    Listens counted in memory and written to the database in batches,
+    so serving a stream doesn't wait for the database.
+    Thread safe, every process keeps its own counts.
+    """
+
+    def __init__(self):
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, song_id, count=1):
+        with self._lock:
+            self._counts[song_id] += count
+
+    def pending(self):
+        with self._lock:
+            return sum(self._counts.values())
+
+    def flush(self, db):
+        """
+        Adds counted listens to listens_count of songs with a single
+        statement. Counts are kept for the next flush if it fails.
+        Returns number of written listens.
+        """
+        from ad_server.models import Song
+
+        with self._lock:
+            counts, self._counts = self._counts, Counter()
+        if not counts:
+            return 0
+        table = Song.__table__
+        try:
+            db.session.execute(
+                table.update()
+                .where(table.c.id == bindparam('song_id'))
+                .values(listens_count=db.func.coalesce(
+                    table.c.listens_count, 0) + bindparam('count')),
+                [{'song_id': id, 'count': n} for id, n in counts.items()])
+            db.session.commit()
+        except SQLAlchemyError:
+            db.session.rollback()
+            with self._lock:
+                self._counts.update(counts)
+            raise
+        return sum(counts.values())
+
+
+# Listens of streams served by signed urls
+listen_counter = ListenCounter()
+
+
+class ListenFlusher(threading.Thread):
+    """
+    Background thread which writes counted listens every interval seconds.
+    """
+
+    def __init__(self, app, interval):
+        super().__init__(name='listen-flusher', daemon=True)
+        self.app = app
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        from ad_server import db
+
+        with self.app.app_context():
+            try:
+                return listen_counter.flush(db)
+            except SQLAlchemyError as e:
+                self.app.logger.error(f'Listens flush failed: {e!r}')
+                return 0
+
+    def stop(self):
+        self.stopped.set()
+
+
+def start_listen_flusher(app):
+    interval = app.config.get('LISTEN_FLUSH_INTERVAL')
+    if not interval:
+        return None
+    flusher = ListenFlusher(app, interval)
+    flusher.start()
+    # Listens counted since the last flush are written on exit
+    atexit.register(flusher.flush)
+    return flusher
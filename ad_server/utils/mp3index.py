@@ -0,0 +1,318 @@
+import os
+import mmap
+import base64
+import struct
+import argparse
+from bisect import bisect_right
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from ad_server.config import ScriptConfig
+
+
+# Bitrates in kbps by (version is MPEG 1, layer)
+BITRATES = {
+    (True, 1): (0, 32, 64, 96, 128, 160, 192, 224,
+                256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112,
+                128, 160, 192, 224, 256, 320, 384),
+    (True, 3): (0, 32, 40, 48, 56, 64, 80, 96,
+                112, 128, 160, 192, 224, 256, 320),
+    (False, 1): (0, 32, 48, 56, 64, 80, 96, 112,
+                 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56,
+                 64, 80, 96, 112, 128, 144, 160),
+}
+BITRATES[(False, 3)] = BITRATES[(False, 2)]
+
+# Sample rates by version bits: MPEG 2.5, reserved, MPEG 2, MPEG 1
+SAMPLE_RATES = {
+    0: (11025, 12000, 8000),
+    2: (22050, 24000, 16000),
+    3: (44100, 48000, 32000),
+}
+
+# Milliseconds between seek table entries
+SEEK_INTERVAL = 1000
+
+# Previews start at this part of the song and last PREVIEW_LENGTH ms
+PREVIEW_POSITION = 0.3
+PREVIEW_LENGTH = 30000
+
+entry = struct.Struct('<II')
+
+Frame = namedtuple(
+    'Frame', 'length samples sample_rate bitrate side_info_length')
+
+
+def parse_header(header):
+    """
+    Parses 4 bytes of an mpeg audio frame header.
+    Returns Frame or None if it is not a valid header.
+    Free format frames are not supported.
+    """
+    if len(header) < 4 or header[0] != 0xff or header[1] & 0xe0 != 0xe0:
+        return None
+    version = (header[1] >> 3) & 3
+    layer = 4 - ((header[1] >> 1) & 3)
+    bitrate_index = header[2] >> 4
+    rate_index = (header[2] >> 2) & 3
+    if version == 1 or layer == 4 or rate_index == 3 or \
+       bitrate_index in (0, 15):
+        return None
+
+    mpeg1 = version == 3
+    bitrate = BITRATES[(mpeg1, layer)][bitrate_index] * 1000
+    sample_rate = SAMPLE_RATES[version][rate_index]
+    padding = (header[2] >> 1) & 1
+    if layer == 1:
+        samples = 384
+        length = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        samples = 1152 if mpeg1 or layer == 2 else 576
+        length = samples // 8 * bitrate // sample_rate + padding
+
+    mono = header[3] >> 6 == 3
+    if mpeg1:
+        side_info_length = 17 if mono else 32
+    else:
+        side_info_length = 9 if mono else 17
+    return Frame(length, samples, sample_rate, bitrate, side_info_length)
+
+
+def audio_start(data):
+    """
+    Returns offset of the data after ID3v2 tag, 0 if there is no tag.
+    """
+    if len(data) < 10 or data[:3] != b'ID3':
+        return 0
+    size = 0
+    for b in data[6:10]:
+        size = (size << 7) | (b & 0x7f)
+    # Footer flag
+    if data[5] & 0x10:
+        size += 10
+    return size + 10
+
+
+def iter_frames(data):
+    """
+    Yields (offset, Frame) of every audio frame in data.
+    After junk, frames are picked up again at the first header
+    followed by another valid header.
+    """
+    end = len(data)
+    if end >= 128 and data[end - 128:end - 125] == b'TAG':
+        end -= 128
+    offset = audio_start(data)
+    synced = False
+    while offset + 4 <= end:
+        frame = parse_header(data[offset:offset + 4])
+        if frame:
+            following = offset + frame.length
+            if synced or following + 4 > end or \
+               parse_header(data[following:following + 4]):
+                synced = True
+                yield offset, frame
+                offset = following
+                continue
+        synced = False
+        offset = data.find(b'\xff', offset + 1, end)
+        if offset < 0:
+            return
+
+
+def is_info_frame(data, offset, frame):
+    """
+    Checks if frame holds Xing, Info or VBRI header instead of audio.
+    """
+    tag_at = offset + 4 + frame.side_info_length
+    return data[tag_at:tag_at + 4] in (b'Xing', b'Info') or \
+        data[offset + 36:offset + 40] == b'VBRI'
+
+
+def build_seek_table(data, interval=SEEK_INTERVAL):
+    """
+    Returns list of (milliseconds, byte offset) of frames starting
+    at least interval milliseconds apart. Time is counted from
+    samples in frame headers, so it is exact for vbr files too.
+    """
+    table = []
+    samples = 0
+    next_ms = 0
+    first = True
+    for offset, frame in iter_frames(data):
+        if first:
+            first = False
+            # Info frame is skipped by decoders and has no duration
+            if is_info_frame(data, offset, frame):
+                continue
+        ms = samples * 1000 // frame.sample_rate
+        if ms >= next_ms:
+            table.append((ms, offset))
+            next_ms = ms + interval
+        samples += frame.samples
+    return table
+
+
+def frames_duration(data):
+    """
+    Returns duration in milliseconds of the audio frames in data.
+    """
+    samples = 0
+    sample_rate = None
+    for _, frame in iter_frames(data):
+        samples += frame.samples
+        sample_rate = frame.sample_rate
+    return samples * 1000 // sample_rate if sample_rate else 0
+
+
+def file_seek_table(filepath, interval=SEEK_INTERVAL):
+    """
+    Returns packed seek table of an mp3 file, see pack.
+    """
+    with open(filepath, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return pack([])
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return pack(build_seek_table(data, interval))
+
+
+def pack(table):
+    """
+    Packs seek table into bytes, 8 bytes per entry.
+    """
+    return b''.join(entry.pack(ms, offset) for ms, offset in table)
+
+
+def unpack(packed):
+    return list(entry.iter_unpack(packed))
+
+
+def encode(packed):
+    """
+    Returns packed seek table as a string, tracks are passed as json.
+    """
+    return base64.b64encode(packed).decode()
+
+
+def decode(encoded):
+    return base64.b64decode(encoded) if encoded else None
+
+
+def seek(packed, ms):
+    """
+    Returns (milliseconds, byte offset) of the last frame in the table
+    which starts at or before ms, (0, 0) if there is none.
+    """
+    table = unpack(packed or b'')
+    i = bisect_right([t for t, _ in table], ms) - 1
+    if i <= 0:
+        # Whole file with its tags is sent from the start
+        return 0, 0
+    return table[i]
+
+
+def preview_range(table, file_size, position=PREVIEW_POSITION,
+                  length=PREVIEW_LENGTH):
+    """
+    Returns (start, end) byte offsets of a preview which starts
+    at the frame playing at position part of the song and lasts
+    length milliseconds, or up to the end of the file.
+    Returns None if the table is empty.
+    """
+    if not table:
+        return None
+    start_ms = table[-1][0] * position
+    start = end = None
+    for ms, offset in table:
+        if start is None and ms >= start_ms:
+            start_ms, start = ms, offset
+        elif start is not None and ms >= start_ms + length:
+            end = offset
+            break
+    return start, end or file_size
+
+
+def file_index(filepath):
+    """
+    Returns dict with packed seek table of the file and byte range
+    of its preview, see preview_range.
+    """
+    packed = file_seek_table(filepath)
+    preview = preview_range(unpack(packed), os.path.getsize(filepath))
+    return {
+        'seek_table': packed,
+        'preview_start': preview and preview[0],
+        'preview_end': preview and preview[1],
+    }
+
+
+def _file_index_or_none(filepath):
+    try:
+        return file_index(filepath)
+    except OSError:
+        return None
+
+
+def backfill_seek_tables(db, storage, workers=None, batch_size=100):
+    """
+    Builds seek tables and preview ranges of songs which have none.
+    Returns number of updated songs.
+    """
+    from ad_server.models import Song
+
+    songs = {}
+    for id, filepath in db.session.query(Song.id, Song.filepath)\
+            .filter(Song.seek_table.is_(None) |
+                    Song.preview_start.is_(None))\
+            .filter(~Song.broken):
+        songs.setdefault(filepath, []).append(id)
+    filepaths = list(songs)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    updated = 0
+    pool = ProcessPoolExecutor(max_workers=workers) if workers else None
+    try:
+        for i in range(0, len(filepaths), batch_size):
+            batch = filepaths[i:i + batch_size]
+            paths = [storage.path(f) for f in batch]
+            if pool:
+                indexes = pool.map(_file_index_or_none, paths, chunksize=8)
+            else:
+                indexes = map(_file_index_or_none, paths)
+            for filepath, index in zip(batch, indexes):
+                if index is None:
+                    continue
+                ids = songs[filepath]
+                Song.query.filter(Song.id.in_(ids))\
+                    .update(index, synchronize_session=False)
+                updated += len(ids)
+            db.session.commit()
+    finally:
+        if pool:
+            pool.shutdown()
+    return updated
+
+
+if __name__ == '__main__':
+    from ad_server import db, create_app
+    from ad_server.utils.storage import get_media_storage
+
+    parser = argparse.ArgumentParser(
+        description='Builds seek tables and previews of songs '
+                    'which have none')
+    parser.add_argument(
+        '--workers', type=int, default=None,
+        help='number of processes reading files, defaults to cpu count')
+    parser.add_argument(
+        '--batch-size', type=int, default=100,
+        help='number of files updated in one transaction')
+    args = parser.parse_args()
+
+    app = create_app(ScriptConfig)
+    with app.app_context():
+        updated = backfill_seek_tables(
+            db, get_media_storage(), workers=args.workers,
+            batch_size=args.batch_size)
+        print(f'Songs updated: {updated}')
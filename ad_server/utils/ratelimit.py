@@ -0,0 +1,187 @@
+import math
+import re
+import sqlite3
+import threading
+import time
+from functools import wraps
+from flask import request, g
+from ad_server.utils.cache import TTLCache
+import ad_server.views.messages as msg
+
+
+PERIODS = {
+    'second': 1,
+    'minute': 60,
+    'hour': 3600,
+    'day': 86400,
+}
+
+limit_reg = re.compile(r'^\s*(\d+)\s*/\s*(\d*)\s*(second|minute|hour|day)s?\s*$')
+
+
+def parse_limit(limit):
+    """
+    Parses limit string like '10/minute' or '100/5 minutes'.
+    Returns tuple (capacity, period in seconds).
+    """
+    match = limit_reg.match(limit)
+    if not match:
+        raise ValueError(f'Invalid rate limit: {limit}')
+    count, multiplier, period = match.groups()
+    return int(count), int(multiplier or 1) * PERIODS[period]
+
+
+class MemoryBucketStorage:
+    """
+    Token buckets in memory of the current process.
+    Every worker process has its own buckets.
+    """
+
+    def __init__(self, maxsize=100000):
+        self.buckets = TTLCache(maxsize=maxsize)
+        self.lock = threading.Lock()
+
+    def consume(self, key, capacity, period):
+        """
+        Takes one token from the bucket.
+        Returns 0 if request is allowed, otherwise
+        seconds until the next token is available.
+        """
+        rate = capacity / period
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / rate
+            # Bucket which is refilled completely is the same as no bucket
+            self.buckets.set(key, (tokens, now), ttl=period)
+        return wait
+
+
+class SQLiteBucketStorage:
+    """
+    Token buckets in a local sqlite database, shared by all worker
+    processes on the host. Place it on tmpfs (e.g. /dev/shm)
+    to keep it in memory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self._connection().execute(
+            'CREATE TABLE IF NOT EXISTS bucket ('
+            'key TEXT PRIMARY KEY, tokens REAL, updated REAL, expires REAL)'
+        )
+
+    def _connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            self.local.conn = conn
+        return conn
+
+    def consume(self, key, capacity, period):
+        rate = capacity / period
+        now = time.time()
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT tokens, updated FROM bucket WHERE key = ?', (key,)
+            ).fetchone()
+            tokens, updated = row if row else (capacity, now)
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / rate
+            conn.execute(
+                'INSERT OR REPLACE INTO bucket VALUES (?, ?, ?, ?)',
+                (key, tokens, now, now + period)
+            )
+            # Drop some of full buckets once in a while
+            if not row:
+                conn.execute(
+                    'DELETE FROM bucket WHERE key IN ('
+                    'SELECT key FROM bucket WHERE expires < ? LIMIT 100)',
+                    (now,)
+                )
+            conn.execute('COMMIT')
+        except sqlite3.Error:
+            conn.execute('ROLLBACK')
+            raise
+        return wait
+
+
+class RateLimiter:
+    """
+    Per route rate limiting with token buckets.
+    Limits are declared on view functions with the limit decorator.
+    Buckets are kept in process memory or, when RATELIMIT_STORAGE
+    is a path, in a sqlite file shared by all workers.
+    """
+
+    def __init__(self, app=None):
+        self.enabled = True
+        self.storage = MemoryBucketStorage()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('RATELIMIT_ENABLED', True)
+        app.config.setdefault('RATELIMIT_STORAGE', 'memory')
+
+        self.enabled = app.config['RATELIMIT_ENABLED']
+        storage = app.config['RATELIMIT_STORAGE']
+        if storage == 'memory':
+            self.storage = MemoryBucketStorage()
+        else:
+            self.storage = SQLiteBucketStorage(storage)
+
+    def limit(self, limit, per='ip'):
+        """
+        Decorator for view functions.
+        Takes limit string of format <count>/<period>, e.g. '30/minute',
+        and what to limit - per 'ip', per 'user' or per 'url'.
+        Per user limits fall back to ip if there is no current user,
+        so they should be placed after authentication decorators.
+        Per url limits give every url with its query string its own
+        bucket, for signed urls which a cdn fetches for many clients.
+        Client ip is the address resolved from TRUSTED_PROXIES.
+        Returns 429 response with Retry-After header when limit is exceeded.
+        """
+        capacity, period = parse_limit(limit)
+        if per not in ('ip', 'user', 'url'):
+            raise ValueError('per must be either ip, user or url')
+
+        def decorator(func):
+            @wraps(func)
+            def check_limit(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+
+                user = g.get('current_user')
+                if per == 'user' and user is not None:
+                    client = f'user:{user.id}'
+                elif per == 'url':
+                    client = f'url:{request.full_path}'
+                else:
+                    client = f'ip:{request.remote_addr}'
+                key = f'{request.endpoint}:{client}'
+
+                wait = self.storage.consume(key, capacity, period)
+                if wait:
+                    return msg.errors.too_many_requests(
+                        'Too many requests. Please try later',
+                        retry_after=math.ceil(wait))
+                return func(*args, **kwargs)
+            return check_limit
+        return decorator
@@ -0,0 +1,181 @@
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from ad_server.config import ScriptConfig
+from ad_server.models import Song, PlaylistSong, MediaFile, IngestItem
+from ad_server.utils.addsongs import import_files, file_checksum
+from ad_server.utils.storage import get_media_storage
+from ad_server import db, create_app
+
+
+def walk_mp3_files(root):
+    """
+    Yields (path, stat result) for every mp3 file under root.
+    """
+    stack = [os.path.abspath(root)]
+    while stack:
+        folder = stack.pop()
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file() and \
+                        os.path.splitext(entry.name)[1] == '.mp3':
+                    yield entry.path, entry.stat()
+
+
+def delete_songs(db, song_ids, batch_size=500):
+    """
+    Deletes songs, their manifest entries and playlist entries.
+    Import job items keep their files, but no longer refer to the songs.
+    """
+    song_ids = list(song_ids)
+    for i in range(0, len(song_ids), batch_size):
+        chunk = song_ids[i:i + batch_size]
+        PlaylistSong.query.filter(PlaylistSong.song_id.in_(chunk))\
+            .delete(synchronize_session=False)
+        MediaFile.query.filter(MediaFile.song_id.in_(chunk))\
+            .delete(synchronize_session=False)
+        IngestItem.query.filter(IngestItem.song_id.in_(chunk))\
+            .update({'song_id': None}, synchronize_session=False)
+        Song.query.filter(Song.id.in_(chunk))\
+            .delete(synchronize_session=False)
+        db.session.commit()
+
+
+def scan_library(root, db, workers=None, batch_size=100):
+    """
+    Brings the database in line with mp3 files under root.
+
+    Files are compared with the manifest (media_file table) by size
+    and modification time, so unchanged files are neither read nor
+    parsed. Changed files are hashed; if content is the same only
+    the manifest is updated, otherwise file is imported again, updating
+    the song it belongs to. New files are imported, songs of deleted
+    files are removed.
+
+    Root may be a folder of the media storage. Its files are known
+    by storage keys and are never changed, so changed files there are
+    counted as damaged and left as they are. New files are moved under
+    their keys.
+
+    :return: dict with counts of unchanged, touched, imported, damaged
+    and failed files and of deleted songs
+    """
+    root = os.path.abspath(root)
+    storage = get_media_storage()
+    in_storage = storage.contains(root)
+    if in_storage:
+        prefix = '' if root == storage.root else f'{storage.key_of(root)}/'
+    else:
+        prefix = os.path.join(root, '')
+
+    def under_root(column):
+        condition = column.startswith(prefix, autoescape=True)
+        if in_storage:
+            # Keys are relative, other files are known by absolute paths
+            condition &= ~column.startswith('/')
+        return condition
+
+    manifest = {
+        f.path: f for f in MediaFile.query.filter(under_root(MediaFile.path))
+    }
+    # Songs may have been added before the manifest existed
+    songs = dict(
+        db.session.query(Song.filepath, Song.id)
+        .filter(under_root(Song.filepath)))
+
+    unchanged = 0
+    candidates = []
+    seen = set()
+    for path, stat in walk_mp3_files(root):
+        name = storage.key_of(path)
+        seen.add(name)
+        known = manifest.get(name)
+        if known and known.size == stat.st_size and \
+           known.mtime == stat.st_mtime_ns:
+            unchanged += 1
+            continue
+        candidates.append((path, stat))
+
+    # Files which were only touched keep their songs as they are
+    known_candidates = [
+        (path, stat) for path, stat in candidates
+        if storage.key_of(path) in manifest
+    ]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if known_candidates and workers:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            checksums = list(pool.map(
+                file_checksum, [path for path, _ in known_candidates],
+                chunksize=8))
+    else:
+        checksums = [file_checksum(path) for path, _ in known_candidates]
+
+    touched = set()
+    for (path, stat), checksum in zip(known_candidates, checksums):
+        known = manifest[storage.key_of(path)]
+        if checksum == known.checksum:
+            known.size = stat.st_size
+            known.mtime = stat.st_mtime_ns
+            touched.add(path)
+    db.session.commit()
+
+    changed = [path for path, _ in candidates if path not in touched]
+    damaged = []
+    if in_storage:
+        damaged = [
+            path for path in changed if storage.key_of(path) in manifest
+        ]
+        changed = [path for path in changed if path not in damaged]
+    imported, failed = import_files(
+        changed,
+        db,
+        storage=storage if in_storage else None,
+        song_ids={
+            path: songs[storage.key_of(path)] for path in changed
+            if storage.key_of(path) in songs
+        },
+        workers=workers,
+        batch_size=batch_size)
+
+    deleted_songs = {id for path, id in songs.items() if path not in seen}
+    delete_songs(db, deleted_songs)
+    deleted_files = [path for path in manifest if path not in seen]
+    for i in range(0, len(deleted_files), 500):
+        MediaFile.query\
+            .filter(MediaFile.path.in_(deleted_files[i:i + 500]))\
+            .delete(synchronize_session=False)
+    db.session.commit()
+
+    return {
+        'unchanged': unchanged,
+        'touched': len(touched),
+        'imported': len(imported),
+        'damaged': len(damaged),
+        'failed': len(failed),
+        'deleted': len(deleted_songs),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Rescans media library and updates the database')
+    parser.add_argument(
+        'root', nargs='?',
+        help='library folder, defaults to the media storage')
+    parser.add_argument(
+        '--workers', type=int, default=None,
+        help='number of processes parsing files, defaults to cpu count')
+    parser.add_argument(
+        '--batch-size', type=int, default=100,
+        help='number of songs written in one transaction')
+    args = parser.parse_args()
+
+    app = create_app(ScriptConfig)
+    with app.app_context():
+        root = args.root or get_media_storage().root
+        result = scan_library(
+            root, db, workers=args.workers, batch_size=args.batch_size)
+        print(', '.join(f'{k}: {v}' for k, v in result.items()))
@@ -0,0 +1,40 @@
+import hmac
+import time
+import base64
+import hashlib
+
+
+def signature(secret, key, song_id, expires):
+    """
+    Returns url safe HMAC-SHA256 signature of a stream url.
+    Reverse proxy verifying urls computes it the same way over
+    '<key>:<song_id>:<expires>'.
+    """
+    message = f'{key}:{song_id}:{expires}'.encode()
+    digest = hmac.new(secret.encode(), message, hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+
+def expiration(ttl, now=None):
+    """
+    Returns expiration time at least ttl seconds from now. Times are
+    rounded up to a multiple of ttl, so urls issued for the same file
+    within that window are equal and caches can share the response.
+    """
+    now = int(time.time() if now is None else now)
+    return (now // ttl + 2) * ttl
+
+
+def verify(secret, key, song_id, expires, sig, now=None):
+    """
+    Checks signature of a stream url and that it hasn't expired.
+    """
+    try:
+        expires = int(expires)
+    except (TypeError, ValueError):
+        return False
+    now = time.time() if now is None else now
+    if expires < now:
+        return False
+    expected = signature(secret, key, song_id, expires)
+    return hmac.compare_digest(expected, sig or '')
@@ -0,0 +1,181 @@
+import os
+import uuid
+import shutil
+import argparse
+from flask import current_app
+from ad_server.config import ScriptConfig
+
+
+class MediaStorage:
+    """
+    Audio files kept under their content hash.
+
+    File with sha256 abcdef... is stored as <root>/ab/cd/abcdef....mp3,
+    so no directory grows too large and files with the same name
+    never collide. Songs refer to files by key, the path relative
+    to root. Absolute paths of files added before this layout
+    are accepted as keys too.
+
+    Every file lives under root. Faster tiers may hold copies
+    of the most listened files under the same keys, placed there
+    by utils.tiers. Readers find the fastest copy with resolve.
+    """
+
+    def __init__(self, root, tiers=()):
+        self.root = os.path.abspath(root)
+        # List of (MediaStorage, budget in bytes), fastest first
+        self.tiers = [(MediaStorage(r), budget) for r, budget in tiers]
+
+    @staticmethod
+    def key(checksum, ext='.mp3'):
+        return f'{checksum[:2]}/{checksum[2:4]}/{checksum}{ext}'
+
+    def path(self, key):
+        """
+        Returns absolute path of the file stored under key.
+        """
+        if os.path.isabs(key):
+            return key
+        return os.path.join(self.root, *key.split('/'))
+
+    def resolve(self, key):
+        """
+        Returns path of the fastest copy of the file stored under key.
+        """
+        if not os.path.isabs(key):
+            for tier, _ in self.tiers:
+                path = tier.path(key)
+                if os.path.exists(path):
+                    return path
+        return self.path(key)
+
+    def contains(self, path):
+        path = os.path.abspath(path)
+        return path == self.root or \
+            path.startswith(os.path.join(self.root, ''))
+
+    def key_of(self, path):
+        """
+        Returns key of a file under root, absolute path of any other file.
+        """
+        path = os.path.abspath(path)
+        if not self.contains(path):
+            return path
+        return os.path.relpath(path, self.root).replace(os.sep, '/')
+
+    def store(self, filepath, key):
+        """
+        Moves file into the storage under key. If the same content
+        is already stored, file is deleted instead.
+        """
+        target = self.path(key)
+        if os.path.abspath(filepath) == target:
+            return key
+        if os.path.exists(target):
+            if os.path.exists(filepath):
+                os.remove(filepath)
+            return key
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # Moved into a temporary name first, so the file under key
+        # is always complete even if moved between filesystems
+        tmp_target = f'{target}.{uuid.uuid4().hex}.tmp'
+        shutil.move(filepath, tmp_target)
+        os.replace(tmp_target, target)
+        return key
+
+
+def parse_tiers(tiers):
+    """
+    Parses storage tiers like '/mnt/nvme=200000000000,/mnt/ssd=...',
+    root and budget in bytes of every tier, fastest first.
+    Returns list of tuples (root, budget).
+    """
+    if not tiers:
+        return []
+    if not isinstance(tiers, str):
+        return list(tiers)
+    parsed = []
+    for tier in tiers.split(','):
+        root, sep, budget = tier.strip().rpartition('=')
+        if not sep or not root:
+            raise ValueError(f'Invalid storage tier: {tier}')
+        parsed.append((root, int(budget)))
+    return parsed
+
+
+def get_media_storage():
+    config = current_app.config
+    return MediaStorage(
+        config.get('LIBRARY_STORAGE') or
+        os.path.join(config.get('MEDIA_STORAGE'), 'library'),
+        tiers=parse_tiers(config.get('STORAGE_TIERS')))
+
+
+def relocate_library(db, storage, batch_size=100):
+    """
+    Moves files of songs which are referred to by absolute path
+    into the storage and replaces their paths with keys.
+    Returns tuple (number of relocated songs, list of missing files).
+    """
+    from ad_server.models import Song, MediaFile
+    from ad_server.utils.addsongs import file_checksum
+
+    moved = {}
+    missing = []
+    relocated = 0
+    legacy = [
+        (id, filepath) for id, filepath in db.session.query(
+            Song.id, Song.filepath).order_by(Song.id)
+        if filepath and os.path.isabs(filepath)
+    ]
+    for i in range(0, len(legacy), batch_size):
+        for id, filepath in legacy[i:i + batch_size]:
+            key = moved.get(filepath)
+            if key is None:
+                known = MediaFile.query.get(filepath)
+                if os.path.exists(filepath):
+                    checksum = file_checksum(filepath)
+                elif known and known.checksum and os.path.exists(
+                        storage.path(storage.key(known.checksum))):
+                    # Moved by a run which hasn't committed
+                    checksum = known.checksum
+                else:
+                    missing.append(filepath)
+                    continue
+                key = storage.store(filepath, storage.key(checksum))
+                moved[filepath] = key
+                stat = os.stat(storage.path(key))
+
+                if known:
+                    db.session.delete(known)
+                db.session.merge(MediaFile(
+                    path=key,
+                    size=stat.st_size,
+                    mtime=stat.st_mtime_ns,
+                    checksum=checksum,
+                    song_id=id))
+            Song.query.filter_by(id=id).update(
+                {'filepath': key}, synchronize_session=False)
+            relocated += 1
+        db.session.commit()
+    return relocated, missing
+
+
+if __name__ == '__main__':
+    from ad_server import db, create_app
+
+    parser = argparse.ArgumentParser(
+        description='Moves songs stored by file name into '
+                    'the content addressed storage')
+    parser.add_argument(
+        '--batch-size', type=int, default=100,
+        help='number of songs updated in one transaction')
+    args = parser.parse_args()
+
+    app = create_app(ScriptConfig)
+    with app.app_context():
+        relocated, missing = relocate_library(
+            db, get_media_storage(), batch_size=args.batch_size)
+        print(f'Relocated songs: {relocated}')
+        for filepath in missing:
+            print(f'Missing file: {filepath}')
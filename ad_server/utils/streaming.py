@@ -0,0 +1,430 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from sqlalchemy.exc import SQLAlchemyError
+
+
+def file_version(stat):
+    """
+    Returns what tells if a file has changed since stat was taken.
+    """
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+class HeadCache:
+    """
+    First head_size bytes of song files kept in memory, so streams
+    of popular songs start without waiting for the disk.
+
+    Heads are keyed by song filepath and kept until their file changes
+    or the total size goes over budget, then least recently used heads
+    are evicted. Cache is thread safe and belongs to a single process.
+    """
+
+    def __init__(self, budget=0, head_size=256 * 1024):
+        self.budget = budget
+        self.head_size = head_size
+        # key: (file version, head)
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def configure(self, budget=None, head_size=None):
+        with self._lock:
+            if head_size is not None and head_size != self.head_size:
+                self.head_size = head_size
+                self._items.clear()
+                self._size = 0
+            if budget is not None:
+                self.budget = budget
+            self._shrink()
+
+    def get(self, key, stat):
+        """
+        Returns head of the file or None if it isn't cached
+        or the file has changed since.
+        """
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or item[0] != file_version(stat):
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, stat, head):
+        if len(head) > self.budget:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old:
+                self._size -= len(old[1])
+            self._items[key] = (file_version(stat), head)
+            self._size += len(head)
+            self._shrink()
+
+    def has(self, key, stat):
+        """
+        Checks if current head of the file is cached,
+        without counting it as a request.
+        """
+        with self._lock:
+            item = self._items.get(key)
+            return item is not None and item[0] == file_version(stat)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def _shrink(self):
+        while self._items and self._size > self.budget:
+            _, (_, head) = self._items.popitem(last=False)
+            self._size -= len(head)
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                'budget': self.budget,
+                'head_size': self.head_size,
+                'size': self._size,
+                'entries': len(self._items),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / requests if requests else None,
+                'evictions': self.evictions,
+            }
+
+
+class OpenFile:
+    """
+    Read only descriptor of a file shared by requests.
+    Reads use pread, so they don't depend on a shared position.
+    Descriptor is closed when it has left the cache and no one uses it.
+    """
+
+    def __init__(self, cache, path, fd, stat):
+        self.cache = cache
+        self.path = path
+        self.fd = fd
+        self.stat = stat
+        self.users = 0
+        self.retired = False
+
+    def read(self, offset, size):
+        data = os.pread(self.fd, size, offset)
+        # Regular files return short reads only at the end
+        while data and len(data) < size:
+            more = os.pread(self.fd, size - len(data), offset + len(data))
+            if not more:
+                break
+            data += more
+        return data
+
+    def release(self):
+        self.cache.release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class FileCache:
+    """
+    Open descriptors and stat results of song files, keyed by song id.
+
+    Stat result is trusted for ttl seconds, then the file is stat'ed
+    again and reopened if its inode, size or mtime has changed.
+    No more than maxsize descriptors are kept, least recently used
+    are closed first. Cache is thread safe and belongs to a single
+    process.
+    """
+
+    def __init__(self, maxsize=0, ttl=5):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # key: (OpenFile, monotonic time of the last stat check)
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, maxsize=None, ttl=None):
+        """
+        Changes cache limits. Number of descriptors is kept
+        under a quarter of the process limit.
+        """
+        import resource
+
+        with self._lock:
+            if maxsize is not None:
+                soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+                if soft != resource.RLIM_INFINITY:
+                    maxsize = min(maxsize, soft // 4)
+                self.maxsize = maxsize
+            if ttl is not None:
+                self.ttl = ttl
+            self._shrink()
+
+    def open(self, key, path):
+        """
+        Returns OpenFile of path, which must be released after use.
+        Raises OSError if the file can't be opened.
+        """
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(key)
+            if item and item[0].path == path and now - item[1] < self.ttl:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._use(item[0])
+
+        if item and item[0].path == path and \
+           file_version(os.stat(path)) == file_version(item[0].stat):
+            with self._lock:
+                if self._items.get(key) is item:
+                    self._items[key] = (item[0], now)
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    return self._use(item[0])
+
+        fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+        opened = OpenFile(self, path, fd, os.fstat(fd))
+        with self._lock:
+            self.misses += 1
+            self._use(opened)
+            if self.maxsize <= 0:
+                opened.retired = True
+                return opened
+            old = self._items.pop(key, None)
+            if old:
+                self._retire(old[0])
+            self._items[key] = (opened, now)
+            self._shrink()
+        return opened
+
+    def release(self, opened):
+        with self._lock:
+            opened.users -= 1
+            if opened.retired and not opened.users:
+                os.close(opened.fd)
+
+    def clear(self):
+        with self._lock:
+            for opened, _ in self._items.values():
+                self._retire(opened)
+            self._items.clear()
+            self.hits = self.misses = 0
+
+    def _use(self, opened):
+        opened.users += 1
+        return opened
+
+    def _retire(self, opened):
+        opened.retired = True
+        if not opened.users:
+            os.close(opened.fd)
+
+    def _shrink(self):
+        while len(self._items) > max(self.maxsize, 0):
+            _, (opened, _) = self._items.popitem(last=False)
+            self._retire(opened)
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                'maxsize': self.maxsize,
+                'open': len(self._items),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / requests if requests else None,
+            }
+
+
+# Heads of popular songs and open song files,
+# limits are applied from app config in create_app
+head_cache = HeadCache()
+file_cache = FileCache()
+
+
+class Pacer:
+    """
+    Limits throughput of a stream to rate bytes per second
+    after the first burst bytes, which are sent at once.
+    Time is taken from clock, monotonic time by default.
+    """
+
+    def __init__(self, rate, burst=0, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.sent = 0
+        self.started = None
+
+    def delay(self, size):
+        """
+        Called before sending size bytes.
+        Returns seconds left until they are due.
+        """
+        now = self.clock()
+        if self.started is None:
+            self.started = now
+        self.sent += size
+        due = self.started + (self.sent - self.burst) / self.rate
+        return max(due - now, 0)
+
+    def wait(self, size):
+        """
+        Called before sending size bytes, sleeps until they are due.
+        """
+        delay = self.delay(size)
+        if delay:
+            time.sleep(delay)
+
+
+class FileStream:
+    """
+    Iterable with content of OpenFile from offset in chunks.
+    Start of the file is served from the head cache if key is given,
+    and is put there if it isn't cached yet. Chunks are sent no faster
+    than pacer allows, if one is given.
+    File is released when the stream is closed, even if it has never
+    been read, as WSGI servers close response iterables.
+
+    Async servers read chunks without pacing and wait for the pacer
+    themselves, see utils.asgi.
+    """
+
+    def __init__(self, opened, offset=0, key=None, chunk_size=64 * 1024,
+                 pacer=None):
+        self.opened = opened
+        self.pacer = pacer
+        self.released = False
+        self.chunks = self._read(offset, key, chunk_size)
+
+    def _read(self, offset, key, chunk_size):
+        opened = self.opened
+        stat = opened.stat
+        if key is not None and offset < head_cache.head_size:
+            head = head_cache.get(key, stat)
+            if head is None:
+                head = opened.read(0, head_cache.head_size)
+                head_cache.put(key, stat, head)
+            for i in range(offset, len(head), chunk_size):
+                yield head[i:i + chunk_size]
+            offset = max(offset, len(head))
+
+        while offset < stat.st_size:
+            chunk = opened.read(offset, chunk_size)
+            if not chunk:
+                break
+            yield chunk
+            offset += len(chunk)
+        self.close()
+
+    @staticmethod
+    def _paced(chunks, pacer):
+        for chunk in chunks:
+            pacer.wait(len(chunk))
+            yield chunk
+
+    def __iter__(self):
+        if self.pacer:
+            return self._paced(self.chunks, self.pacer)
+        return self.chunks
+
+    def close(self):
+        if not self.released:
+            self.released = True
+            self.opened.release()
+
+
+def warm_head_cache(db, storage):
+    """
+    Reads heads of the most listened songs which fit in the budget
+    into the head cache. Most listened songs are put last, so they
+    are the last to be evicted.
+    Returns number of heads read.
+    """
+    from ad_server.models import Song
+
+    limit = head_cache.budget // head_cache.head_size
+    if not limit:
+        return 0
+    listens = db.func.coalesce(Song.listens_count, 0)
+    filepaths = []
+    for filepath, in db.session.query(Song.filepath)\
+            .filter(~Song.broken)\
+            .order_by(listens.desc(), Song.id)\
+            .limit(limit * 2):
+        if filepath not in filepaths:
+            filepaths.append(filepath)
+    filepaths = filepaths[:limit]
+
+    read = 0
+    for filepath in reversed(filepaths):
+        path = storage.resolve(filepath)
+        try:
+            with open(path, 'rb') as f:
+                stat = os.fstat(f.fileno())
+                if head_cache.has(filepath, stat):
+                    continue
+                head_cache.put(filepath, stat, f.read(head_cache.head_size))
+        except OSError:
+            continue
+        read += 1
+    return read
+
+
+class HeadCacheWarmer(threading.Thread):
+    """
+    Background thread which fills the head cache with the most listened
+    songs on start and every interval seconds, following changes
+    in popularity.
+    """
+
+    def __init__(self, app, interval):
+        super().__init__(name='head-cache-warmer', daemon=True)
+        self.app = app
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        self.warm()
+        while not self.stopped.wait(self.interval):
+            self.warm()
+
+    def warm(self):
+        from ad_server import db
+        from ad_server.utils.storage import get_media_storage
+
+        with self.app.app_context():
+            try:
+                return warm_head_cache(db, get_media_storage())
+            except SQLAlchemyError as e:
+                db.session.rollback()
+                self.app.logger.error(f'Head cache warm up failed: {e!r}')
+                return 0
+
+    def stop(self):
+        self.stopped.set()
+
+
+def start_head_cache_warmer(app):
+    interval = app.config.get('HEAD_CACHE_REFRESH')
+    if not interval or not app.config.get('HEAD_CACHE_SIZE'):
+        return None
+    warmer = HeadCacheWarmer(app, interval)
+    warmer.start()
+    return warmer
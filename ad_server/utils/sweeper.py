@@ -0,0 +1,53 @@
+import threading
+from sqlalchemy.exc import SQLAlchemyError
+from ad_server.models import RefreshToken, RevokedToken
+from ad_server.config import ScriptConfig
+from ad_server import db, create_app
+
+
+class TokenSweeper(threading.Thread):
+    """
+    Background thread which deletes expired refresh tokens
+    and revocations of expired access tokens every interval seconds.
+    """
+
+    def __init__(self, app, interval, batch_size=1000):
+        super().__init__(name='token-sweeper', daemon=True)
+        self.app = app
+        self.interval = interval
+        self.batch_size = batch_size
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sweep()
+
+    def sweep(self):
+        with self.app.app_context():
+            try:
+                return RefreshToken.delete_expired(self.batch_size) + \
+                    RevokedToken.delete_expired(self.batch_size)
+            except SQLAlchemyError as e:
+                db.session.rollback()
+                self.app.logger.error(f'Refresh tokens sweep failed: {e!r}')
+                return 0
+
+    def stop(self):
+        self.stopped.set()
+
+
+def start_token_sweeper(app):
+    interval = app.config.get('TOKEN_SWEEP_INTERVAL')
+    if not interval:
+        return None
+    sweeper = TokenSweeper(
+        app, interval, app.config.get('TOKEN_SWEEP_BATCH_SIZE', 1000))
+    sweeper.start()
+    return sweeper
+
+
+if __name__ == '__main__':
+    app = create_app(ScriptConfig)
+    deleted = TokenSweeper(
+        app, 0, ScriptConfig.TOKEN_SWEEP_BATCH_SIZE).sweep()
+    print(f'Deleted {deleted} expired tokens')
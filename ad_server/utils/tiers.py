@@ -0,0 +1,178 @@
+import os
+import uuid
+import fcntl
+import shutil
+import argparse
+import threading
+from sqlalchemy.exc import SQLAlchemyError
+from ad_server.config import ScriptConfig
+
+
+def tier_keys(tier):
+    """
+    Returns set of keys of files stored on a tier.
+    """
+    keys = set()
+    for folder, _, files in os.walk(tier.root):
+        for name in files:
+            if not name.endswith('.tmp'):
+                keys.add(tier.key_of(os.path.join(folder, name)))
+    return keys
+
+
+def copy_to_tier(storage, tier, key):
+    """
+    Copies file stored under key onto the tier. The copy is written
+    under a temporary name first, so readers never see a partial file.
+    It keeps modification time of the source, so it is the same file
+    to anything comparing stat results.
+    """
+    source = storage.path(key)
+    target = tier.path(key)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp_target = f'{target}.{uuid.uuid4().hex}.tmp'
+    try:
+        shutil.copy2(source, tmp_target)
+        if os.path.getsize(tmp_target) != os.path.getsize(source):
+            raise OSError(f'{source} has changed while copied')
+        os.replace(tmp_target, target)
+    except OSError:
+        if os.path.exists(tmp_target):
+            os.remove(tmp_target)
+        raise
+
+
+def plan_tiers(db, storage):
+    """
+    Returns list of sets of keys which belong on every tier.
+    Files are ranked by listens of their songs, every file is placed
+    on the fastest tier which has room for it. Songs which have never
+    been listened to and files referred to by absolute path stay
+    in the library only.
+    """
+    from ad_server.models import Song, MediaFile
+
+    room = [budget for _, budget in storage.tiers]
+    planned = [set() for _ in storage.tiers]
+    listens = db.func.sum(db.func.coalesce(Song.listens_count, 0))
+    ranked = db.session.query(Song.filepath, MediaFile.size)\
+        .outerjoin(MediaFile, MediaFile.path == Song.filepath)\
+        .filter(~Song.broken)\
+        .group_by(Song.filepath, MediaFile.size)\
+        .having(listens > 0)\
+        .order_by(listens.desc(), Song.filepath)\
+        .yield_per(1000)
+    for key, size in ranked:
+        if not any(room):
+            break
+        if os.path.isabs(key):
+            continue
+        if size is None:
+            try:
+                size = os.path.getsize(storage.path(key))
+            except OSError:
+                continue
+        for i, left in enumerate(room):
+            if size <= left:
+                room[i] -= size
+                planned[i].add(key)
+                break
+    return planned
+
+
+def rebalance_tiers(db, storage):
+    """
+    Promotes copies of the most listened songs onto the storage tiers
+    and demotes copies of songs which have cooled down, see plan_tiers.
+    Files are removed before copying, so tiers stay within budget.
+    Returns dict with numbers of promoted, demoted and failed files.
+    """
+    planned = plan_tiers(db, storage)
+    db.session.rollback()
+    stored = [tier_keys(tier) for tier, _ in storage.tiers]
+    report = {'promoted': 0, 'demoted': 0, 'failed': 0}
+
+    for (tier, _), keys, wanted in zip(storage.tiers, stored, planned):
+        for key in keys - wanted:
+            # Open descriptors of readers stay valid, new readers
+            # resolve the file on a slower tier
+            try:
+                os.remove(tier.path(key))
+                report['demoted'] += 1
+            except FileNotFoundError:
+                pass
+
+    for (tier, _), keys, wanted in zip(storage.tiers, stored, planned):
+        for key in wanted - keys:
+            try:
+                copy_to_tier(storage, tier, key)
+                report['promoted'] += 1
+            except OSError:
+                report['failed'] += 1
+    return report
+
+
+class TierBalancer(threading.Thread):
+    """
+    Background thread which rebalances storage tiers
+    every interval seconds.
+    Only one process at a time does the work, others skip their turn.
+    """
+
+    def __init__(self, app, interval):
+        super().__init__(name='tier-balancer', daemon=True)
+        self.app = app
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.rebalance()
+
+    def rebalance(self):
+        from ad_server import db
+        from ad_server.utils.storage import get_media_storage
+
+        with self.app.app_context():
+            storage = get_media_storage()
+            lock_path = os.path.join(storage.root, '.tiers.lock')
+            try:
+                with open(lock_path, 'a') as lock:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return rebalance_tiers(db, storage)
+            except BlockingIOError:
+                return None
+            except (OSError, SQLAlchemyError) as e:
+                db.session.rollback()
+                self.app.logger.error(
+                    f'Storage tiers rebalance failed: {e!r}')
+                return None
+
+    def stop(self):
+        self.stopped.set()
+
+
+def start_tier_balancer(app):
+    interval = app.config.get('STORAGE_TIER_INTERVAL')
+    if not interval or not app.config.get('STORAGE_TIERS'):
+        return None
+    balancer = TierBalancer(app, interval)
+    balancer.start()
+    return balancer
+
+
+if __name__ == '__main__':
+    from ad_server import create_app
+
+    parser = argparse.ArgumentParser(
+        description='Places copies of the most listened songs '
+                    'on the storage tiers')
+    parser.parse_args()
+
+    app = create_app(ScriptConfig)
+    report = TierBalancer(app, 0).rebalance()
+    if report is None:
+        print('Rebalance is already running or has failed')
+    else:
+        print(f'Promoted: {report["promoted"]}, '
+              f'demoted: {report["demoted"]}, failed: {report["failed"]}')
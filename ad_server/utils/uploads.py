@@ -0,0 +1,176 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import hashlib
+from werkzeug.utils import secure_filename
+from ad_server.utils.cache import TTLCache
+from ad_server.views.error import UploadError, UploadOffsetError
+
+
+# Hashes of uploads in progress keyed by upload id, as (offset, hash).
+# When a chunk comes to another worker, hash is recomputed from the file.
+hashers = TTLCache(maxsize=256, ttl=3600)
+
+
+def read_chunks(stream, chunk_size):
+    chunk = stream.read(chunk_size)
+    while chunk:
+        yield chunk
+        chunk = stream.read(chunk_size)
+
+
+class UploadStore:
+    """
+    Uploads in progress kept as files in a folder.
+    Every upload has a data file with its content so far
+    and a json file with name and expected size.
+    """
+
+    def __init__(self, folder, chunk_size=64 * 1024, max_size=None,
+                 expires_in=24 * 3600):
+        self.folder = folder
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+        self.expires_in = expires_in
+        os.makedirs(folder, exist_ok=True)
+
+    def _path(self, upload_id, ext):
+        # Ids come from clients, so only ids made here are accepted
+        try:
+            upload_id = uuid.UUID(upload_id).hex
+        except (ValueError, TypeError, AttributeError):
+            raise UploadError('Unknown upload')
+        return os.path.join(self.folder, f'{upload_id}.{ext}')
+
+    def create(self, filename, size):
+        """
+        Starts new upload. Returns its id.
+        """
+        filename = secure_filename(filename or '')
+        if os.path.splitext(filename)[1] != '.mp3':
+            raise UploadError('Only mp3 files can be uploaded')
+        if size is not None and self.max_size and size > self.max_size:
+            raise UploadError(f'File is larger than {self.max_size} bytes')
+        self.purge()
+
+        upload_id = uuid.uuid4().hex
+        with open(self._path(upload_id, 'json'), 'w') as f:
+            json.dump({'filename': filename, 'size': size}, f)
+        open(self._path(upload_id, 'part'), 'wb').close()
+        return upload_id
+
+    def info(self, upload_id):
+        """
+        Returns dict with filename, expected size and current offset.
+        """
+        try:
+            with open(self._path(upload_id, 'json')) as f:
+                info = json.load(f)
+            info['offset'] = os.path.getsize(self._path(upload_id, 'part'))
+        except OSError:
+            raise UploadError('Unknown upload')
+        return info
+
+    def append(self, upload_id, offset, stream):
+        """
+        Writes stream to the upload starting at offset,
+        reading it in chunks. Returns new offset.
+        """
+        info = self.info(upload_id)
+        limit = info['size'] or self.max_size
+        with open(self._path(upload_id, 'part'), 'ab') as f:
+            # Other worker may be writing the same upload
+            fcntl.flock(f, fcntl.LOCK_EX)
+            current = f.seek(0, os.SEEK_END)
+            if offset != current:
+                raise UploadOffsetError(current)
+
+            known = hashers.get(upload_id)
+            if known and known[0] == current:
+                digest = known[1]
+            else:
+                digest = self._hash_file(upload_id, current)
+
+            for chunk in read_chunks(stream, self.chunk_size):
+                if limit and current + len(chunk) > limit:
+                    f.truncate(offset)
+                    hashers.pop(upload_id)
+                    raise UploadError(f'File is larger than {limit} bytes')
+                f.write(chunk)
+                digest.update(chunk)
+                current += len(chunk)
+            f.flush()
+        hashers.set(upload_id, (current, digest))
+        return current
+
+    def _hash_file(self, upload_id, length):
+        digest = hashlib.sha256()
+        with open(self._path(upload_id, 'part'), 'rb') as f:
+            for chunk in read_chunks(f, self.chunk_size):
+                digest.update(chunk[:length])
+                length -= len(chunk)
+                if length <= 0:
+                    break
+        return digest
+
+    def finish(self, upload_id):
+        """
+        Completes upload. Returns tuple (path of the uploaded file,
+        filename, sha256 hex digest of its content).
+        File must be moved or deleted by the caller.
+        """
+        info = self.info(upload_id)
+        if info['size'] is not None and info['offset'] != info['size']:
+            raise UploadError(
+                f'Upload is incomplete: {info["offset"]} '
+                f'of {info["size"]} bytes')
+
+        known = hashers.pop(upload_id)
+        if known and known[0] == info['offset']:
+            digest = known[1]
+        else:
+            digest = self._hash_file(upload_id, info['offset'])
+        os.remove(self._path(upload_id, 'json'))
+        return (
+            self._path(upload_id, 'part'),
+            info['filename'],
+            digest.hexdigest())
+
+    def cancel(self, upload_id):
+        hashers.pop(upload_id)
+        for ext in ('json', 'part'):
+            try:
+                os.remove(self._path(upload_id, ext))
+            except OSError:
+                pass
+
+    def purge(self):
+        """
+        Deletes uploads which haven't got any data for expires_in seconds.
+        """
+        expired = time.time() - self.expires_in
+        for f in os.listdir(self.folder):
+            upload_id, ext = os.path.splitext(f)
+            if ext != '.json':
+                continue
+            try:
+                changed = os.path.getmtime(self._path(upload_id, 'part'))
+            except OSError:
+                changed = 0
+            if changed < expired:
+                self.cancel(upload_id)
+
+
+def unique_path(folder, filename):
+    """
+    Returns path for filename in folder which isn't taken yet.
+    """
+    name, ext = os.path.splitext(filename)
+    path = os.path.join(folder, filename)
+    i = 1
+    while os.path.exists(path):
+        path = os.path.join(folder, f'{name}_{i}{ext}')
+        i += 1
+    return path
@@ -0,0 +1,336 @@
+import os
+import ctypes
+import ctypes.util
+import json
+import select
+import struct
+import time
+import argparse
+from sqlalchemy.exc import SQLAlchemyError
+from ad_server.config import ScriptConfig
+from ad_server.utils.addsongs import add_songs_to_db
+from ad_server.utils.storage import get_media_storage
+from ad_server import db, create_app
+
+
+# inotify flags, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+event_header = struct.Struct('iIII')
+
+
+def is_audio_file(path):
+    return os.path.splitext(path)[1] == '.mp3' and os.path.isfile(path)
+
+
+class PollingWatcher:
+    """
+    Finds new and changed files by listing the folder on every poll.
+    """
+
+    def __init__(self, folder, interval=1):
+        self.folder = os.path.abspath(folder)
+        self.interval = interval
+        self.known = {}
+
+    def poll(self, timeout):
+        """
+        Waits up to timeout seconds and returns set of changed paths.
+        """
+        time.sleep(min(timeout, self.interval))
+        changed = set()
+        current = {}
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+                current[entry.path] = (stat.st_size, stat.st_mtime_ns)
+                if self.known.get(entry.path) != current[entry.path]:
+                    changed.add(entry.path)
+        self.known = current
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """
+    Gets changed files from linux inotify, without listing the folder.
+    """
+
+    def __init__(self, folder):
+        self.folder = os.path.abspath(folder)
+        libc_name = ctypes.util.find_library('c')
+        if not libc_name:
+            raise OSError('libc is not found')
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify is not supported')
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_MODIFY
+        wd = libc.inotify_add_watch(
+            self.fd, os.fsencode(self.folder), mask)
+        if wd < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+
+    def poll(self, timeout):
+        changed = set()
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return changed
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+        offset = 0
+        while offset < len(data):
+            _, _, _, length = event_header.unpack_from(data, offset)
+            offset += event_header.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if name:
+                changed.add(os.path.join(self.folder, os.fsdecode(name)))
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def make_watcher(folder, polling=False):
+    """
+    Returns inotify watcher if it is available, polling watcher otherwise.
+    """
+    if not polling:
+        try:
+            return InotifyWatcher(folder)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(folder)
+
+
+class IngestDaemon:
+    """
+    Watches drop folder and imports files put there.
+
+    File is considered complete when its size and modification time
+    haven't changed for settle seconds. Complete files are imported in
+    batches of up to batch_size, or as soon as no more files are coming.
+    Every batch is an import job, so a batch interrupted by a crash
+    is resumed with the next one.
+    Daemon state is written to status_file as json after every cycle.
+    Failed cycles are logged and reported in the status, daemon backs
+    off up to max_backoff seconds and tries again.
+    """
+
+    def __init__(self, app, folder, storage, status_file, settle=2,
+                 batch_size=100, workers=None, polling=False,
+                 max_backoff=60):
+        self.app = app
+        self.folder = os.path.abspath(folder)
+        self.storage = storage
+        self.status_file = status_file
+        self.settle = settle
+        self.batch_size = batch_size
+        self.workers = workers
+        self.max_backoff = max_backoff
+        self.watcher = make_watcher(folder, polling)
+        # path: ((size, mtime), time of the last change)
+        self.pending = {}
+        self.started_at = time.time()
+        self.imported = 0
+        self.failed = 0
+        self.last_batch = None
+        # Number of cycles failed in a row
+        self.errors = 0
+        self.last_error = None
+
+        # Files dropped while daemon wasn't running
+        for f in os.listdir(self.folder):
+            self.update(os.path.join(self.folder, f))
+
+    def track(self, path):
+        if not is_audio_file(path):
+            return
+        stat = os.stat(path)
+        state = (stat.st_size, stat.st_mtime_ns)
+        known = self.pending.get(path)
+        if not known or known[0] != state:
+            self.pending[path] = (state, time.monotonic())
+
+    def update(self, path):
+        """
+        Tracks changed path. Files which can't be read are dropped
+        until they change again.
+        """
+        try:
+            self.track(path)
+        except FileNotFoundError:
+            self.pending.pop(path, None)
+        except OSError as e:
+            self.pending.pop(path, None)
+            self.app.logger.warning(f'Skipping {path}: {e!r}')
+
+    def ready_files(self):
+        """
+        Returns files which haven't changed for settle seconds.
+        """
+        now = time.monotonic()
+        ready = []
+        for path in list(self.pending):
+            self.update(path)
+            if path in self.pending and \
+                    now - self.pending[path][1] >= self.settle:
+                ready.append(path)
+        return ready
+
+    def run_once(self, timeout=1):
+        """
+        Imports files which are ready and writes the status.
+        Returns False if the cycle has failed.
+        """
+        with self.app.app_context():
+            try:
+                for path in self.watcher.poll(timeout):
+                    self.update(path)
+                ready = self.ready_files()
+                if ready:
+                    self.import_batch(ready[:self.batch_size])
+                self.errors = 0
+            except (OSError, SQLAlchemyError) as e:
+                db.session.rollback()
+                self.record_error(e)
+
+        try:
+            self.write_status()
+        except OSError as e:
+            self.record_error(e)
+        return not self.errors
+
+    def record_error(self, e):
+        self.app.logger.error(f'Drop folder import failed: {e!r}')
+        self.errors += 1
+        self.last_error = {'error': repr(e), 'at': time.time()}
+
+    def backoff(self):
+        """
+        Returns seconds to wait after errors in a row.
+        """
+        return min(2 ** (self.errors - 1), self.max_backoff)
+
+    def import_batch(self, files):
+        started = time.monotonic()
+        # Files of an interrupted batch are imported with this one
+        # and counted in it
+        imported, failed = add_songs_to_db(
+            self.folder,
+            db,
+            workers=self.workers,
+            batch_size=self.batch_size,
+            files=files,
+            storage=self.storage)
+        elapsed = time.monotonic() - started
+
+        for path in files:
+            # Failed files stay in the drop folder until they change
+            self.pending.pop(path, None)
+        self.imported += len(imported)
+        self.failed += len(failed)
+        self.last_batch = {
+            'files': len(files),
+            'imported': len(imported),
+            'failed': len(failed),
+            'seconds': round(elapsed, 3),
+            'files_per_second': round(len(files) / elapsed, 2)
+            if elapsed else None,
+            'finished_at': time.time(),
+        }
+
+    def status(self):
+        return {
+            'folder': self.folder,
+            'watcher': type(self.watcher).__name__,
+            'backlog': len(self.pending),
+            'imported': self.imported,
+            'failed': self.failed,
+            'last_batch': self.last_batch,
+            'errors': self.errors,
+            'last_error': self.last_error,
+            'started_at': self.started_at,
+            'updated_at': time.time(),
+        }
+
+    def write_status(self):
+        tmp_file = f'{self.status_file}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.status(), f)
+        os.replace(tmp_file, self.status_file)
+
+    def run(self):
+        try:
+            while True:
+                if not self.run_once():
+                    time.sleep(self.backoff())
+        finally:
+            self.watcher.close()
+
+
+def read_status(status_file, stale_after=10):
+    """
+    Returns status written by a daemon or None if there is no status.
+    Status includes running flag, which is False if the daemon hasn't
+    updated it for stale_after seconds.
+    """
+    try:
+        with open(status_file) as f:
+            status = json.load(f)
+    except (OSError, ValueError):
+        return None
+    status['running'] = time.time() - status['updated_at'] < stale_after
+    return status
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Watches drop folder and adds new files to the database')
+    parser.add_argument(
+        'folder', nargs='?',
+        help='drop folder, defaults to INGEST_DROP_FOLDER or MEDIA_STORAGE')
+    parser.add_argument(
+        '--settle', type=float, default=2,
+        help='seconds a file must stay unchanged before import')
+    parser.add_argument(
+        '--batch-size', type=int, default=100,
+        help='max number of files imported at once')
+    parser.add_argument(
+        '--workers', type=int, default=None,
+        help='number of processes parsing tags, defaults to cpu count')
+    parser.add_argument(
+        '--poll', action='store_true',
+        help='list the folder instead of using inotify')
+    args = parser.parse_args()
+
+    app = create_app(ScriptConfig)
+    with app.app_context():
+        storage = get_media_storage()
+    daemon = IngestDaemon(
+        app,
+        args.folder or app.config.get('INGEST_DROP_FOLDER') or
+        app.config.get('MEDIA_STORAGE'),
+        storage=storage,
+        status_file=app.config.get('INGEST_STATUS_FILE'),
+        settle=args.settle,
+        batch_size=args.batch_size,
+        workers=args.workers,
+        polling=args.poll)
+    daemon.run()
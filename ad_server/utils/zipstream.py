@@ -0,0 +1,202 @@
+import os
+import time
+import struct
+import zlib
+import argparse
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from ad_server.config import ScriptConfig
+
+
+# Entry of an archive. Size and crc32 must be known before streaming,
+# as they are written in front of the file data.
+ZipEntry = namedtuple('ZipEntry', 'name path size crc32 mtime')
+
+local_header = struct.Struct('<IHHHHHIIIHH')
+central_header = struct.Struct('<IHHHHHHIIIHHHHHII')
+end_record = struct.Struct('<IHHHHIIH')
+
+# Zip format 2.0 without zip64 extensions
+VERSION = 20
+# Names are utf-8
+FLAGS = 0x800
+STORED = 0
+MAX_SIZE = 0xffffffff
+
+
+def dos_time(timestamp):
+    """
+    Returns (time, date) of timestamp in ms-dos format.
+    """
+    t = time.localtime(max(timestamp, 315532800))
+    return (
+        (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+        ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+
+def file_crc32(path, chunk_size=1024 * 1024):
+    """
+    Returns crc32 of file content, for files imported without it.
+    """
+    crc = 0
+    with open(path, 'rb') as f:
+        chunk = f.read(chunk_size)
+        while chunk:
+            crc = zlib.crc32(chunk, crc)
+            chunk = f.read(chunk_size)
+    return crc
+
+
+class StoredZip:
+    """
+    Zip archive of files stored without compression, made on the fly.
+
+    Headers are built from entries up front, so the archive length
+    is known before it is sent and any byte range of it can be
+    produced without reading files out of the range.
+    Archives over 4 GiB need zip64 and are not supported.
+    """
+
+    def __init__(self, entries):
+        # Parts of the archive in order, either bytes or ZipEntry
+        # whose file content goes there
+        self.parts = []
+        central = []
+        offset = 0
+        for entry in entries:
+            name = entry.name.encode()
+            mod_time, mod_date = dos_time(entry.mtime)
+            header = local_header.pack(
+                0x04034b50, VERSION, FLAGS, STORED, mod_time, mod_date,
+                entry.crc32, entry.size, entry.size, len(name), 0) + name
+            central.append(central_header.pack(
+                0x02014b50, VERSION, VERSION, FLAGS, STORED,
+                mod_time, mod_date, entry.crc32, entry.size, entry.size,
+                len(name), 0, 0, 0, 0, 0, offset) + name)
+            self.parts.append(header)
+            self.parts.append(entry)
+            offset += len(header) + entry.size
+
+        directory = b''.join(central)
+        self.parts.append(directory + end_record.pack(
+            0x06054b50, 0, 0, len(central), len(central),
+            len(directory), offset, 0))
+        self.length = offset + len(self.parts[-1])
+        if self.length > MAX_SIZE or len(central) > 0xffff:
+            raise ValueError('Archive is too large')
+
+    def iter_range(self, start=0, end=None, chunk_size=64 * 1024):
+        """
+        Yields bytes of the archive from start up to end in chunks.
+        """
+        end = self.length if end is None else min(end, self.length)
+        position = 0
+        for part in self.parts:
+            size = len(part) if isinstance(part, bytes) else part.size
+            part_start = max(start - position, 0)
+            part_end = min(end - position, size)
+            position += size
+            if part_start >= part_end:
+                if position >= end:
+                    break
+                continue
+
+            if isinstance(part, bytes):
+                yield part[part_start:part_end]
+                continue
+            with open(part.path, 'rb') as f:
+                f.seek(part_start)
+                left = part_end - part_start
+                while left > 0:
+                    chunk = f.read(min(chunk_size, left))
+                    if not chunk:
+                        raise OSError(f'{part.path} is shorter '
+                                      'than expected')
+                    left -= len(chunk)
+                    yield chunk
+
+
+def _file_manifest_or_none(path):
+    from ad_server.utils.addsongs import file_digests
+
+    try:
+        stat = os.stat(path)
+        checksum, crc32 = file_digests(path)
+    except OSError:
+        return None
+    return {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+        'checksum': checksum,
+        'crc32': crc32,
+    }
+
+
+def backfill_crc32(db, storage, workers=None, batch_size=100):
+    """
+    Computes crc32 of song files which have none in the media file
+    manifest. Songs imported before the manifest get their entries.
+    Returns number of updated files.
+    """
+    from ad_server.models import Song, MediaFile
+
+    songs = {}
+    for filepath, id in db.session.query(Song.filepath, Song.id)\
+            .outerjoin(MediaFile, MediaFile.path == Song.filepath)\
+            .filter(MediaFile.crc32.is_(None))\
+            .filter(~Song.broken)\
+            .order_by(Song.id):
+        songs.setdefault(filepath, id)
+    filepaths = list(songs)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    updated = 0
+    pool = ProcessPoolExecutor(max_workers=workers) if workers else None
+    try:
+        for i in range(0, len(filepaths), batch_size):
+            batch = filepaths[i:i + batch_size]
+            paths = [storage.path(f) for f in batch]
+            if pool:
+                manifests = pool.map(
+                    _file_manifest_or_none, paths, chunksize=8)
+            else:
+                manifests = map(_file_manifest_or_none, paths)
+            for filepath, manifest in zip(batch, manifests):
+                if manifest is None:
+                    continue
+                known = MediaFile.query.get(filepath)
+                if known:
+                    known.crc32 = manifest['crc32']
+                else:
+                    db.session.add(MediaFile(
+                        path=filepath, song_id=songs[filepath], **manifest))
+                updated += 1
+            db.session.commit()
+    finally:
+        if pool:
+            pool.shutdown()
+    return updated
+
+
+if __name__ == '__main__':
+    from ad_server import db, create_app
+    from ad_server.utils.storage import get_media_storage
+
+    parser = argparse.ArgumentParser(
+        description='Computes crc32 of song files needed by album '
+                    'downloads, for files which have none')
+    parser.add_argument(
+        '--workers', type=int, default=None,
+        help='number of processes reading files, defaults to cpu count')
+    parser.add_argument(
+        '--batch-size', type=int, default=100,
+        help='number of files updated in one transaction')
+    args = parser.parse_args()
+
+    app = create_app(ScriptConfig)
+    with app.app_context():
+        updated = backfill_crc32(
+            db, get_media_storage(), workers=args.workers,
+            batch_size=args.batch_size)
+        print(f'Files updated: {updated}')
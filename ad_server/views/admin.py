@@ -0,0 +1,192 @@
+from flask import Blueprint, current_app, request
+from ad_server.views.auth import token_auth
+from ad_server.views.media import required_params
+from ad_server.views.error import UploadError, UploadOffsetError
+from ad_server.models import MediaFile
+from ad_server.utils.watcher import read_status
+from ad_server.utils.uploads import UploadStore, unique_path
+from ad_server.utils.streaming import head_cache, file_cache
+import ad_server.views.messages as msg
+import os
+
+
+admin = Blueprint('admin', __name__)
+
+
+@admin.route('/ingest/status', methods=['GET'])
+@token_auth.login_required(role='admin')
+def ingest_status():
+    """
+    _server_/admin/ingest/status GET
+    Returns state of the drop folder watcher. Admin only.
+
+    :return: response with fields _status_, _message_, _running_,
+    _backlog_ (files waiting for import), _imported_, _failed_
+    and _last_batch_ with throughput of the latest import
+    """
+    status = read_status(current_app.config.get('INGEST_STATUS_FILE'))
+    if status is None:
+        return msg.errors.not_found('Ingestion daemon has never run')
+    return msg.success('Ingestion status', **status)
+
+
+@admin.route('/cache/stats', methods=['GET'])
+@token_auth.login_required(role='admin')
+def cache_stats():
+    """
+    _server_/admin/cache/stats GET
+    Returns metrics of the stream caches of the worker process
+    which has served the request. Admin only.
+
+    :return: response with fields _status_, _message_, _head_cache_
+    with its budget, size, entries, hits, misses, hit_rate and evictions,
+    and _file_cache_ with number of open files, hits, misses and hit_rate
+    """
+    return msg.success(
+        'Cache stats',
+        head_cache=head_cache.stats(),
+        file_cache=file_cache.stats())
+
+
+def get_upload_store():
+    config = current_app.config
+    return UploadStore(
+        os.path.join(config.get('MEDIA_STORAGE'), 'uploads'),
+        chunk_size=config.get('UPLOAD_CHUNK_SIZE'),
+        max_size=config.get('UPLOAD_MAX_SIZE'))
+
+
+def queue_upload(store, upload_id):
+    """
+    Completes upload and moves the file into the drop folder,
+    unless the same file is already in the library.
+    """
+    path, filename, checksum = store.finish(upload_id)
+
+    known = MediaFile.query.filter_by(checksum=checksum).first()
+    if known:
+        os.remove(path)
+        return msg.success(
+            'File is already in the library',
+            checksum=checksum,
+            song_id=known.song_id)
+
+    config = current_app.config
+    drop_folder = config.get('INGEST_DROP_FOLDER') or \
+        config.get('MEDIA_STORAGE')
+    target = unique_path(drop_folder, filename)
+    os.replace(path, target)
+    return msg.success(
+        'File is queued for import',
+        status_code=201,
+        filename=os.path.basename(target),
+        checksum=checksum)
+
+
+@admin.route('/upload', methods=['PUT'])
+@token_auth.login_required(role='admin')
+@required_params({'filename': str})
+def upload_file(filename):
+    """
+    _server_/admin/upload PUT
+    Uploads audio file in a single request. Request body is the file
+    itself, it is written to disk as it comes. Admin only.
+
+    :param str filename: name of the uploaded mp3 file
+    :return: response with fields _status_, _message_, _filename_
+    and _checksum_ (sha256 of the file). If the file is already in
+    the library, _song_id_ is returned instead of _filename_
+    """
+    store = get_upload_store()
+    try:
+        upload_id = store.create(filename, request.content_length)
+        try:
+            store.append(upload_id, 0, request.stream)
+            return queue_upload(store, upload_id)
+        except UploadError:
+            store.cancel(upload_id)
+            raise
+    except UploadError as e:
+        return msg.errors.bad_request(e.message)
+
+
+@admin.route('/upload/new', methods=['POST'])
+@token_auth.login_required(role='admin')
+@required_params({'filename': str, 'size': int})
+def create_upload(filename, size):
+    """
+    _server_/admin/upload/new POST
+    Starts upload of a file sent in several chunks. Admin only.
+
+    :param str filename: name of the uploaded mp3 file
+    :param int size: size of the whole file in bytes
+    :return: response with fields _status_, _message_, _upload_id_
+    and _offset_
+    """
+    try:
+        upload_id = get_upload_store().create(filename, size)
+    except UploadError as e:
+        return msg.errors.bad_request(e.message)
+    return msg.success(
+        'Upload is created', status_code=201, upload_id=upload_id, offset=0)
+
+
+@admin.route('/upload/chunk', methods=['PUT'])
+@token_auth.login_required(role='admin')
+@required_params({'upload_id': str, 'offset': int})
+def upload_chunk(upload_id, offset):
+    """
+    _server_/admin/upload/chunk PUT
+    Appends request body to the upload. Admin only.
+    Interrupted upload is continued from the offset
+    returned by _server_/admin/upload/status.
+
+    :param str upload_id: id of the upload
+    :param int offset: position of the chunk in the file
+    :return: response with fields _status_, _message_ and _offset_ where
+    the next chunk starts. If offset is wrong, response has status 409
+    and the right offset
+    """
+    try:
+        offset = get_upload_store().append(upload_id, offset, request.stream)
+    except UploadOffsetError as e:
+        return msg.errors.conflict(e.message, offset=e.offset)
+    except UploadError as e:
+        return msg.errors.bad_request(e.message)
+    return msg.success('Chunk is uploaded', offset=offset)
+
+
+@admin.route('/upload/status', methods=['GET'])
+@token_auth.login_required(role='admin')
+@required_params({'upload_id': str})
+def upload_status(upload_id):
+    """
+    _server_/admin/upload/status GET
+    Admin only.
+
+    :param str upload_id: id of the upload
+    :return: response with fields _status_, _message_, _filename_,
+    _size_ and _offset_ (bytes uploaded so far)
+    """
+    try:
+        info = get_upload_store().info(upload_id)
+    except UploadError as e:
+        return msg.errors.not_found(e.message)
+    return msg.success('Upload status', **info)
+
+
+@admin.route('/upload/finish', methods=['POST'])
+@token_auth.login_required(role='admin')
+@required_params({'upload_id': str})
+def finish_upload(upload_id):
+    """
+    _server_/admin/upload/finish POST
+    Completes upload and queues the file for import. Admin only.
+
+    :param str upload_id: id of the upload
+    :return: same response as _server_/admin/upload
+    """
+    try:
+        return queue_upload(get_upload_store(), upload_id)
+    except UploadError as e:
+        return msg.errors.bad_request(e.message)
@@ -1,13 +1,37 @@
 from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth
-from ad_server.models import User
+from ad_server.models import User, RevokedToken
+from ad_server import db, password_hasher
+from ad_server.views.error import HasherBusyError
+from ad_server.utils.cache import TTLCache
 from flask import g, current_app
 from datetime import datetime, timedelta
+from collections import namedtuple
 import ad_server.views.messages as msg
+import hashlib
+import time
+import uuid
 import jwt
 
 
 basic_auth = HTTPBasicAuth()
 token_auth = HTTPTokenAuth()
+# Claims only authentication for views which need nothing but user id.
+# Touches the database only to check now and then if the token
+# has been revoked.
+claims_auth = HTTPTokenAuth()
+
+# Stands for the user in views protected by claims_auth
+Principal = namedtuple('Principal', ['id'])
+
+# Claims of already verified tokens keyed by token digest.
+# Every entry lives until its token expires. Cache is per process,
+# so revocations are kept in the database, see RevokedToken.
+token_cache = TTLCache(maxsize=4096)
+
+# Ids of tokens found not revoked, keyed by jti. Every entry lives
+# for TOKEN_REVOCATION_CHECK_INTERVAL seconds, so the database
+# is asked about a token at most once per interval.
+revocation_cache = TTLCache(maxsize=4096, ttl=30)
 
 
 def generate_token(user_id, expires_in=timedelta(hours=24)):
@@ -22,17 +46,76 @@ def generate_token(user_id, expires_in=timedelta(hours=24)):
         )
     payload = {
         'id': user_id,
-        'exp': datetime.utcnow() + delta
+        'exp': datetime.utcnow() + delta,
+        # Unique token id, so revoking one token never hits another
+        # issued for the same user within the same second
+        'jti': uuid.uuid4().hex
         }
     secret = current_app.config.get('SECRET_KEY')
     return jwt.encode(payload, secret, algorithm='HS256')
 
 
+def token_digest(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def token_id(token, payload):
+    """
+    Returns jti claim of the token, digest of tokens issued without it.
+    """
+    return payload.get('jti') or token_digest(token)
+
+
+def decode_token(token):
+    """
+    Verifies token and returns its claims.
+    Signature is checked only once per token, after that claims
+    are taken from token_cache until token expires. Revocation is
+    checked in the database once per TOKEN_REVOCATION_CHECK_INTERVAL
+    seconds, see revocation_cache. A token revoked by this worker
+    is rejected right away, by other workers within the interval.
+    """
+    digest = token_digest(token)
+    payload = token_cache.get(digest)
+    if payload is None:
+        secret = current_app.config.get('SECRET_KEY')
+        payload = jwt.decode(token, secret, algorithms='HS256')
+        exp = payload.get('exp')
+        ttl = exp - time.time() if exp else None
+        token_cache.set(digest, payload, ttl=ttl)
+    jti = token_id(token, payload)
+    if jti not in revocation_cache:
+        if RevokedToken.is_revoked(jti):
+            token_cache.pop(digest)
+            raise jwt.InvalidTokenError('Token has been revoked')
+        revocation_cache.set(jti, True)
+    return payload
+
+
+def revoke_access_token(token):
+    """
+    Rejects valid access token by all workers until it expires.
+    Revocation is added to the session, caller commits it.
+    Returns False if token is not valid anyway.
+    """
+    try:
+        payload = decode_token(token)
+    except jwt.InvalidTokenError:
+        return False
+    token_cache.pop(token_digest(token))
+    revocation_cache.pop(token_id(token, payload))
+    exp = payload.get('exp')
+    # Tokens without expiration are kept for the longest token lifetime
+    expiration_date = datetime.utcfromtimestamp(exp) if exp else \
+        datetime.utcnow() + timedelta(weeks=24)
+    RevokedToken.revoke(token_id(token, payload), expiration_date)
+    return True
+
+
 def validate_token(token):
-    secret = current_app.config.get('SECRET_KEY')
-    payload = jwt.decode(token, secret, algorithms='HS256')
+    payload = decode_token(token)
     id = payload.get('id')
-    return User.query.get(int(id))
+    return User.get_cached(int(id))
 
 
 @basic_auth.verify_password
@@ -41,13 +124,25 @@ def verify_user(login, password):
     if user:
         # Store this user in request context
         g.current_user = user
-        return user.check_password(password)
+        try:
+            valid, new_hash = password_hasher.verify(user.pass_hash, password)
+        except HasherBusyError as e:
+            g.auth_exception = e
+            return False
+        # Hashing method has changed since this hash was made
+        if new_hash:
+            user.pass_hash = new_hash
+            db.session.commit()
+        return valid
     else:
         return False
 
 
 @basic_auth.error_handler
 def basic_auth_error():
+    if isinstance(g.get('auth_exception'), HasherBusyError):
+        return msg.errors.too_many_requests(
+            'Server is busy. Please try later', retry_after=1)
     return msg.errors.unauthorized('Invalid credentials')
 
 
@@ -64,8 +159,32 @@ def verify_token(token):
         return False
 
 
-@token_auth.error_handler
-def token_auth_error():
+@token_auth.get_user_roles
+def get_user_roles(auth):
+    if g.current_user.is_admin:
+        return 'admin'
+    return None
+
+
+@claims_auth.verify_token
+def verify_claims(token):
+    if token:
+        try:
+            payload = decode_token(token)
+            g.current_user = Principal(id=int(payload.get('id')))
+            return True
+        except (jwt.InvalidTokenError, jwt.ExpiredSignatureError) as e:
+            g.token_exception = e
+            return False
+        except (TypeError, ValueError):
+            return False
+    else:
+        return False
+
+
+def token_auth_error(status=401):
+    if status == 403:
+        return msg.errors.forbidden('Operation is forbidden')
     try:
         excp = g.token_exception
         if isinstance(excp, jwt.ExpiredSignatureError):
@@ -74,3 +193,7 @@ def token_auth_error():
             return msg.errors.unauthorized('Invalid token')
     except AttributeError:
         return msg.errors.unauthorized('Token verification failed')
+
+
+token_auth.error_handler(token_auth_error)
+claims_auth.error_handler(token_auth_error)
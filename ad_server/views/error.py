@@ -1,3 +1,30 @@
 class RefreshTokenError(Exception):
     def __init__(self, message):
-        self.message = message
\ No newline at end of file
+        self.message = message
+
+
+class HasherBusyError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+class UploadError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+class UploadOffsetError(UploadError):
+    """
+    Chunk doesn't start where the upload has stopped.
+    """
+    def __init__(self, offset):
+        self.message = f'Upload continues from offset {offset}'
+        self.offset = offset
+
+
+class SongFileError(Exception):
+    """
+    Song file exists, but can't be opened right now.
+    """
+    def __init__(self, message):
+        self.message = message
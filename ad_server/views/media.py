@@ -1,17 +1,30 @@
-from flask import Blueprint, request, g
-from ad_server.views.auth import token_auth
-from ad_server.models import Song, Album, Playlist, Genre, User
-from ad_server import db
-from flask import Response
+from flask import Blueprint, request, g, current_app, url_for
+from ad_server.views.auth import token_auth, claims_auth
+from ad_server.views.error import SongFileError
+from ad_server.models import Song, Album, Playlist, Genre, User, MediaFile
+from ad_server.utils.covers import get_cover_store, image_type
+from ad_server.utils.storage import get_media_storage
+from ad_server.utils import mp3index, hls, signed_urls, zipstream
+from ad_server.utils.listens import listen_counter
+from ad_server.utils.streaming import FileStream, Pacer, file_cache
+from ad_server import db, limiter
+from flask import Response, send_file
 from functools import wraps
 from sqlalchemy.exc import SQLAlchemyError
 import ad_server.views.messages as msg
+import time
+import hashlib
 import os
 
 
 media = Blueprint('media', __name__)
 
 
+@media.errorhandler(SongFileError)
+def song_file_error(e):
+    return msg.errors.service_unavailable(e.message, retry_after=5)
+
+
 def required_params(required):
     """
     Decorator for view functions.
@@ -154,7 +167,118 @@ def album_songs(id):
     )
 
 
+def archive_name(name):
+    """
+    Returns name usable as a file name inside an archive.
+    """
+    name = ''.join('_' if c in '/\\:*?"<>|' or ord(c) < 32 else c
+                   for c in name).strip(' .')
+    return name or 'unknown'
+
+
+def album_archive_entries(album):
+    """
+    Returns ZipEntry list of playable songs of the album, or None
+    if crc32 of some of their files is not in the media file manifest
+    yet, see zipstream.backfill_crc32.
+    Sizes and times are taken from the manifest, so the archive
+    is the same whichever storage tier files are read from.
+    """
+    songs = [s for s in album.songs if not s.broken]
+    manifest = {
+        f.path: f for f in MediaFile.query.filter(
+            MediaFile.path.in_({s.filepath for s in songs}))
+    }
+    storage = get_media_storage()
+    folder = archive_name(album.title)
+    entries = []
+    names = set()
+    for song in songs:
+        known = manifest.get(song.filepath)
+        if known is None or known.crc32 is None:
+            return None
+        name = f'{song.album_position or 0:02d} - {archive_name(song.title)}'
+        if name in names:
+            name = f'{name} ({song.id})'
+        names.add(name)
+        entries.append(zipstream.ZipEntry(
+            f'{folder}/{name}.mp3', storage.resolve(song.filepath),
+            known.size, known.crc32, known.mtime / 1e9))
+    return entries
+
+
+@media.route('/album/download', methods=['GET'])
+@limiter.limit('10/minute')
+@required_params({'id': int})
+def download_album(id):
+    """
+    _server_/media/album/download GET
+    Returns zip archive with songs of an album. Files are stored without
+    compression and the archive is streamed as it is made, so its length
+    is known up front and interrupted downloads are resumed with Range.
+    Downloads are not counted as listens. Crc32 of files must be
+    in the media file manifest, which is filled on import or by
+    the zipstream backfill.
+
+    :param int id: id of an album
+    :return: response with content type 'application/zip'
+    """
+    album = Album.query.get(id)
+    if not album:
+        return msg.errors.bad_request('Invalid id provided')
+    entries = album_archive_entries(album)
+    if entries is None:
+        current_app.logger.warning(
+            f'Album {album.id} has files without crc32, '
+            'run zipstream backfill')
+        return msg.errors.service_unavailable(
+            'Album download is not available yet')
+    if not entries:
+        return msg.errors.not_found(f'Songs not found for album {album.title}')
+    try:
+        archive = zipstream.StoredZip(entries)
+    except ValueError:
+        return msg.errors.bad_request('Album is too large to download')
+
+    etag = hashlib.sha1(repr([
+        (e.name, e.size, e.crc32, e.mtime) for e in entries
+    ]).encode()).hexdigest()
+    status = 200
+    start, end = 0, archive.length
+    byte_range = request.range
+    # Range of an archive which has changed since is not sent,
+    # if-range dates are not trusted as archives are made on the fly.
+    # Multiple ranges are not supported, whole archive is sent instead.
+    if_range = request.headers.get('If-Range')
+    if byte_range and len(byte_range.ranges) == 1 and \
+            (not if_range or request.if_range.etag == etag):
+        bounds = byte_range.range_for_length(archive.length)
+        if bounds is None:
+            response = Response(status=416)
+            response.headers['Content-Range'] = f'bytes */{archive.length}'
+            return response
+        start, end = bounds
+        status = 206
+
+    response = Response(
+        archive.iter_range(
+            start, end, current_app.config.get('STREAM_CHUNK_SIZE')),
+        status=status,
+        mimetype='application/zip')
+    response.headers['Content-Length'] = end - start
+    response.headers['Accept-Ranges'] = 'bytes'
+    if status == 206:
+        response.headers['Content-Range'] = \
+            f'bytes {start}-{end - 1}/{archive.length}'
+    response.set_etag(etag)
+    response.headers.set(
+        'Content-Disposition', 'attachment',
+        filename=f'{archive_name(album.title)}.zip')
+    return response
+
+
 @media.route('/song/title', methods=['GET'])
+@limiter.limit('30/minute')
 @required_params({'title': str})
 def songs_by_title(title):
     """
@@ -187,6 +311,7 @@ def songs_by_title(title):
 
 
 @media.route('/song/artist', methods=['GET'])
+@limiter.limit('30/minute')
 @required_params({'title': str})
 def songs_by_artist(title):
     """
@@ -218,43 +343,383 @@ def songs_by_artist(title):
     )
 
 
+def open_storage_file(cache_key, key):
+    """
+    Returns OpenFile of the fastest copy of the file stored under key.
+    Raises OSError if the file can't be opened.
+    """
+    storage = get_media_storage()
+    path = storage.resolve(key)
+    try:
+        return file_cache.open(cache_key, path)
+    except OSError:
+        if path == storage.path(key):
+            raise
+        # Copy has been demoted since it was resolved
+        return file_cache.open(cache_key, storage.path(key))
+
+
+def open_storage_error(key, e):
+    """
+    Returns SongFileError for a file which exists but has failed
+    to open, e.g. out of descriptors or a storage hiccup.
+    """
+    current_app.logger.error(f'Failed to open {key}: {e!r}')
+    return SongFileError('Song file is temporarily unavailable')
+
+
+def open_song_file(song):
+    """
+    Returns OpenFile of the song file from the file cache, which must
+    be released after use, or None if the song is broken.
+    Files found bad by the integrity scanner are not looked up,
+    song whose file has gone is flagged broken. Other errors are
+    not the file's fault, they raise SongFileError and leave
+    the song as it is.
+    """
+    if song.broken:
+        return None
+    try:
+        return open_storage_file(song.id, song.filepath)
+    except FileNotFoundError:
+        song.broken = True
+        db.session.commit()
+        return None
+    except OSError as e:
+        raise open_storage_error(song.filepath, e)
+
+
+def song_segments(song, song_file):
+    return hls.segments(
+        song.seek_table,
+        (song.duration or 0) * 1000,
+        song_file.stat.st_size,
+        current_app.config.get('HLS_SEGMENT_DURATION') * 1000,
+        read=song_file.read)
+
+
+def stream_pacer(song, file_size):
+    """
+    Returns Pacer which lets the song stream a little faster
+    than it plays, None if its bitrate is unknown.
+    """
+    bitrate = song.bitrate
+    if not bitrate and song.duration:
+        # Songs added before bitrate was stored
+        bitrate = file_size * 8 // song.duration
+    if not bitrate:
+        return None
+    config = current_app.config
+    rate = bitrate / 8
+    return Pacer(
+        rate * config.get('STREAM_PACING_FACTOR'),
+        burst=rate * config.get('STREAM_PACING_BURST'))
+
+
 @media.route('/song/play', methods=['GET'])
+@limiter.limit('60/minute')
 @required_params({'id': int})
 def stream_song(id):
     """
     _server_/media/song/play GET
     Streams song specified by id.
+    If time is given, stream starts at the frame playing at that time,
+    found in the seek table of the song. Actual start time is returned
+    in X-Start-Time header.
 
     :param int id: id of a song
+    :param float t: optional time in seconds to start from
     :return: response with content type 'audio/mpeg' which contains stream of an audio file
     """
 
-    # Get song filepath from db and increment listens count
-    song_file = Song.play_song(id)
+    song = Song.query.get(id)
+    if not song:
+        return msg.errors.bad_request('Invalid id provided')
+    key = song.filepath
+    start_ms, offset = 0, 0
+    t = request.args.get('t', type=float)
+    if t and t > 0:
+        start_ms, offset = mp3index.seek(song.seek_table, int(t * 1000))
+
+    song_file = open_song_file(song)
     if not song_file:
+        return msg.errors.not_found('Song file is unavailable')
+    pacer = None
+    if current_app.config.get('STREAM_PACING'):
+        pacer = stream_pacer(song, song_file.stat.st_size)
+    try:
+        # Increment listens count, song is already in the session
+        Song.play_song(id)
+        db.session.commit()
+    except Exception:
+        song_file.release()
+        raise
+
+    # Start of popular songs is served from memory,
+    # file is released when the response is closed.
+    # Stream is passed to the server as is, so the async server
+    # can tell it from other responses, see utils.asgi
+    response = Response(
+        FileStream(
+            song_file, offset, key=key,
+            chunk_size=current_app.config.get('STREAM_CHUNK_SIZE'),
+            pacer=pacer),
+        status=200,
+        mimetype='audio/mpeg',
+        direct_passthrough=True)
+    response.headers['Content-Length'] = song_file.stat.st_size - offset
+    response.headers['X-Start-Time'] = start_ms / 1000
+    return response
+
+
+def stream_url_secret():
+    config = current_app.config
+    return config.get('STREAM_URL_SECRET') or config.get('SECRET_KEY')
+
+
+def is_play_start():
+    """
+    Tells if the request starts a play of the song. Players and the
+    reverse proxy fetch the rest of a song with range requests,
+    those are parts of the same listen.
+    """
+    byte_range = request.range
+    # No Range header or one which is ignored, whole file is sent
+    if byte_range is None:
+        return True
+    return byte_range.ranges[0][0] == 0
+
+
+@media.route('/song/url', methods=['GET'])
+@limiter.limit('60/minute')
+@required_params({'id': int})
+def song_stream_url(id):
+    """
+    _server_/media/song/url GET
+    Returns signed stream url of the song specified by id.
+    Url embeds storage key of the song file and expiration time,
+    so the file is served by /stream without database queries
+    and may be cached by proxies until it expires. Listens are counted
+    when the stream is served.
+    Songs whose files are stored outside the media storage
+    get /song/play url instead.
+
+    :param int id: id of a song
+    :return: response with fields _status_, _message_, _url_ and
+    _expires_ - unix time after which url is not valid
+    """
+    song = Song.query.get(id)
+    if not song:
+        return msg.errors.bad_request('Invalid id provided')
+    if song.broken:
+        return msg.errors.not_found('Song file is unavailable')
+
+    key = song.filepath
+    if os.path.isabs(key):
+        return msg.success(
+            'Stream url', url=url_for('media.stream_song', id=id),
+            expires=None)
+
+    expires = signed_urls.expiration(
+        current_app.config.get('STREAM_URL_TTL'))
+    url = url_for(
+        'media.signed_stream',
+        key=key,
+        song=id,
+        expires=expires,
+        sig=signed_urls.signature(stream_url_secret(), key, id, expires))
+    return msg.success('Stream url', url=url, expires=expires)
+
+
+@media.route('/stream/<path:key>', methods=['GET'])
+@limiter.limit('60/minute', per='url')
+def signed_stream(key):
+    """
+    _server_/media/stream/<key> GET
+    Streams file by a url signed by /song/url, without database queries.
+    If STREAM_ACCEL_PREFIX is set, file is sent by the reverse proxy
+    with X-Accel-Redirect after the url is verified here.
+    Range requests past the start of the file are not counted
+    as listens.
+
+    :param int song: id of the song
+    :param int expires: unix time of url expiration
+    :param str sig: signature of the url
+    :return: response with content type 'audio/mpeg'
+    """
+    args = request.args
+    song_id = args.get('song', type=int)
+    expires = args.get('expires', type=int)
+    if song_id is None or not signed_urls.verify(
+            stream_url_secret(), key, song_id, expires, args.get('sig')):
+        return msg.errors.forbidden('Url is invalid or has expired')
+
+    config = current_app.config
+    accel_prefix = config.get('STREAM_ACCEL_PREFIX')
+    if accel_prefix:
+        response = Response(status=200, mimetype='audio/mpeg')
+        response.headers['X-Accel-Redirect'] = \
+            f'{accel_prefix.rstrip("/")}/{key}'
+    else:
+        try:
+            song_file = open_storage_file(key, key)
+        except FileNotFoundError:
+            return msg.errors.not_found('Song file is unavailable')
+        except OSError as e:
+            raise open_storage_error(key, e)
+        response = Response(
+            FileStream(
+                song_file, key=key,
+                chunk_size=config.get('STREAM_CHUNK_SIZE')),
+            status=200,
+            mimetype='audio/mpeg',
+            direct_passthrough=True)
+        response.headers['Content-Length'] = song_file.stat.st_size
+
+    if is_play_start():
+        listen_counter.add(song_id)
+    response.cache_control.public = True
+    response.cache_control.max_age = max(expires - int(time.time()), 0)
+    return response
+
+
+@media.route('/song/preview', methods=['GET'])
+@limiter.limit('120/minute')
+@required_params({'id': int})
+def song_preview(id):
+    """
+    _server_/media/song/preview GET
+    Returns preview clip of the song specified by id, about 30 seconds
+    starting at 30% of the song. Clip byte range is found on import,
+    so it is sent with a single read. Previews are not counted
+    as listens.
+
+    :param int id: id of a song
+    :return: response with content type 'audio/mpeg'
+    """
+    song = Song.query.get(id)
+    if not song:
         return msg.errors.bad_request('Invalid id provided')
+    if song.preview_start is None:
+        return msg.errors.not_found('Preview is not available')
+    start, end = song.preview_start, song.preview_end
+    song_file = open_song_file(song)
+    if not song_file:
+        return msg.errors.not_found('Song file is unavailable')
+    with song_file:
+        data = song_file.read(start, end - start)
+
+    response = Response(data, status=200, mimetype='audio/mpeg')
+    response.cache_control.public = True
+    response.cache_control.max_age = \
+        current_app.config.get('PREVIEW_MAX_AGE')
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+@media.route('/song/playlist', methods=['GET'])
+@limiter.limit('60/minute')
+@required_params({'id': int})
+def song_playlist(id):
+    """
+    _server_/media/song/playlist GET
+    Returns HLS playlist of the song specified by id.
+    Song is split into segments of about HLS_SEGMENT_DURATION seconds
+    at frame boundaries from its seek table, segments are plain parts
+    of the mp3 file served by /song/segment.
+
+    :param int id: id of a song
+    :return: response with content type 'application/vnd.apple.mpegurl'
+    """
+    song = Song.query.get(id)
+    if not song:
+        return msg.errors.bad_request('Invalid id provided')
+    song_file = open_song_file(song)
+    if not song_file:
+        return msg.errors.not_found('Song file is unavailable')
+    with song_file:
+        segment_list = song_segments(song, song_file)
+    playlist = hls.playlist(
+        segment_list,
+        lambda n: url_for('media.song_segment', id=id, n=n))
+
+    # Segments are not counted, so a listen is counted here
+    Song.play_song(id)
     db.session.commit()
-    file_size = os.path.getsize(song_file)
-
-    # Generator function. Yields chuncks of the file into Response
-    def stream_file(filepath):
-        # What is the optimal chunk size for this?
-        chunk_size = 1024
-        with open(filepath, 'rb') as f:
-            chunk = f.read(chunk_size)
-            while chunk:
-                yield chunk
-                chunk = f.read(chunk_size)
+
+    return Response(playlist, status=200, mimetype=hls.PLAYLIST_MIMETYPE)
+
+
+@media.route('/song/segment', methods=['GET'])
+@limiter.limit('600/minute')
+@required_params({'id': int, 'n': int})
+def song_segment(id, n):
+    """
+    _server_/media/song/segment GET
+    Returns segment of a song listed in its HLS playlist.
+    Segments don't change while the file is the same,
+    so they are cached by proxies and revalidated with ETag.
+
+    :param int id: id of a song
+    :param int n: number of the segment
+    :return: response with content type 'audio/mpeg'
+    """
+    song = Song.query.get(id)
+    if not song:
+        return msg.errors.bad_request('Invalid id provided')
+    song_file = open_song_file(song)
+    if not song_file:
+        return msg.errors.not_found('Song file is unavailable')
+    with song_file:
+        segment_list = song_segments(song, song_file)
+        if not 0 <= n < len(segment_list):
+            return msg.errors.not_found('Segment not found')
+        start_ms, _, start, end = segment_list[n]
+        data = song_file.read(start, end - start)
 
     response = Response(
-        stream_file(song_file),
+        hls.timestamp_tag(start_ms) + data,
         status=200,
         mimetype='audio/mpeg')
-    response.headers['Content-Length'] = file_size
+    response.cache_control.public = True
+    response.cache_control.max_age = \
+        current_app.config.get('HLS_SEGMENT_MAX_AGE')
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+@media.route('/cover', methods=['GET'])
+@required_params({'hash': str})
+def cover(hash):
+    """
+    _server_/media/cover GET
+    Returns cover image from the local cover store.
+    Covers are addressed by content, so they are cached by clients
+    for a long time and revalidated with ETag.
+
+    :param str hash: cover_hash of a song or an album
+    :param str size: optional size, small or medium. Original image
+    is returned if it is omitted or there is no such size variant
+    :return: response with the image
+    """
+    path = get_cover_store().path(hash, request.values.get('size'))
+    if not path:
+        return msg.errors.not_found('Cover is not found')
+    with open(path, 'rb') as f:
+        mimetype = image_type(f.read(16)) or 'application/octet-stream'
+
+    response = send_file(
+        path,
+        mimetype=mimetype,
+        etag=os.path.basename(path),
+        max_age=current_app.config.get('COVER_MAX_AGE'))
+    response.cache_control.public = True
+    response.cache_control.immutable = True
     return response
 
 
 @media.route('/album/title', methods=['GET'])
+@limiter.limit('30/minute')
 @required_params({'title': str})
 def albums_by_title(title):
     """
@@ -336,7 +801,8 @@ def user_playlists():
 
 
 @media.route('/playlist/new', methods=['PUT'])
-@token_auth.login_required
+@claims_auth.login_required
+@limiter.limit('30/minute', per='user')
 @required_params({'title': str})
 def create_playlist(title):
     """
@@ -366,7 +832,8 @@ def create_playlist(title):
 
 
 @media.route('/playlist/song/add', methods=['PUT'])
-@token_auth.login_required
+@claims_auth.login_required
+@limiter.limit('120/minute', per='user')
 @required_params({'playlist_id': int, 'song_id': int})
 def add_song_to_playlist(playlist_id, song_id):
     """
@@ -406,7 +873,8 @@ def add_song_to_playlist(playlist_id, song_id):
 
 
 @media.route('/playlist/song/delete', methods=['DELETE'])
-@token_auth.login_required
+@claims_auth.login_required
+@limiter.limit('120/minute', per='user')
 @required_params({'playlist_id': int, 'song_id': int})
 def delete_song_from_playlist(playlist_id, song_id):
     """
@@ -450,6 +918,7 @@ def delete_song_from_playlist(playlist_id, song_id):
 
 @media.route('/playlist/delete', methods=['DELETE'])
 @token_auth.login_required
+@limiter.limit('30/minute', per='user')
 @required_params({'id': int})
 def delete_playlist(id):
     """
@@ -35,6 +35,21 @@ class ErrorMessage(Message):
     def unauthorized(self, message=''):
         return self.send_message(401, message=message)
 
+    def conflict(self, message='', **kwargs):
+        return self.send_message(409, message=message, **kwargs)
+
+    def service_unavailable(self, message='', retry_after=None):
+        response = self.send_message(503, message=message)
+        if retry_after is not None:
+            response.headers['Retry-After'] = str(retry_after)
+        return response
+
+    def too_many_requests(self, message='', retry_after=None):
+        response = self.send_message(429, message=message)
+        if retry_after is not None:
+            response.headers['Retry-After'] = str(retry_after)
+        return response
+
 
 errors = ErrorMessage()
 
@@ -1,7 +1,11 @@
 from flask import Blueprint, request, g
 from ad_server.models import User, RefreshToken
-from ad_server import db
-from ad_server.views.auth import basic_auth, generate_token
+from ad_server import db, limiter
+from ad_server.views.auth import (
+    basic_auth,
+    generate_token,
+    revoke_access_token
+)
 import ad_server.views.messages as msg
 
 
@@ -9,6 +13,7 @@ users = Blueprint('users', __name__)
 
 
 @users.route('/user/new', methods=['POST'])
+@limiter.limit('10/hour')
 def register_user():
     """
     _server_/user/new POST
@@ -34,6 +39,7 @@ def register_user():
 
 
 @users.route('/token/new', methods=['GET'])
+@limiter.limit('10/minute')
 @basic_auth.login_required
 def get_token():
     """
@@ -55,6 +61,7 @@ def get_token():
 
 
 @users.route('/token/refresh', methods=['POST'])
+@limiter.limit('30/minute')
 def refresh_token():
     """
     _server_/auth/token/refresh POST
@@ -82,8 +89,10 @@ def revoke_token():
     """
     _server_/auth/token/revoke POST
     Revokes refresh token.
+    Access token is revoked as well if it is provided.
 
     :param str refresh_token: refresh token must be present in request field refresh_token
+    :param str access_token: optional access token to reject from now on
     :return: response with fields _status_ and _message_
     """
     json_request = request.json
@@ -91,6 +100,9 @@ def revoke_token():
     if not refresh_token:
         return msg.errors.bad_request(
             'You should provide refresh token for this call')
+    access_token = json_request.get('access_token')
+    if access_token:
+        revoke_access_token(access_token)
     RefreshToken.revoke(refresh_token)
     db.session.commit()
     return msg.success('Token is successfully revoked')
@@ -0,0 +1,6 @@
+from ad_server import create_app
+from ad_server.utils.asgi import AsyncApp
+
+
+# Served by an ASGI server, e.g. `uvicorn asgi:app`
+app = AsyncApp(create_app())
@@ -0,0 +1,83 @@
+"""
+Measures token authentication overhead per request.
+
+Every request goes to a minimal view protected by token_auth,
+first with caches switched off (jwt signature check and user query
+on every request), then with caches enabled.
+
+Usage: python -m benchmarks.auth_overhead [-n REQUESTS]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from ad_server import create_app, db
+from ad_server.config import Config
+from ad_server.models import User, user_cache
+from ad_server.views.auth import generate_token, token_auth, token_cache
+
+
+class BenchConfig(Config):
+    SECRET_KEY = 'benchmark'
+    DEBUG = False
+    TESTING = True
+
+
+def measure(client, url, headers, requests):
+    start = time.perf_counter()
+    for _ in range(requests):
+        response = client.get(url, headers=headers)
+        assert response.status_code == 200
+    return (time.perf_counter() - start) / requests
+
+
+def main(requests):
+    db_file = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    BenchConfig.SQLALCHEMY_DATABASE_URI = f'sqlite:///{db_file}'
+    app = create_app(BenchConfig)
+
+    @app.route('/bench/token', methods=['GET'])
+    @token_auth.login_required
+    def bench_token():
+        return ''
+
+    @app.route('/bench/public', methods=['GET'])
+    def bench_public():
+        return ''
+
+    with app.app_context():
+        db.create_all()
+        user = User(login='bench', password='bench')
+        db.session.add(user)
+        db.session.commit()
+        token = generate_token(user.id)
+
+    headers = {'Authorization': f'Bearer {token}'}
+    client = app.test_client()
+
+    baseline = measure(client, '/bench/public', {}, requests)
+
+    token_cache.configure(maxsize=0)
+    user_cache.configure(maxsize=0)
+    uncached = measure(client, '/bench/token', headers, requests)
+
+    token_cache.configure(maxsize=4096)
+    user_cache.configure(maxsize=1024)
+    cached = measure(client, '/bench/token', headers, requests)
+
+    print(f'requests per run: {requests}')
+    print(f'no auth:            {baseline * 1e6:8.1f} us/request')
+    print(f'auth without cache: {uncached * 1e6:8.1f} us/request '
+          f'(+{(uncached - baseline) * 1e6:.1f} us)')
+    print(f'auth with cache:    {cached * 1e6:8.1f} us/request '
+          f'(+{(cached - baseline) * 1e6:.1f} us)')
+
+    os.remove(db_file)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('-n', '--requests', type=int, default=2000)
+    args = parser.parse_args()
+    main(args.requests)
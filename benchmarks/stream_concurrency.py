@@ -0,0 +1,170 @@
+"""
+Measures how many concurrent paced song streams a single process keeps
+up with, served by the async server and by a pool of WSGI threads.
+
+Every stream plays a 128 kbps song for the given number of seconds and
+counts as kept up if it has received at least as much audio as it has
+played. Requests go straight to the applications without an http
+server, so sockets and http parsing are not part of the measurement.
+
+Usage: python -m benchmarks.stream_concurrency [-c 100,500,2000]
+       [-d SECONDS] [-w WORKERS]
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ad_server import create_app, db
+from ad_server.config import Config
+from ad_server.models import Song, Album, Artist
+from ad_server.utils.asgi import AsyncApp, wsgi_environ
+
+BITRATE = 128000
+# MPEG 1 layer 3 frame header, 128 kbps, 44100 Hz, 417 bytes long
+FRAME = b'\xff\xfb\x90\x00' + bytes(413)
+FRAME_MS = 1152 / 44100 * 1000
+STREAM_PATH = '/api/public/media/song/play'
+
+
+class BenchConfig(Config):
+    SECRET_KEY = 'benchmark'
+    DEBUG = False
+    TESTING = True
+    RATELIMIT_ENABLED = False
+    STREAM_PACING = True
+    STREAM_PACING_BURST = 2
+    TOKEN_SWEEP_INTERVAL = 0
+    HEAD_CACHE_REFRESH = 0
+    LISTEN_FLUSH_INTERVAL = 0
+
+
+def make_song(folder, seconds):
+    path = os.path.join(folder, 'song.mp3')
+    with open(path, 'wb') as f:
+        f.write(FRAME * int(seconds * 1000 / FRAME_MS + 1))
+    artist = Artist(title='bench')
+    album = Album(title='bench')
+    db.session.add_all([artist, album])
+    db.session.flush()
+    song = Song(
+        title='bench', filepath=path, duration=seconds, bitrate=BITRATE,
+        listens_count=0, artist_id=artist.id, album_id=album.id)
+    db.session.add(song)
+    db.session.commit()
+    return song.id
+
+
+def scope(song_id, i):
+    return {
+        'type': 'http',
+        'method': 'GET',
+        'path': STREAM_PATH,
+        'query_string': f'id={song_id}'.encode(),
+        'headers': [(b'host', b'localhost')],
+        'client': (f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}', 0),
+    }
+
+
+def run_async(app, song_id, streams, duration, workers):
+    server = AsyncApp(app, workers=workers)
+    received = [0] * streams
+
+    async def stream(i, deadline):
+        requests = [{'type': 'http.request', 'body': b''}]
+
+        async def receive():
+            if requests:
+                return requests.pop()
+            await asyncio.sleep(deadline - time.monotonic())
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            received[i] += len(message.get('body', b''))
+
+        await server(scope(song_id, i), receive, send)
+
+    async def serve():
+        deadline = time.monotonic() + duration
+        await asyncio.gather(*(stream(i, deadline) for i in range(streams)))
+
+    try:
+        asyncio.run(serve())
+    finally:
+        server.executor.shutdown()
+    return received
+
+
+def run_sync(app, song_id, streams, duration, workers):
+    received = [0] * streams
+
+    def stream(i, deadline):
+        if time.monotonic() >= deadline:
+            return
+        body = app(wsgi_environ(scope(song_id, i), None),
+                   lambda status, headers, exc_info=None: None)
+        try:
+            for chunk in body:
+                received[i] += len(chunk)
+                if time.monotonic() >= deadline:
+                    break
+        finally:
+            body.close()
+
+    deadline = time.monotonic() + duration
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for i in range(streams):
+            pool.submit(stream, i, deadline)
+    return received
+
+
+def measure(run, app, song_id, streams, duration, workers):
+    start = time.perf_counter()
+    cpu = time.process_time()
+    received = run(app, song_id, streams, duration, workers)
+    cpu = time.process_time() - cpu
+    elapsed = time.perf_counter() - start
+    played = BITRATE / 8 * duration
+    kept_up = sum(size >= played for size in received)
+    return kept_up, sum(received) / elapsed, cpu / elapsed
+
+
+def main(concurrency, duration, workers):
+    folder = tempfile.mkdtemp()
+    BenchConfig.SQLALCHEMY_DATABASE_URI = \
+        f'sqlite:///{os.path.join(folder, "bench.db")}'
+    BenchConfig.MEDIA_STORAGE = folder
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.create_all()
+        song_id = make_song(folder, int(duration) * 2 + 10)
+
+    print(f'{duration} s of 128 kbps streams, {workers} worker threads')
+    print(f'{"mode":6} {"streams":>8} {"kept up":>8} '
+          f'{"MB/s":>8} {"cpu":>6}')
+    for streams in concurrency:
+        for mode, run in (('async', run_async), ('sync', run_sync)):
+            kept_up, rate, cpu = measure(
+                run, app, song_id, streams, duration, workers)
+            print(f'{mode:6} {streams:8} {kept_up:8} '
+                  f'{rate / 1024 ** 2:8.2f} {cpu:6.0%}')
+
+    for name in os.listdir(folder):
+        os.remove(os.path.join(folder, name))
+    os.rmdir(folder)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        '-c', '--concurrency', default='100,500,2000',
+        help='comma separated numbers of concurrent streams')
+    parser.add_argument('-d', '--duration', type=float, default=10)
+    parser.add_argument('-w', '--workers', type=int, default=32)
+    args = parser.parse_args()
+    main([int(c) for c in args.concurrency.split(',')],
+         args.duration, args.workers)
@@ -2,8 +2,13 @@ import pytest
 import requests
 import os
 import shutil
+import json
+import base64
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
 import ad_server.views.messages as msg
-from ad_server import create_app, db
+from ad_server import create_app, db, limiter
 from ad_server.config import TestConfig
 from ad_server.models import (
     User,
@@ -15,11 +20,17 @@ from ad_server.models import (
     Genre
     )
 from ad_server.views.auth import generate_token, token_auth
+from ad_server.utils.scanner import walk_mp3_files
 from flask import current_app, testing
 
 
 PWD = os.path.dirname(os.path.abspath(__file__))
 
+# 1x1 png served by the last.fm stub as album image
+COVER_PNG = base64.b64decode(
+    'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA'
+    '60e6kgAAAABJRU5ErkJggg==')
+
 
 class TestClient(testing.FlaskClient):
     """
@@ -95,6 +106,22 @@ def token_endpoint(app):
         return msg.success('Successful API call with token required')
 
 
+@pytest.fixture(scope='session', autouse=True)
+def limited_endpoint(app):
+    """
+    Creates fake api endpoint with tight rate limit
+    """
+    @app.route('/test/limited', methods=['GET'])
+    @limiter.limit('2/minute')
+    def test_limited():
+        return msg.success('Successful API call with rate limit')
+
+    @app.route('/test/limited/url', methods=['GET'])
+    @limiter.limit('1/minute', per='url')
+    def test_limited_url():
+        return msg.success('Successful API call with rate limit per url')
+
+
 @pytest.fixture(scope='function')
 def app_db(app):
     return db
@@ -147,14 +174,80 @@ def audio_storage(app):
     shutil.rmtree(media_folder)
 
 
+class LastFMStubHandler(BaseHTTPRequestHandler):
+    """
+    Answers last.fm api calls with made up track and album info.
+    """
+
+    requests_count = 0
+
+    def do_GET(self):
+        LastFMStubHandler.requests_count += 1
+        if self.path.startswith('/covers/'):
+            return self.send_cover()
+        params = {
+            k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()
+        }
+        method = params.get('method')
+
+        if method == 'track.getInfo':
+            body = {'track': {
+                'name': params.get('track'),
+                'album': {'title': f'{params.get("artist")} album'}
+            }}
+        elif method == 'album.getInfo':
+            host = self.headers['Host']
+            images = [
+                {'#text': f'http://{host}/covers/{size}.png', 'size': size}
+                for size in ('small', 'medium', 'large', 'extralarge')
+            ]
+            body = {'album': {'name': params.get('album'), 'image': images}}
+        else:
+            body = {'error': 6, 'message': 'Not found'}
+
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_cover(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(COVER_PNG)))
+        self.end_headers()
+        self.wfile.write(COVER_PNG)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture(scope='session')
+def lastfm_stub(app):
+    """
+    Runs local server standing in for last.fm api during tests.
+    """
+    server = HTTPServer(('127.0.0.1', 0), LastFMStubHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    url = f'http://127.0.0.1:{server.server_port}/2.0'
+    current_app.config['LAST_FM_API_URL'] = url
+    # Client is recreated with stub url on the next call
+    current_app.extensions.pop('lastfm', None)
+
+    yield url
+
+    server.shutdown()
+    current_app.extensions.pop('lastfm', None)
+
+
 @pytest.fixture(scope='module')
 def fill_db(audio_storage):
     """
     Fill database with fake albums, artists, genres and songs for test purposes
     """
-    if os.path.exists(os.path.join(audio_storage, 'added')):
-        audio_storage = os.path.join(audio_storage, 'added')
-
     artist1 = Artist(title='artist1')
     db.session.add(artist1)
     artist2 = Artist(title='artist2')
@@ -178,9 +271,10 @@ def fill_db(audio_storage):
 
     db.session.commit()
 
-    # Filepath for one of loaded mp3 files from audio_storage
+    # Filepath for one of loaded mp3 files from audio_storage,
+    # either downloaded or already imported into the media storage.
     # Will be used as filepath for all test songs in db
-    loaded_song = os.path.join(audio_storage, os.listdir(audio_storage)[0])
+    loaded_song = sorted(path for path, _ in walk_mp3_files(audio_storage))[0]
 
     artists = [artist1, artist2]
     albums = [album1, album2]
@@ -1,9 +1,91 @@
-from ad_server.utils.addsongs import add_songs_to_db
-from ad_server.models import Song, Album, Genre, AlbumGenre, AlbumArtist
+from ad_server.utils import addsongs, mp3index, zipstream, tiers
+from ad_server.utils.addsongs import (
+    add_songs_to_db, parse_song_file, import_files, file_checksum
+)
+from ad_server.utils.jobs import JobProgress
+from ad_server.utils.covers import CoverStore, get_cover_store
+from ad_server.utils.lastfm_api import LastFMClient
+from ad_server.utils.ingest import IngestionSession
+from ad_server.utils.scanner import (
+    scan_library, delete_songs, walk_mp3_files
+)
+from ad_server.utils.storage import (
+    MediaStorage, get_media_storage, relocate_library, parse_tiers
+)
+from ad_server.utils import watcher
+from ad_server.utils.watcher import IngestDaemon, read_status
+from ad_server.utils.integrity import check_library, write_report
+from mutagen.mp3 import EasyMP3, MP3
+from mutagen.id3 import ID3, APIC
+from sqlalchemy.exc import OperationalError
+from queue import Queue
+from tests.conftest import LastFMStubHandler
+from ad_server.models import (
+    Song, Album, Artist, Genre, AlbumGenre, AlbumArtist, MediaFile,
+    IngestJob, IngestItem
+)
+import pytest
+import hashlib
+import json
 import os
+import shutil
+import time
 
 
-def test_script_adding_songs_to_db(app, app_db, audio_storage):
+def stored_song_files():
+    """
+    Returns paths of files imported into the media storage.
+    """
+    return sorted(
+        path for path, _ in walk_mp3_files(get_media_storage().root))
+
+
+def test_parse_song_file(audio_storage):
+    """
+    Tags are read into a plain dict which can be sent between processes.
+    """
+    for f in os.listdir(audio_storage):
+        filepath = os.path.join(audio_storage, f)
+        if not os.path.isfile(filepath):
+            continue
+
+        track = parse_song_file(filepath)
+
+        assert track['filepath'] == filepath
+        assert track['title']
+        assert track['artists']
+        assert track['duration'] > 0
+
+
+def test_parse_embedded_cover(audio_storage, tmp_path):
+    """
+    Embedded cover is stored once under the hash of its content.
+    """
+    source = os.path.join(audio_storage, sorted(
+        f for f in os.listdir(audio_storage) if f.endswith('.mp3'))[0])
+    filepath = str(tmp_path / 'with_cover.mp3')
+    shutil.copy(source, filepath)
+
+    image = b'\xff\xd8\xff\xe0' + os.urandom(1024)
+    tags = ID3(filepath)
+    tags.add(APIC(mime='image/jpeg', type=3, desc='Cover', data=image))
+    tags.save()
+
+    cover_folder = str(tmp_path / 'covers')
+    track = parse_song_file(filepath, cover_folder)
+    assert track['cover_hash'] == hashlib.sha256(image).hexdigest()
+
+    store = CoverStore(cover_folder)
+    with open(store.path(track['cover_hash']), 'rb') as f:
+        assert f.read() == image
+    # Same picture is not stored again
+    assert parse_song_file(filepath, cover_folder)['cover_hash'] == \
+        track['cover_hash']
+    assert len(os.listdir(os.path.join(
+        cover_folder, track['cover_hash'][:2]))) == 1
+
+
+def test_script_adding_songs_to_db(app, app_db, audio_storage, lastfm_stub):
 
     add_songs_to_db(audio_storage, app_db)
 
@@ -17,12 +99,571 @@ def test_script_adding_songs_to_db(app, app_db, audio_storage):
 
     # Album cover from last fm api call should've been added to db
     assert album.cover_small and album.cover_medium
+    # and downloaded into the local cover store
+    assert album.cover_hash
+    assert get_cover_store().path(album.cover_hash)
 
     songs = Song.query.all()
+    storage = get_media_storage()
+
+    for song in songs:
+        # Songs must've been placed in the media storage under
+        # the hash of their content and their keys written in database
+        path = storage.path(song.filepath)
+        assert not os.path.isabs(song.filepath)
+        assert song.filepath == storage.key(file_checksum(path))
+        assert song.seek_table == mp3index.file_seek_table(path)
+        assert song.bitrate == MP3(path).info.bitrate
+        assert 0 < song.preview_start < song.preview_end
+        assert MediaFile.query.get(song.filepath).crc32 == \
+            zipstream.file_crc32(path)
+    assert not any(f.endswith('.mp3') for f in os.listdir(audio_storage))
+
+
+def test_seek_table(app_db, audio_storage):
+    """
+    Seek table points at frame headers about a second apart
+    and covers the whole song.
+    """
+    path = stored_song_files()[0]
+    table = mp3index.unpack(mp3index.file_seek_table(path))
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    assert table[0][0] == 0
+    for (ms, offset), (next_ms, next_offset) in zip(table, table[1:]):
+        assert next_ms - ms >= mp3index.SEEK_INTERVAL
+        assert next_offset > offset
+    for ms, offset in table:
+        assert mp3index.parse_header(data[offset:offset + 4])
+    length = MP3(path).info.length * 1000
+    assert length - table[-1][0] <= mp3index.SEEK_INTERVAL + 100
+
+    packed = mp3index.pack(table)
+    assert mp3index.seek(packed, 0) == (0, 0)
+    assert mp3index.seek(packed, table[2][0] + 10) == table[2]
+    assert mp3index.decode(mp3index.encode(packed)) == packed
+
+    # Songs added before seek tables get them from the backfill
+    song = Song.query.filter_by(filepath=get_media_storage().key_of(path))\
+        .first()
+    song.seek_table = None
+    app_db.session.commit()
+    assert mp3index.backfill_seek_tables(
+        app_db, get_media_storage(), workers=0) >= 1
+    assert Song.query.get(song.id).seek_table == packed
+    start, end = mp3index.preview_range(table, os.path.getsize(path))
+    assert Song.query.get(song.id).preview_start == start
+    assert table[0][1] < start < end
+    # Preview lasts 30 seconds if the song is long enough
+    times = dict((offset, ms) for ms, offset in table)
+    if end in times:
+        assert times[end] - times[start] >= mp3index.PREVIEW_LENGTH
+
+
+def test_lastfm_response_cache(lastfm_stub, tmp_path):
+    """
+    Repeated lookups are served from the disk cache,
+    batch lookups return results in order of queries.
+    """
+    client = LastFMClient(
+        'key', base_url=lastfm_stub,
+        cache_path=os.path.join(tmp_path, 'lastfm.db'))
+
+    before = LastFMStubHandler.requests_count
+    album = client.search('album', album='cached', artist='artist')
+    assert album['image']
+    assert client.search('album', album='cached', artist='artist') == album
+    assert LastFMStubHandler.requests_count == before + 1
+
+    results = client.search_many([
+        ('track', {'track': 'song', 'artist': 'first'}),
+        ('track', {'track': 'song', 'artist': 'second'}),
+        ('artist', {'artist': 'missing'}),
+    ])
+
+    assert results[0]['album']['title'] == 'first album'
+    assert results[1]['album']['title'] == 'second album'
+    assert isinstance(results[2], ConnectionError)
+
+
+def test_ingestion_session_isolates_bad_rows(app_db):
+    """
+    Track which can't be written doesn't prevent others
+    in the same batch from being committed.
+    """
+    def track(title):
+        return {
+            'filepath': f'/dropped/{title}.mp3',
+            'target': f'/added/{title}.mp3',
+            'title': title,
+            'track_number': 1,
+            'duration': 100,
+            'genres': ['ingest genre'],
+            'artists': ['ingest artist', 'ingest guest'],
+            'album': 'ingest album',
+            'cover_small': None,
+            'cover_medium': None,
+            'size': 1000,
+            'mtime': 0,
+            'checksum': title,
+        }
+
+    ingest = IngestionSession(app_db, batch_size=10)
+    ingest.preload()
+
+    good = track('ingest good')
+    bad = track(None)
+    ingest.add(good)
+    ingest.add(bad)
+    committed = ingest.flush()
+
+    assert committed == [good]
+    assert ingest.failed[0][0] is bad
+
+    song = Song.query.get(good['song_id'])
+    assert song.album.title == 'ingest album'
+    assert [g.title for g in song.album.genres] == ['ingest genre']
+    assert {a.title for a in song.album.artists} == \
+        {'ingest artist', 'ingest guest'}
+
+    # Same album is reused by the next batch
+    again = track('ingest again')
+    ingest.add(again)
+    ingest.flush()
+    assert Song.query.get(again['song_id']).album_id == song.album_id
+    assert AlbumArtist.query.filter_by(album_id=song.album_id).count() == 2
+
+    album = song.album
+    song_ids = [good['song_id'], again['song_id']]
+    MediaFile.query.filter(MediaFile.song_id.in_(song_ids)).delete()
+    Song.query.filter(Song.id.in_(song_ids)).delete()
+    AlbumArtist.query.filter_by(album_id=album.id).delete()
+    AlbumGenre.query.filter_by(album_id=album.id).delete()
+    app_db.session.delete(album)
+    Artist.query.filter(
+        Artist.title.in_(['ingest artist', 'ingest guest'])).delete()
+    app_db.session.commit()
+
+
+def test_lookup_stage_failure():
+    """
+    Tracks of a batch whose lookup raises are failed
+    and the write stage still gets the end mark.
+    """
+    def lookup(batch):
+        if any(t['title'] == 'bad' for t in batch):
+            raise RuntimeError('lookup failed')
+        return batch
+
+    parsed, enriched = Queue(), Queue()
+    for title in ('bad', 'other'):
+        parsed.put({'title': title})
+    parsed.put(addsongs.STOP)
+    failed = []
+    addsongs.lookup_stage(lookup, parsed, enriched, 10, failed)
+
+    assert [t['title'] for t, _ in failed] == ['bad', 'other']
+    assert isinstance(failed[0][1], RuntimeError)
+    assert enriched.get_nowait() is addsongs.STOP
+
+
+def test_album_lookup_without_results():
+    """
+    Tracks are kept without album covers when last.fm finds nothing.
+    """
+    class EmptyClient:
+        max_concurrency = 1
+
+        def search_many(self, searches):
+            return [None] * len(searches)
+
+    lookup = addsongs.AlbumLookup(EmptyClient(), {})
+    tracks = lookup([
+        {'title': 'song', 'artists': ['artist'], 'album': None},
+        {'title': 'song', 'artists': ['artist'], 'album': 'album'},
+    ])
+    assert tracks[0]['album'] is None
+    assert (tracks[1]['cover_small'], tracks[1]['cover_medium']) == \
+        (None, None)
+
+
+def test_incremental_rescan(app_db, audio_storage, lastfm_stub, tmp_path):
+    """
+    Rescan skips unchanged files, updates retagged ones,
+    imports new files and removes songs of deleted ones.
+    Files outside of the media storage stay where they are.
+    """
+    library = str(tmp_path / 'legacy')
+    os.mkdir(library)
+    for i, path in enumerate(stored_song_files()):
+        shutil.copy(path, os.path.join(library, f'legacy{i}.mp3'))
+    files = sorted(os.listdir(library))
+
+    result = scan_library(library, app_db, workers=0)
+    assert result['imported'] == len(files)
+
+    result = scan_library(library, app_db, workers=0)
+    assert result['unchanged'] == len(files)
+    assert result['imported'] == 0
+
+    # Only modification time changes
+    touched = os.path.join(library, files[0])
+    os.utime(touched, ns=(time.time_ns(), time.time_ns()))
+    result = scan_library(library, app_db, workers=0)
+    assert result['touched'] == 1
+    assert result['imported'] == 0
+
+    copy = os.path.join(library, 'rescan_copy.mp3')
+    shutil.copy(touched, copy)
+    tags = EasyMP3(copy)
+    tags['title'] = 'Rescanned'
+    tags.save()
+
+    result = scan_library(library, app_db, workers=0)
+    assert result['imported'] == 1
+    song = Song.query.filter_by(filepath=copy).one()
+    assert song.title == 'Rescanned'
+
+    tags['title'] = 'Retagged'
+    tags.save()
+
+    result = scan_library(library, app_db, workers=0)
+    assert result['imported'] == 1
+    assert Song.query.filter_by(filepath=copy).one().id == song.id
+    assert Song.query.get(song.id).title == 'Retagged'
+
+    os.remove(copy)
 
+    result = scan_library(library, app_db, workers=0)
+    assert result['deleted'] == 1
+    assert Song.query.filter_by(filepath=copy).count() == 0
+    assert MediaFile.query.get(copy) is None
+
+    for f in files:
+        os.remove(os.path.join(library, f))
+    result = scan_library(library, app_db, workers=0)
+    assert result['deleted'] == len(files)
+
+
+def test_storage_rescan(app_db, audio_storage, lastfm_stub):
+    """
+    Files put into the media storage by hand are moved under their keys,
+    stored files which have changed are reported as damaged.
+    """
+    storage = get_media_storage()
+    stray = os.path.join(storage.root, 'stray.mp3')
+    shutil.copy(stored_song_files()[0], stray)
+    tags = EasyMP3(stray)
+    tags['title'] = 'Stray'
+    tags.save()
+    key = storage.key(file_checksum(stray))
+
+    result = scan_library(storage.root, app_db, workers=0)
+    assert result['imported'] == 1
+    assert not os.path.exists(stray)
+    song = Song.query.filter_by(title='Stray').one()
+    assert song.filepath == key
+    assert MediaFile.query.get(key).song_id == song.id
+
+    with open(storage.path(key), 'ab') as f:
+        f.write(b'garbage')
+    result = scan_library(storage.root, app_db, workers=0)
+    assert result['damaged'] == 1
+    assert result['imported'] == 0
+
+    os.remove(storage.path(key))
+    result = scan_library(storage.root, app_db, workers=0)
+    assert result['deleted'] == 1
+    assert Song.query.filter_by(title='Stray').count() == 0
+
+
+def test_relocate_library(app_db, audio_storage, tmp_path):
+    """
+    Songs stored by file name are moved under content keys.
+    """
+    storage = get_media_storage()
+    legacy = str(tmp_path / 'song.mp3')
+    with open(legacy, 'wb') as f:
+        f.write(os.urandom(4096))
+    checksum = file_checksum(legacy)
+
+    artist = Artist(title='relocated')
+    app_db.session.add(artist)
+    songs = [
+        Song(title=f'relocated{i}', artist=artist, filepath=legacy)
+        for i in range(2)
+    ]
+    missing = Song(title='missing', artist=artist,
+                   filepath=str(tmp_path / 'missing.mp3'))
+    app_db.session.add_all(songs + [missing])
+    app_db.session.commit()
+
+    relocated, missing_files = relocate_library(app_db, storage)
+    assert relocated == 2
+    assert missing_files == [str(tmp_path / 'missing.mp3')]
+
+    key = storage.key(checksum)
     for song in songs:
-        # Songs must've been placed in added directory within
-        # servers media storage
-        # this path then written in database
-        assert os.path.dirname(song.filepath) == \
-            os.path.join(audio_storage, 'added')
+        assert Song.query.get(song.id).filepath == key
+    assert not os.path.exists(legacy)
+    assert file_checksum(storage.path(key)) == checksum
+    assert MediaFile.query.get(key).checksum == checksum
+
+    delete_songs(app_db, [s.id for s in songs] + [missing.id])
+    os.remove(storage.path(key))
+    app_db.session.delete(Artist.query.get(artist.id))
+    app_db.session.commit()
+
+
+def test_storage_tiers(app, app_db, audio_storage, tmp_path):
+    """
+    Most listened songs are copied onto the fastest tier with room,
+    cooled down songs are removed from tiers, and readers resolve
+    the fastest copy.
+    """
+    library = get_media_storage()
+    keys = sorted({
+        s.filepath for s in Song.query.filter(~Song.broken)
+        if not os.path.isabs(s.filepath)})
+    hot, warm = keys[:2]
+    # Either file fits on a tier, but not both
+    budget = max(os.path.getsize(library.path(k)) for k in (hot, warm))
+    fast, slow = str(tmp_path / 'fast'), str(tmp_path / 'slow')
+    storage = MediaStorage(
+        library.root, tiers=[(fast, budget), (slow, budget)])
+    listens = Song.listens_count
+
+    def set_listens(counts):
+        Song.query.update({'listens_count': 0}, synchronize_session=False)
+        for key, count in counts.items():
+            Song.query.filter_by(filepath=key).update(
+                {'listens_count': count}, synchronize_session=False)
+        app_db.session.commit()
+
+    old_listens = dict(app_db.session.query(Song.id, listens))
+    set_listens({hot: 10, warm: 5})
+    # Copy left on the fast tier by an earlier placement
+    stale = storage.tiers[0][0].path(warm)
+    os.makedirs(os.path.dirname(stale))
+    shutil.copyfile(library.path(warm), stale)
+
+    report = tiers.rebalance_tiers(app_db, storage)
+    assert report == {'promoted': 2, 'demoted': 1, 'failed': 0}
+    assert storage.resolve(hot) == os.path.join(fast, *hot.split('/'))
+    assert storage.resolve(warm) == os.path.join(slow, *warm.split('/'))
+    assert os.stat(storage.resolve(hot)).st_mtime_ns == \
+        os.stat(library.path(hot)).st_mtime_ns
+    with open(storage.resolve(hot), 'rb') as f:
+        assert file_checksum(library.path(hot)) == \
+            hashlib.sha256(f.read()).hexdigest()
+
+    # Songs change places as their listens change
+    set_listens({warm: 10})
+    report = tiers.rebalance_tiers(app_db, storage)
+    assert report == {'promoted': 1, 'demoted': 2, 'failed': 0}
+    assert storage.resolve(warm) == os.path.join(fast, *warm.split('/'))
+    assert storage.resolve(hot) == library.path(hot)
+
+    # Tiers are taken from config by the stream path
+    app.config['STORAGE_TIERS'] = f'{fast}={budget},{slow}={budget}'
+    try:
+        assert get_media_storage().resolve(warm) == storage.resolve(warm)
+    finally:
+        app.config['STORAGE_TIERS'] = None
+    with pytest.raises(ValueError):
+        parse_tiers('/mnt/fast')
+
+    for id, count in old_listens.items():
+        Song.query.filter_by(id=id).update(
+            {'listens_count': count}, synchronize_session=False)
+    app_db.session.commit()
+
+
+def test_watcher_imports_dropped_files(app, app_db, audio_storage,
+                                       lastfm_stub, tmp_path, monkeypatch):
+    """
+    Watcher waits until dropped file stops changing,
+    imports it and reports progress in the status file.
+    Failed imports are reported and retried.
+    """
+    drop = tmp_path / 'drop'
+    drop.mkdir()
+    storage = MediaStorage(str(tmp_path / 'library'))
+    status_file = str(tmp_path / 'status.json')
+
+    daemon = IngestDaemon(
+        app, str(drop), storage, status_file,
+        settle=0.5, workers=0, polling=True)
+
+    dropped = str(drop / 'dropped.mp3')
+    shutil.copy(stored_song_files()[0], dropped)
+    tags = EasyMP3(dropped)
+    tags['title'] = 'Dropped'
+    tags.save()
+    key = storage.key(file_checksum(dropped))
+
+    # File has just been written, so it isn't imported yet
+    daemon.run_once(timeout=0)
+    status = read_status(status_file)
+    assert status['running']
+    assert status['backlog'] == 1
+    assert status['imported'] == 0
+
+    def fail(*args, **kwargs):
+        raise OperationalError('INSERT', {}, Exception('database is gone'))
+
+    time.sleep(0.5)
+    monkeypatch.setattr(watcher, 'add_songs_to_db', fail)
+    assert not daemon.run_once(timeout=0)
+    monkeypatch.undo()
+    status = read_status(status_file)
+    assert status['errors'] == 1
+    assert 'database is gone' in status['last_error']['error']
+    assert status['backlog'] == 1
+    assert daemon.backoff() == 1
+
+    assert daemon.run_once(timeout=0)
+    status = read_status(status_file)
+    assert status['errors'] == 0
+    assert status['backlog'] == 0
+    assert status['imported'] == 1
+    assert status['last_batch']['files'] == 1
+
+    song = Song.query.filter_by(title='Dropped').one()
+    song_id = song.id
+    assert song.filepath == key
+    assert os.path.exists(storage.path(key))
+    assert not os.path.exists(dropped)
+
+    # Same file dropped again is not added twice
+    shutil.copy(storage.path(key), dropped)
+    daemon.run_once(timeout=0)
+    time.sleep(0.5)
+    daemon.run_once(timeout=0)
+    assert Song.query.filter_by(title='Dropped').count() == 1
+    assert not os.path.exists(dropped)
+
+    delete_songs(app_db, [song_id])
+
+
+def test_interrupted_import_resumes(app_db, audio_storage, lastfm_stub,
+                                    tmp_path, monkeypatch):
+    """
+    Import interrupted after a commit is resumed by the next run
+    without adding songs twice.
+    """
+    drop = tmp_path / 'drop'
+    drop.mkdir()
+    storage = MediaStorage(str(tmp_path / 'library'))
+
+    source = stored_song_files()[0]
+    files = []
+    for i in range(2):
+        filepath = str(drop / f'resume{i}.mp3')
+        shutil.copy(source, filepath)
+        tags = EasyMP3(filepath)
+        tags['title'] = f'Resume{i}'
+        tags.save()
+        files.append(filepath)
+
+    def crash(tracks, storage):
+        if tracks:
+            raise RuntimeError('Interrupted')
+
+    progress = JobProgress.start(app_db, str(drop), files, storage.root)
+    monkeypatch.setattr(addsongs, 'move_files', crash)
+    with pytest.raises(RuntimeError):
+        import_files(files, app_db, storage=storage, workers=0,
+                     batch_size=1, progress=progress)
+    monkeypatch.undo()
+
+    # First song is committed, but its file is still in the drop folder
+    assert Song.query.filter_by(title='Resume0').count() == 1
+    assert os.path.exists(files[0])
+    assert progress.state(files[0]) == IngestItem.PENDING
+    progress.load()
+    assert progress.state(files[0]) == IngestItem.COMMITTED
+
+    resumed = JobProgress.start(app_db, str(drop), files, storage.root)
+    assert resumed.job.id == progress.job.id
+    import_files(resumed.filepaths(), app_db, storage=storage, workers=0,
+                 batch_size=1, progress=resumed)
+
+    songs = Song.query.filter(Song.title.in_(['Resume0', 'Resume1'])).all()
+    assert sorted(s.title for s in songs) == ['Resume0', 'Resume1']
+    for song in songs:
+        assert os.path.exists(storage.path(song.filepath))
+    assert not any(os.path.exists(f) for f in files)
+    assert IngestJob.query.get(resumed.job.id).finished
+    resumed.load()
+    assert {resumed.state(f) for f in files} == {IngestItem.MOVED}
+
+    # Finished job is not resumed
+    assert JobProgress.start(app_db, str(drop), []).job.id != resumed.job.id
+
+    # Items of the job stop referring to deleted songs
+    items = IngestItem.query.filter_by(job_id=resumed.job.id)
+    assert {i.song_id for i in items} == {s.id for s in songs}
+    delete_songs(app_db, [s.id for s in songs])
+    assert {i.song_id for i in items} == {None}
+
+
+def test_integrity_check(app_db, audio_storage, tmp_path):
+    """
+    Songs with missing, truncated or corrupt files are flagged broken,
+    flag is cleared once the file is fine again.
+    """
+    storage = get_media_storage()
+    source = stored_song_files()[0]
+    paths = {}
+    for name in ('good', 'truncated', 'corrupt'):
+        paths[name] = str(tmp_path / f'{name}.mp3')
+        shutil.copy(source, paths[name])
+    paths['missing'] = str(tmp_path / 'missing.mp3')
+    size = os.path.getsize(source)
+    with open(paths['truncated'], 'r+b') as f:
+        f.truncate(size // 2)
+    with open(paths['corrupt'], 'wb') as f:
+        f.write(os.urandom(size))
+
+    artist = Artist(title='integrity')
+    app_db.session.add(artist)
+    songs = {
+        name: Song(title=name, artist=artist, filepath=path)
+        for name, path in paths.items()
+    }
+    app_db.session.add_all(songs.values())
+    app_db.session.flush()
+    app_db.session.add(MediaFile(
+        path=paths['truncated'], size=size, mtime=0,
+        song_id=songs['truncated'].id))
+    app_db.session.commit()
+    ids = {name: song.id for name, song in songs.items()}
+
+    report = check_library(app_db, storage, workers=2)
+    problems = {
+        item['song_id']: item['problem'] for item in report['broken']
+    }
+    assert ids['good'] not in problems
+    assert problems[ids['truncated']] == 'truncated'
+    assert problems[ids['corrupt']] == 'corrupt'
+    assert problems[ids['missing']] == 'missing'
+    assert report['newly_broken'] == 3
+    for name, id in ids.items():
+        assert Song.query.get(id).broken == (name != 'good')
+
+    report_file = str(tmp_path / 'report.json')
+    write_report(report, report_file)
+    with open(report_file) as f:
+        assert json.load(f)['broken'] == report['broken']
+
+    shutil.copy(source, paths['corrupt'])
+    report = check_library(app_db, storage, workers=0)
+    assert report['repaired'] == 1
+    assert report['newly_broken'] == 0
+    assert not Song.query.get(ids['corrupt']).broken
+
+    delete_songs(app_db, ids.values())
+    app_db.session.delete(Artist.query.get(artist.id))
+    app_db.session.commit()
@@ -0,0 +1,214 @@
+from flask import url_for, current_app
+from ad_server.models import User
+from ad_server.views.auth import generate_token
+from ad_server.utils.uploads import hashers
+from ad_server.utils.scanner import walk_mp3_files
+from ad_server.utils.storage import get_media_storage
+from ad_server.utils.streaming import head_cache
+from ad_server import db
+import pytest
+import hashlib
+import json
+import time
+import os
+
+
+@pytest.fixture(scope='function')
+def admin_token():
+    """
+    Creates admin user and returns his access token.
+    """
+    user = User(login='AdminUser', password='testpass', is_admin=True)
+    db.session.add(user)
+    db.session.commit()
+
+    yield generate_token(user.id)
+
+    db.session.delete(user)
+    db.session.commit()
+
+
+@pytest.fixture(scope='function')
+def status_file(tmp_path):
+    """
+    Points app to a temporary ingestion status file.
+    """
+    path = tmp_path / 'ingest_status.json'
+    default = current_app.config.get('INGEST_STATUS_FILE')
+    current_app.config['INGEST_STATUS_FILE'] = str(path)
+
+    yield path
+
+    current_app.config['INGEST_STATUS_FILE'] = default
+
+
+def test_ingest_status_requires_admin(test_client, user_with_tokens):
+
+    _, access_token, _ = user_with_tokens
+    url = url_for('admin.ingest_status')
+
+    response = test_client.get(url)
+    assert response.status_code == 401
+
+    response = test_client.get(
+        url, headers={'Authorization': f'Bearer {access_token}'})
+    assert response.status_code == 403
+
+
+def test_demoted_admin_is_forbidden(test_client, admin_token, status_file):
+    """
+    Cached user loses admin access as soon as the flag is cleared,
+    even by another worker.
+    """
+    url = url_for('admin.ingest_status')
+    headers = {'Authorization': f'Bearer {admin_token}'}
+    # There is no status yet
+    assert test_client.get(url, headers=headers).status_code == 404
+
+    User.query.filter_by(login='AdminUser')\
+        .update({'is_admin': False}, synchronize_session=False)
+    db.session.commit()
+    assert test_client.get(url, headers=headers).status_code == 403
+
+
+def test_ingest_status(test_client, admin_token, status_file):
+
+    url = url_for('admin.ingest_status')
+    headers = {'Authorization': f'Bearer {admin_token}'}
+
+    response = test_client.get(url, headers=headers)
+    assert response.status_code == 404
+
+    status_file.write_text(json.dumps({
+        'backlog': 3,
+        'imported': 10,
+        'failed': 1,
+        'last_batch': None,
+        'updated_at': time.time()
+    }))
+
+    response = test_client.get(url, headers=headers)
+    assert response.status_code == 200
+    assert response.json.get('running')
+    assert response.json.get('backlog') == 3
+    assert response.json.get('imported') == 10
+
+
+def test_cache_stats(test_client, admin_token, tmp_path):
+
+    path = tmp_path / 'song.mp3'
+    path.write_bytes(b'head')
+    stat = os.stat(path)
+    head_cache.clear()
+    assert head_cache.get('song.mp3', stat) is None
+    head_cache.put('song.mp3', stat, b'head')
+    assert head_cache.get('song.mp3', stat) == b'head'
+
+    response = test_client.get(
+        url_for('admin.cache_stats'),
+        headers={'Authorization': f'Bearer {admin_token}'})
+    assert response.status_code == 200
+    stats = response.json.get('head_cache')
+    assert stats['misses'] == 1
+    assert stats['entries'] == 1
+    assert stats['hit_rate'] == 0.5
+    head_cache.clear()
+
+
+def test_upload_file(test_client, admin_token, audio_storage):
+
+    url = url_for('admin.upload_file')
+    headers = {
+        'Authorization': f'Bearer {admin_token}',
+        'Content-Type': 'application/octet-stream'
+    }
+    data = os.urandom(200 * 1024)
+
+    response = test_client.put(
+        url, query_string={'filename': 'notes.txt'},
+        headers=headers, data=data)
+    assert response.status_code == 400
+
+    response = test_client.put(
+        url, query_string={'filename': 'uploaded.mp3'},
+        headers=headers, data=data)
+    assert response.status_code == 201
+    assert response.json.get('checksum') == hashlib.sha256(data).hexdigest()
+
+    # File is put into the drop folder for the importer
+    uploaded = os.path.join(audio_storage, response.json.get('filename'))
+    with open(uploaded, 'rb') as f:
+        assert f.read() == data
+    os.remove(uploaded)
+
+    # Files already in the library are not queued again
+    library = get_media_storage().root
+    stored = sorted(path for path, _ in walk_mp3_files(library))[0]
+    with open(stored, 'rb') as f:
+        known = f.read()
+    response = test_client.put(
+        url, query_string={'filename': 'known.mp3'},
+        headers=headers, data=known)
+    assert response.status_code == 200
+    assert response.json.get('song_id')
+    assert not os.path.exists(os.path.join(audio_storage, 'known.mp3'))
+
+
+def test_resumable_upload(test_client, admin_token, audio_storage):
+
+    headers = {
+        'Authorization': f'Bearer {admin_token}',
+        'Content-Type': 'application/octet-stream'
+    }
+    data = os.urandom(300 * 1024)
+
+    response = test_client.post(
+        url_for('admin.create_upload'),
+        query_string={'filename': 'chunked.mp3', 'size': len(data)},
+        headers=headers)
+    assert response.status_code == 201
+    upload_id = response.json.get('upload_id')
+
+    chunk_url = url_for('admin.upload_chunk')
+    response = test_client.put(
+        chunk_url, query_string={'upload_id': upload_id, 'offset': 0},
+        headers=headers, data=data[:100 * 1024])
+    assert response.status_code == 200
+    assert response.json.get('offset') == 100 * 1024
+
+    # Finishing incomplete upload fails
+    response = test_client.post(
+        url_for('admin.finish_upload'),
+        query_string={'upload_id': upload_id}, headers=headers)
+    assert response.status_code == 400
+
+    # Chunk which doesn't continue the upload is rejected
+    response = test_client.put(
+        chunk_url, query_string={'upload_id': upload_id, 'offset': 0},
+        headers=headers, data=data[:100 * 1024])
+    assert response.status_code == 409
+    assert response.json.get('offset') == 100 * 1024
+
+    response = test_client.get(
+        url_for('admin.upload_status'),
+        query_string={'upload_id': upload_id}, headers=headers)
+    assert response.json.get('offset') == 100 * 1024
+    assert response.json.get('size') == len(data)
+
+    # Next chunk goes to a worker which hasn't seen the upload
+    hashers.clear()
+    response = test_client.put(
+        chunk_url,
+        query_string={'upload_id': upload_id, 'offset': 100 * 1024},
+        headers=headers, data=data[100 * 1024:])
+    assert response.json.get('offset') == len(data)
+
+    response = test_client.post(
+        url_for('admin.finish_upload'),
+        query_string={'upload_id': upload_id}, headers=headers)
+    assert response.status_code == 201
+    assert response.json.get('checksum') == hashlib.sha256(data).hexdigest()
+
+    uploaded = os.path.join(audio_storage, response.json.get('filename'))
+    assert os.path.getsize(uploaded) == len(data)
+    os.remove(uploaded)
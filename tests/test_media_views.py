@@ -1,12 +1,47 @@
 from flask import url_for
-from ad_server.models import Genre, Album, Song, Artist
-from mutagen.mp3 import EasyMP3
+from ad_server.models import Genre, Album, Song, Artist, MediaFile
+from mutagen.mp3 import EasyMP3, MP3
+from PIL import Image
 from ad_server import db
+from ad_server.utils.covers import get_cover_store
+from ad_server.utils.storage import get_media_storage
+from ad_server.utils import mp3index, signed_urls, zipstream
+from ad_server.utils.listens import listen_counter
+from ad_server.utils.asgi import AsyncApp
+from ad_server.utils.scanner import walk_mp3_files
+from ad_server.utils.streaming import (
+    head_cache, file_cache, warm_head_cache, Pacer
+)
+from ad_server.views import media as media_views
 import pytest
+import asyncio
+import errno
+import zipfile
 import json
+import io
+import time
 import os
 
 
+@pytest.fixture
+def stream_caches(app):
+    """
+    Empties head and file caches, which tests may reconfigure.
+    Their limits are restored from app config on teardown.
+    """
+    head_cache.clear()
+    file_cache.clear()
+    yield head_cache, file_cache
+    head_cache.configure(
+        budget=app.config.get('HEAD_CACHE_SIZE'),
+        head_size=app.config.get('HEAD_CACHE_HEAD_SIZE'))
+    head_cache.clear()
+    file_cache.configure(
+        maxsize=app.config.get('FILE_CACHE_SIZE'),
+        ttl=app.config.get('FILE_CACHE_TTL'))
+    file_cache.clear()
+
+
 def test_get_top_genres(test_client, fill_db):
     """
     Test getting list of top genres
@@ -189,6 +224,464 @@ def test_stream_song(test_client, fill_db):
     os.remove(filename)
 
 
+def test_stream_song_from_time(test_client, fill_db):
+    """
+    Stream started at a time begins with the frame found
+    in the seek table.
+    """
+    song = Song.query.first()
+    path = get_media_storage().path(song.filepath)
+    song.seek_table = mp3index.file_seek_table(path)
+    db.session.commit()
+    start_ms, offset = mp3index.unpack(song.seek_table)[3]
+
+    response = test_client.get(
+        url_for('media.stream_song'),
+        query_string={'id': song.id, 't': start_ms / 1000 + 0.5})
+    assert response.status_code == 200
+    assert float(response.headers['X-Start-Time']) == start_ms / 1000
+    content = response.get_data()
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        assert content == f.read()
+    assert mp3index.parse_header(content[:4])
+
+
+def test_song_segments(test_client, fill_db):
+    """
+    Playlist lists frame aligned segments which put together
+    make the audio of the whole file. Durations are taken from frames,
+    not from song duration rounded down to seconds.
+    """
+    song = Song.query.first()
+    path = get_media_storage().path(song.filepath)
+    length = MP3(path).info.length
+    song.seek_table = mp3index.file_seek_table(path)
+    song.duration = 1
+    db.session.commit()
+
+    response = test_client.get(
+        url_for('media.song_playlist'), query_string={'id': song.id})
+    assert response.status_code == 200
+    assert response.mimetype == 'application/vnd.apple.mpegurl'
+    lines = response.get_data(as_text=True).splitlines()
+    assert lines[0] == '#EXTM3U'
+    assert lines[-1] == '#EXT-X-ENDLIST'
+    urls = [line for line in lines if not line.startswith('#')]
+    assert len(urls) > 1
+    durations = [
+        float(line[len('#EXTINF:'):].rstrip(','))
+        for line in lines if line.startswith('#EXTINF:')]
+    assert all(durations)
+    assert sum(durations) == pytest.approx(length, abs=0.05)
+
+    audio = b''
+    etag = None
+    for url in urls:
+        response = test_client.get(url)
+        assert response.status_code == 200
+        assert response.cache_control.public
+        data = response.get_data()
+        # Segment starts with ID3 timestamp followed by a frame
+        assert data[:3] == b'ID3'
+        tag_size = 10 + int.from_bytes(data[6:10], 'big')
+        assert mp3index.parse_header(data[tag_size:tag_size + 4])
+        audio += data[tag_size:]
+        etag = response.headers['ETag']
+
+    first_frame = mp3index.unpack(song.seek_table)[0][1]
+    with open(path, 'rb') as f:
+        f.seek(first_frame)
+        assert audio == f.read()
+
+    response = test_client.get(urls[-1], headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    response = test_client.get(
+        url_for('media.song_segment'),
+        query_string={'id': song.id, 'n': len(urls)})
+    assert response.status_code == 404
+
+    song.duration = int(length)
+    db.session.commit()
+
+
+def test_stream_song_head_cache(test_client, fill_db, stream_caches):
+    """
+    Start of the song is served from memory once cached, head
+    of a changed file is not used. Most listened songs are cached
+    by the warm up, least recently used heads are evicted.
+    """
+    song = Song.query.first()
+    path = get_media_storage().path(song.filepath)
+    with open(path, 'rb') as f:
+        content = f.read()
+    head_cache.configure(budget=64 * 1024, head_size=16 * 1024)
+    url = url_for('media.stream_song')
+
+    for _ in range(2):
+        response = test_client.get(url, query_string={'id': song.id})
+        assert response.get_data() == content
+    stats = head_cache.stats()
+    assert stats['misses'] == 1
+    assert stats['hits'] == 1
+    assert stats['size'] == 16 * 1024
+
+    os.utime(path, ns=(0, 0))
+    # Stat results of open files are trusted for a while
+    file_cache.clear()
+    response = test_client.get(url, query_string={'id': song.id})
+    assert response.get_data() == content
+    assert head_cache.stats()['misses'] == 2
+
+    stat = os.stat(path)
+    for i in range(4):
+        head_cache.put(f'other{i}', stat, bytes(16 * 1024))
+    assert not head_cache.has(song.filepath, stat)
+    assert head_cache.stats()['evictions'] == 1
+
+    song.listens_count = 1000
+    db.session.commit()
+    assert warm_head_cache(db, get_media_storage()) >= 1
+    assert head_cache.has(song.filepath, os.stat(path))
+
+
+def test_file_cache(test_client, fill_db, tmp_path, stream_caches):
+    """
+    Song files stay open between plays and are reopened when replaced,
+    descriptors of evicted files are closed once they aren't used.
+    """
+    song = Song.query.first()
+    url = url_for('media.stream_song')
+    for _ in range(2):
+        response = test_client.get(url, query_string={'id': song.id})
+        assert response.status_code == 200
+        response.close()
+    stats = file_cache.stats()
+    assert stats['open'] == 1
+    assert stats['hits'] == 1
+
+    path = str(tmp_path / 'song.mp3')
+    with open(path, 'wb') as f:
+        f.write(b'first')
+    file_cache.configure(ttl=0)
+    with file_cache.open('song', path) as opened:
+        assert opened.read(0, 100) == b'first'
+    replacement = str(tmp_path / 'replacement.mp3')
+    with open(replacement, 'wb') as f:
+        f.write(b'second')
+    os.replace(replacement, path)
+    with file_cache.open('song', path) as reopened:
+        assert reopened is not opened
+        assert reopened.read(0, 100) == b'second'
+    assert opened.retired
+
+    file_cache.configure(maxsize=1)
+    in_use = file_cache.open('song', path)
+    file_cache.open('other', path).release()
+    # Evicted file can still be read by the request using it
+    assert in_use.retired
+    assert in_use.read(1, 3) == b'eco'
+    in_use.release()
+    with pytest.raises(OSError):
+        os.fstat(in_use.fd)
+
+
+def test_paced_stream(app, test_client, fill_db, monkeypatch):
+    """
+    Paced stream is sent after the burst at the rate
+    following bitrate of the song.
+    """
+    now = [100.0]
+    pacer = Pacer(1000, burst=500, clock=lambda: now[0])
+    assert pacer.delay(500) == 0
+    assert pacer.delay(500) == 0.5
+    now[0] += 0.5
+    assert pacer.delay(1000) == 1
+
+    song = Song.query.first()
+    path = get_media_storage().path(song.filepath)
+    size = os.path.getsize(path)
+    monkeypatch.setitem(app.config, 'STREAM_PACING', True)
+    monkeypatch.setitem(app.config, 'STREAM_PACING_BURST', 0.1)
+    factor = app.config['STREAM_PACING_FACTOR']
+    # Whole file takes half a second
+    song.bitrate = int(size * 8 * 2 / factor)
+    rate = song.bitrate / 8
+    db.session.commit()
+
+    # Stream waits for every chunk, time stands still
+    delays = []
+    monkeypatch.setattr(
+        media_views, 'Pacer', lambda *args, **kwargs: Pacer(
+            *args, clock=lambda: 0, **kwargs))
+    monkeypatch.setattr(
+        Pacer, 'wait', lambda pacer, size: delays.append(pacer.delay(size)))
+    response = test_client.get(
+        url_for('media.stream_song'), query_string={'id': song.id})
+    with open(path, 'rb') as f:
+        assert response.get_data() == f.read()
+    assert delays == sorted(delays)
+    assert delays[-1] == pytest.approx(
+        (size - rate * 0.1) / (rate * factor))
+
+
+def test_signed_stream_url(app, test_client, fill_db, monkeypatch):
+    """
+    Signed url serves the file without looking up the song,
+    listens are written later in a batch.
+    """
+    storage = get_media_storage()
+    path = sorted(p for p, _ in walk_mp3_files(storage.root))[0]
+    song = Song.query.first()
+    song.filepath = storage.key_of(path)
+    listens = song.listens_count or 0
+    db.session.commit()
+    song_id = song.id
+
+    response = test_client.get(
+        url_for('media.song_stream_url'), query_string={'id': song_id})
+    assert response.status_code == 200
+    url = response.json.get('url')
+    assert song.filepath in url
+    assert response.json.get('expires') > time.time()
+
+    response = test_client.get(url)
+    assert response.status_code == 200
+    assert response.cache_control.public
+    with open(path, 'rb') as f:
+        assert response.get_data() == f.read()
+    assert listen_counter.pending() == 1
+    assert Song.query.get(song_id).listens_count == listens
+
+    assert listen_counter.flush(db) == 1
+    db.session.expire_all()
+    assert Song.query.get(song_id).listens_count == listens + 1
+
+    # Rest of the song fetched by a player is the same listen
+    test_client.get(url, headers={'Range': 'bytes=1000-'})
+    assert listen_counter.pending() == 0
+    test_client.get(url, headers={'Range': 'bytes=0-'})
+    assert listen_counter.pending() == 1
+    listen_counter.flush(db)
+
+    response = test_client.get(url.replace('sig=', 'sig=x'))
+    assert response.status_code == 403
+    assert not signed_urls.verify(
+        'secret', 'key', 1, 100,
+        signed_urls.signature('secret', 'key', 1, 100), now=101)
+
+    monkeypatch.setitem(app.config, 'STREAM_ACCEL_PREFIX', '/internal/')
+    response = test_client.get(url)
+    assert response.headers['X-Accel-Redirect'] == \
+        f'/internal/{song.filepath}'
+    assert not response.get_data()
+    listen_counter.flush(db)
+
+
+def test_song_preview(test_client, fill_db):
+    """
+    Preview is the frame aligned part of the file found on import,
+    it is not counted as a listen.
+    """
+    song = Song.query.first()
+    path = get_media_storage().path(song.filepath)
+    index = mp3index.file_index(path)
+    song.preview_start = index['preview_start']
+    song.preview_end = index['preview_end']
+    listens = song.listens_count
+    db.session.commit()
+    url = url_for('media.song_preview')
+
+    response = test_client.get(url, query_string={'id': song.id})
+    assert response.status_code == 200
+    assert response.cache_control.public
+    content = response.get_data()
+    with open(path, 'rb') as f:
+        f.seek(song.preview_start)
+        assert content == f.read(song.preview_end - song.preview_start)
+    assert mp3index.parse_header(content[:4])
+    assert Song.query.get(song.id).listens_count == listens
+
+    other = Song.query.filter(Song.id != song.id).first()
+    other.preview_start = other.preview_end = None
+    db.session.commit()
+    response = test_client.get(url, query_string={'id': other.id})
+    assert response.status_code == 404
+
+
+def test_download_album(test_client, fill_db):
+    """
+    Album is downloaded as a valid zip archive of its songs,
+    which can be resumed with Range.
+    """
+    album = Song.query.first().album
+    songs = album.songs.all()
+    url = url_for('media.download_album')
+    filepaths = {s.filepath for s in songs}
+    manifest = MediaFile.query.filter(MediaFile.path.in_(filepaths))
+    existed = {f.path for f in manifest}
+    manifest.update({'crc32': None}, synchronize_session=False)
+    db.session.commit()
+
+    # Crc32 is not computed by requests
+    response = test_client.get(url, query_string={'id': album.id})
+    assert response.status_code == 503
+    assert zipstream.backfill_crc32(
+        db, get_media_storage(), workers=0) >= len(filepaths)
+    assert {f.path for f in manifest if f.crc32 is not None} == filepaths
+
+    response = test_client.get(url, query_string={'id': album.id})
+    assert response.status_code == 200
+    assert response.mimetype == 'application/zip'
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    data = response.get_data()
+    assert int(response.headers['Content-Length']) == len(data)
+
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        assert archive.testzip() is None
+        infos = archive.infolist()
+        assert len(infos) == len(songs)
+        storage = get_media_storage()
+        for info, song in zip(infos, songs):
+            assert info.compress_type == zipfile.ZIP_STORED
+            with open(storage.path(song.filepath), 'rb') as f:
+                assert archive.read(info) == f.read()
+
+    etag = response.headers['ETag'].strip('"')
+    response = test_client.get(
+        url, query_string={'id': album.id},
+        headers={'Range': 'bytes=100-', 'If-Range': f'"{etag}"'})
+    assert response.status_code == 206
+    assert response.get_data() == data[100:]
+    assert response.headers['Content-Range'] == \
+        f'bytes 100-{len(data) - 1}/{len(data)}'
+
+    # Range is ignored unless If-Range matches the archive
+    for if_range in ('"changed"', 'Wed, 21 Oct 2015 07:28:00 GMT'):
+        response = test_client.get(
+            url, query_string={'id': album.id},
+            headers={'Range': 'bytes=100-', 'If-Range': if_range})
+        assert response.status_code == 200
+        assert response.get_data() == data
+
+    response = test_client.get(
+        url, query_string={'id': album.id},
+        headers={'Range': f'bytes={len(data)}-'})
+    assert response.status_code == 416
+
+    # Multiple ranges are answered with the whole archive
+    response = test_client.get(
+        url, query_string={'id': album.id},
+        headers={'Range': f'bytes=0-99,{len(data)}-'})
+    assert response.status_code == 200
+    assert response.get_data() == data
+
+    response = test_client.get(url, query_string={'id': 0})
+    assert response.status_code == 400
+
+    MediaFile.query.filter(MediaFile.path.in_(filepaths - existed))\
+        .delete(synchronize_session=False)
+    db.session.commit()
+
+
+def test_async_stream_song(app, fill_db):
+    """
+    Async server sends the same stream as the WSGI app, and streams
+    waiting for slow clients don't hold its threads.
+    """
+    song = Song.query.first()
+    with open(get_media_storage().path(song.filepath), 'rb') as f:
+        content = f.read()
+    server = AsyncApp(app, workers=2)
+    streams = 6
+    started = []
+
+    async def stream(i, client_ready):
+        scope = {
+            'type': 'http',
+            'method': 'GET',
+            'path': url_for('media.stream_song'),
+            'query_string': f'id={song.id}'.encode(),
+            'headers': [(b'host', b'localhost')],
+            'client': (f'10.0.0.{i}', 0),
+        }
+        requests = [{'type': 'http.request', 'body': b''}]
+        sent = []
+
+        async def receive():
+            if requests:
+                return requests.pop()
+            await asyncio.Event().wait()
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                started.append(i)
+                await client_ready.wait()
+            sent.append(message)
+
+        await server(scope, receive, send)
+        return sent
+
+    async def serve():
+        client_ready = asyncio.Event()
+        tasks = [asyncio.ensure_future(stream(i, client_ready))
+                 for i in range(streams)]
+        for _ in range(500):
+            if len(started) == streams:
+                break
+            await asyncio.sleep(0.01)
+        client_ready.set()
+        return len(started), await asyncio.gather(*tasks)
+
+    try:
+        started_at_once, responses = asyncio.run(serve())
+    finally:
+        server.executor.shutdown()
+    assert started_at_once == streams
+    for sent in responses:
+        assert sent[0]['status'] == 200
+        assert (b'content-length', str(len(content)).encode()) in \
+            sent[0]['headers']
+        assert b''.join(m.get('body', b'') for m in sent[1:]) == content
+        assert not sent[-1].get('more_body')
+
+
+def test_stream_broken_song(test_client, fill_db):
+    """
+    Broken songs are not streamed, song whose file has gone
+    is flagged broken.
+    """
+    song, missing = Song.query.limit(2).all()
+    song.broken = True
+    missing.filepath = '/nonexistent/song.mp3'
+    db.session.commit()
+    url = url_for('media.stream_song')
+
+    response = test_client.get(url, query_string={'id': song.id})
+    assert response.status_code == 404
+
+    response = test_client.get(url, query_string={'id': missing.id})
+    assert response.status_code == 404
+    assert Song.query.get(missing.id).broken
+
+
+def test_stream_song_open_error(test_client, fill_db, monkeypatch):
+    """
+    Song whose file exists but fails to open is not flagged broken.
+    """
+    song = Song.query.filter(~Song.broken).first()
+
+    def fail(key, path):
+        raise OSError(errno.EMFILE, 'Too many open files')
+
+    monkeypatch.setattr(file_cache, 'open', fail)
+    response = test_client.get(
+        url_for('media.stream_song'), query_string={'id': song.id})
+    assert response.status_code == 503
+    assert response.headers['Retry-After']
+    assert not Song.query.get(song.id).broken
+
+
 def test_search_albums_by_title(test_client, albums_for_search, fill_db):
     """
     Tests view function wich searches albums by title
@@ -438,3 +931,49 @@ def test_pagination(test_client, fill_db):
 
     # Check if a the songs from first and second queries is different
     assert set(first_ids).isdisjoint(set(second_ids))
+
+
+def test_cover(test_client, audio_storage):
+    """
+    Covers are served from the local store with long lived cache headers
+    and revalidated with ETag.
+    """
+    image = b'\x89PNG\r\n\x1a\n' + os.urandom(256)
+    cover_hash = get_cover_store().put(image)
+    url = url_for('media.cover')
+
+    response = test_client.get(url, query_string={'hash': cover_hash})
+    assert response.status_code == 200
+    assert response.data == image
+    assert response.mimetype == 'image/png'
+    assert response.cache_control.max_age >= 24 * 3600
+    assert response.cache_control.immutable
+    etag = response.headers['ETag']
+
+    response = test_client.get(
+        url,
+        query_string={'hash': cover_hash, 'size': 'small'},
+        headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+    response = test_client.get(url, query_string={'hash': '0' * 64})
+    assert response.status_code == 404
+    response = test_client.get(url, query_string={'hash': '../../x'})
+    assert response.status_code == 404
+
+
+def test_cover_size_variants(test_client, audio_storage):
+    """
+    Smaller variants of big covers are made when they are stored.
+    """
+    buffer = io.BytesIO()
+    Image.new('RGB', (600, 300), 'red').save(buffer, 'PNG')
+    cover_hash = get_cover_store().put(buffer.getvalue())
+    url = url_for('media.cover')
+
+    for size, expected in (('small', (174, 87)), ('medium', (300, 150))):
+        response = test_client.get(
+            url, query_string={'hash': cover_hash, 'size': size})
+        assert response.status_code == 200
+        assert response.mimetype == 'image/jpeg'
+        assert Image.open(io.BytesIO(response.data)).size == expected
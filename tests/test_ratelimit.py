@@ -0,0 +1,90 @@
+from ad_server import limiter
+from ad_server.utils.ratelimit import (
+    MemoryBucketStorage, SQLiteBucketStorage, parse_limit
+)
+from werkzeug.middleware.proxy_fix import ProxyFix
+from flask import url_for
+import os
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def rate_limits(monkeypatch):
+    """
+    Rate limits are disabled in other tests, these run them
+    with empty buckets.
+    """
+    monkeypatch.setattr(limiter, 'enabled', True)
+    monkeypatch.setattr(limiter, 'storage', MemoryBucketStorage())
+
+
+def test_parse_limit():
+    assert parse_limit('10/minute') == (10, 60)
+    assert parse_limit('100/5 minutes') == (100, 300)
+
+    with pytest.raises(ValueError):
+        parse_limit('ten per minute')
+
+
+def test_rate_limited_endpoint(test_client):
+    """
+    Requests above the limit are rejected with 429 and Retry-After header.
+    """
+    url = url_for('test_limited')
+
+    for _ in range(2):
+        response = test_client.get(url)
+        assert response.status_code == 200
+
+    response = test_client.get(url)
+
+    assert response.status_code == 429
+    assert int(response.headers.get('Retry-After')) > 0
+
+    # Other clients have their own buckets
+    response = test_client.get(
+        url, environ_base={'REMOTE_ADDR': '10.0.0.2'})
+    assert response.status_code == 200
+
+
+def test_rate_limit_behind_proxy(app, test_client, monkeypatch):
+    """
+    Behind a trusted proxy clients are told apart by forwarded address.
+    """
+    monkeypatch.setattr(app, 'wsgi_app', ProxyFix(app.wsgi_app, x_for=1))
+    url = url_for('test_limited')
+
+    for client in ('203.0.113.1', '203.0.113.2'):
+        headers = {'X-Forwarded-For': client}
+        for _ in range(2):
+            assert test_client.get(url, headers=headers).status_code == 200
+        assert test_client.get(url, headers=headers).status_code == 429
+
+
+def test_rate_limit_per_url(test_client):
+    """
+    Every url has its own bucket, whoever requests it.
+    """
+    url = url_for('test_limited_url', sig='a')
+
+    assert test_client.get(url).status_code == 200
+    response = test_client.get(
+        url, environ_base={'REMOTE_ADDR': '10.0.0.2'})
+    assert response.status_code == 429
+    assert test_client.get(
+        url_for('test_limited_url', sig='b')).status_code == 200
+
+
+def test_sqlite_bucket_storage(tmp_path):
+    """
+    Buckets in sqlite file are shared between storage instances,
+    like between worker processes.
+    """
+    path = os.path.join(tmp_path, 'buckets.db')
+    first = SQLiteBucketStorage(path)
+    second = SQLiteBucketStorage(path)
+
+    assert first.consume('key', 2, 60) == 0
+    assert second.consume('key', 2, 60) == 0
+    assert first.consume('key', 2, 60) > 0
+    assert second.consume('other', 2, 60) == 0
@@ -1,9 +1,16 @@
 from werkzeug.security import generate_password_hash, check_password_hash
-from ad_server.models import User
-from ad_server.models import RefreshToken
-from flask import url_for
+from ad_server.models import User, user_cache
+from ad_server.models import RefreshToken, RevokedToken
+from ad_server.views.auth import token_cache, token_digest, \
+    revocation_cache
+from ad_server import db, password_hasher, create_app
+from ad_server.config import TestConfig
+from datetime import datetime, timedelta
+from flask import url_for, current_app
 import json
+import jwt
 import base64
+import threading
 import time
 
 
@@ -75,6 +82,60 @@ def test_get_token(test_client):
     assert message == 'Access token retrieved'
 
 
+def basic_auth_header(login, password):
+    auth = base64.b64encode(
+        bytes(login + ':' + password, 'utf-8')).decode('utf-8')
+    return {'Authorization': f'Basic {auth}'}
+
+
+def test_password_rehash_on_login(test_client):
+    """
+    Password hash made with outdated method is replaced on login.
+    """
+    user = User(login='RehashUser')
+    user.pass_hash = generate_password_hash(
+        'testpass', method='pbkdf2:sha256:500')
+    db.session.add(user)
+    db.session.commit()
+
+    assert password_hasher.needs_rehash(user.pass_hash)
+
+    response = test_client.get(
+        url_for('users.get_token'),
+        headers=basic_auth_header('RehashUser', 'testpass')
+    )
+
+    assert response.status_code == 200
+    assert not password_hasher.needs_rehash(user.pass_hash)
+    assert user.check_password('testpass')
+
+    RefreshToken.revoke(response.json.get('refresh_token'))
+    db.session.delete(user)
+    db.session.commit()
+
+
+def test_password_check_rejected_when_busy(test_client):
+    """
+    Login is rejected with 429 when password hashing pool is full.
+    """
+    slots = password_hasher.slots
+    taken = 0
+    while slots.acquire(blocking=False):
+        taken += 1
+
+    try:
+        response = test_client.get(
+            url_for('users.get_token'),
+            headers=basic_auth_header('TestUser', 'testpass')
+        )
+    finally:
+        for _ in range(taken):
+            slots.release()
+
+    assert response.status_code == 429
+    assert response.headers.get('Retry-After')
+
+
 def test_refresh_token(test_client_json, user_with_tokens):
     """
     Test process of getting new access token by
@@ -189,3 +250,152 @@ def test_access_with_valid_token(test_client, user_with_tokens):
     assert response.status_code == 200
     assert response.json.get('message') ==\
         'Successful API call with token required'
+
+
+def test_user_cache(test_client, user_with_tokens):
+    """
+    User loaded during token authentication is cached by id
+    and dropped from cache when password is changed.
+    """
+    user, access, _ = user_with_tokens
+    user_cache.clear()
+
+    headers = {'Authorization': f'Bearer {access}'}
+
+    response = test_client.get(url_for('test_token_access'), headers=headers)
+    assert response.status_code == 200
+    assert user.id in user_cache
+
+    # Served from cache this time
+    response = test_client.get(url_for('test_token_access'), headers=headers)
+    assert response.status_code == 200
+    assert User.get_cached(user.id).login == user.login
+
+    user.password = 'testpass'
+    assert user.id not in user_cache
+
+
+def test_revoke_access_token(test_client_json, user_with_tokens):
+    """
+    Verified token is cached and rejected right after it is revoked.
+    """
+    user, access, refresh = user_with_tokens
+
+    headers = {'Authorization': f'Bearer {access}'}
+
+    response = test_client_json.get(
+        url_for('test_token_access'), headers=headers)
+    assert response.status_code == 200
+    assert token_cache.get(token_digest(access))['id'] == user.id
+
+    response = test_client_json.post(
+        url_for('users.revoke_token'),
+        data=json.dumps({'refresh_token': refresh, 'access_token': access})
+    )
+    assert response.status_code == 200
+
+    response = test_client_json.get(
+        url_for('test_token_access'), headers=headers)
+    assert response.status_code == 401
+    assert response.json.get('message') == 'Invalid token'
+
+    # Revocation is kept in the database, so workers which have
+    # the token cached reject it once their revocation check expires
+    payload = jwt.decode(
+        access, current_app.config['SECRET_KEY'], algorithms='HS256')
+    assert RevokedToken.is_revoked(payload['jti'])
+    token_cache.set(token_digest(access), payload)
+    revocation_cache.set(payload['jti'], True)
+    response = test_client_json.get(
+        url_for('test_token_access'), headers=headers)
+    assert response.status_code == 200
+
+    revocation_cache.pop(payload['jti'])
+    response = test_client_json.get(
+        url_for('test_token_access'), headers=headers)
+    assert response.status_code == 401
+
+
+def test_delete_expired_revoked_tokens():
+    """
+    Revocations are deleted once their tokens have expired.
+    """
+    now = datetime.utcnow()
+    RevokedToken.revoke('expired', now - timedelta(seconds=1))
+    RevokedToken.revoke('valid', now + timedelta(hours=1))
+    db.session.commit()
+
+    assert RevokedToken.delete_expired() >= 1
+    assert not RevokedToken.is_revoked('expired')
+    assert RevokedToken.is_revoked('valid')
+    RevokedToken.query.delete()
+    db.session.commit()
+
+
+def test_sweeper_starts_with_first_request():
+    """
+    Background threads are not started by create_app, so scripts
+    and the master of a pre-forking server don't run them.
+    """
+    class SweepConfig(TestConfig):
+        TOKEN_SWEEP_INTERVAL = 3600
+
+    def sweepers():
+        return [t for t in threading.enumerate() if t.name == 'token-sweeper']
+
+    app = create_app(SweepConfig)
+    assert not sweepers()
+
+    app.test_client().get('/')
+    assert len(sweepers()) == 1
+    app.test_client().get('/')
+    assert len(sweepers()) == 1
+    sweepers()[0].stop()
+
+
+def test_expired_refresh_token_rotation(user_with_tokens):
+    """
+    Expired refresh token is not valid and replaced by create_or_get.
+    """
+    user, _, refresh = user_with_tokens
+
+    token = RefreshToken.query.get(refresh)
+    token.expiration_date = datetime.utcnow() - timedelta(seconds=1)
+    db.session.commit()
+
+    assert RefreshToken.valid_token(refresh) is None
+
+    new_refresh = RefreshToken.create_or_get(user.id)
+    db.session.commit()
+
+    assert new_refresh != refresh
+    assert RefreshToken.valid_token(new_refresh)
+    assert RefreshToken.create_or_get(user.id) == new_refresh
+
+    RefreshToken.revoke(new_refresh)
+    db.session.commit()
+
+
+def test_delete_expired_refresh_tokens():
+    """
+    Expired tokens are deleted in batches, valid ones are kept.
+    """
+    users = [User(login=f'SweepUser{i}', password='testpass')
+             for i in range(5)]
+    db.session.add_all(users)
+    db.session.commit()
+
+    tokens = [RefreshToken.create(u.id, timedelta(seconds=-1))
+              for u in users[:4]]
+    valid = RefreshToken.create(users[4].id)
+    db.session.commit()
+
+    assert RefreshToken.delete_expired(batch_size=3) == len(tokens)
+    assert RefreshToken.query.filter(
+        RefreshToken.token.in_(tokens)).count() == 0
+    assert RefreshToken.valid_token(valid)
+
+    RefreshToken.revoke(valid)
+    for u in users:
+        db.session.delete(u)
+    db.session.commit()